@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AniArr 轻量客户端：把一个目录或文件交给常驻的 `main.py --serve` 处理，供下载客户端的完成钩子调用。
+只导入几个标准库模块，不加载配置也不扫描目录；服务没有运行时退回到直接执行 `main.py -y`。
+
+qBittorrent「Torrent 完成时运行外部程序」：
+  python3 /path/to/aniarr_client.py "%F" /media/Anime
+
+退出码：0 成功 / 已入队，1 请求错误或无法连接，2 有文件执行失败（与 main.py 相同）。
+"""
+
+import json, os, socket, sys
+
+USAGE = ("usage: aniarr_client.py [--socket PATH] [--no-wait] [--title T] [--year Y] [--season N]\n"
+         "                        [--depth N] [--no-extras] source [destination]")
+VALUE_OPTS = {"--title": "title", "--year": "year", "--season": "season", "--depth": "depth"}
+
+def default_socket() -> str:
+    # 与 main.py 中的同名函数保持一致
+    if os.environ.get("ANIARR_SOCKET"): return os.environ["ANIARR_SOCKET"]
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    return os.path.join(base, "aniarr.sock") if base else f"/tmp/aniarr-{os.getuid()}.sock"
+
+def usage_error(msg: str):
+    print(f"{USAGE}\naniarr_client.py: error: {msg}", file=sys.stderr); sys.exit(1)
+
+def parse_args(argv):
+    path, job, pos = default_socket(), {"wait": True}, []
+    it = iter(argv)
+    for a in it:
+        if a in ("-h", "--help"):
+            print(USAGE); sys.exit(0)
+        elif a == "--socket":
+            path = next(it, None) or usage_error("--socket needs a value")
+        elif a == "--no-wait":
+            job["wait"] = False
+        elif a == "--no-extras":
+            job["no_extras"] = True
+        elif a in VALUE_OPTS:
+            v = next(it, None)
+            if v is None: usage_error(f"{a} needs a value")
+            if a in ("--season", "--depth"):
+                if not v.isdigit(): usage_error(f"{a} needs a number")
+                v = int(v)
+            job[VALUE_OPTS[a]] = v
+        elif a.startswith("--"):
+            usage_error(f"unknown option {a}")
+        else:
+            pos.append(a)
+    if not 1 <= len(pos) <= 2: usage_error("expected source [destination]")
+    # 服务端的工作目录与钩子不同，路径一律转成绝对路径
+    job["source"] = os.path.abspath(pos[0])
+    if len(pos) == 2: job["destination"] = os.path.abspath(pos[1])
+    return path, job
+
+def fallback(job) -> int:
+    """服务不可用：同目录下有 main.py 时直接跑一次非交互整理。"""
+    main = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    if not os.path.isfile(main): return 1
+    argv = [sys.executable, main, "-y", job["source"]] + ([job["destination"]] if "destination" in job else [])
+    for opt, key in VALUE_OPTS.items():
+        if key in job: argv += [opt, str(job[key])]
+    if job.get("no_extras"): argv.append("--no-extras")
+    sys.stdout.flush()
+    os.execv(sys.executable, argv)
+
+def main() -> int:
+    path, job = parse_args(sys.argv[1:])
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except OSError as e:
+        s.close()
+        print(f"[WARN] aniarr server not reachable at {path} ({e}); running main.py directly.", file=sys.stderr)
+        return fallback(job)
+    with s, s.makefile("rwb") as f:
+        f.write(json.dumps(job, ensure_ascii=False).encode("utf-8") + b"\n"); f.flush()
+        line = f.readline()
+    if not line:
+        print("[ERROR] server closed the connection before replying", file=sys.stderr); return 1
+    reply = json.loads(line)
+    if reply.get("status") == "error":
+        print(f"[ERROR] {reply.get('error')}", file=sys.stderr); return 1
+    if reply.get("status") == "queued":
+        print("Queued."); return 0
+    print(f"Done. planned={reply['planned']} OK={reply['ok']} FAIL={reply['fail']} "
+          f"skipped={reply['skipped']} (handled together with {reply['requests'] - 1} other request(s))")
+    return 2 if reply.get("fail") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+aniarr 基准测试：生成确定性的字幕组发布文件名语料，分阶段测吞吐。
+
+阶段：scan（os.scandir 遍历）、parse（NameParser 冷缓存）、classify（extras 规则）、
+plan（plan_entries，冷缓存，不含重名解决）、sort、resolve（DestIndex 重名解决）、render（文本输出）、
+link（在 tmpfs 上实际建硬链接）。
+
+  python bench.py                                  # 默认 1k / 10k / 100k
+  python bench.py --sizes 1000,1000000 --no-fs     # 只测纯计算阶段，不落盘
+  python bench.py --save-baseline                  # 写入 bench_baseline.json
+  python bench.py --check                          # 与基线比较，任一阶段低于 --tolerance 时退出码 1
+"""
+import argparse, contextlib, io, json, os, platform, random, shutil, sys, tempfile, time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import main as aniarr
+
+BASELINE = Path(__file__).with_name("bench_baseline.json")
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+STAGES = ("scan", "parse", "classify", "plan", "sort", "resolve", "render", "link")
+
+# ---------- corpus ----------
+
+GROUPS = ["LoliHouse", "Nekomoe kissaten", "Sakurato", "ANi", "VCB-Studio", "SweetSub",
+          "XKsub&VCB-Studio", "桜都字幕组", "北宇治字幕组", "喵萌奶茶屋"]
+TITLES = ["Dandadan", "Sousou no Frieren", "Kusuriya no Hitorigoto", "Oshi no Ko", "Bocchi the Rock",
+          "Spy x Family", "Mushoku Tensei", "Kaguya-sama wa Kokurasetai", "Hibike Euphonium",
+          "Yuru Camp", "胆大党", "葬送的芙莉莲", "药屋少女的呢喃", "孤独摇滚"]
+SUFFIXES = ["", "", "", " Zoku", " Kan", " Next", " Shin", " Final", " Gaiden", " Zero"]
+TECH = ["[1080p]", "[HEVC]", "[x265_flac]", "[Ma10p_1080p]", "[WebRip 1080p HEVC-10bit AAC]",
+        "[BDRip 1080p AVC FLAC]", "[2160p][HDR]", "WEB-DL 1080p", ""]
+SUB_LANGS = [".zh-CN", ".zh-TW", ".sc", ".tc", ".chs", ".cht", ".jpsc", ".jptc", ".ja", ".en", ""]
+EXTRAS = ["NCOP", "NCED", "PV1", "PV2", "CM01", "CM02", "Menu1", "Menu2", "SP01", "SP02", "Preview01", "Trailer"]
+ZH_DIGITS = "零一二三四五六七八九"
+
+def zh_num(n: int) -> str:
+    if n < 10: return ZH_DIGITS[n]
+    tens, ones = divmod(n, 10)
+    return (ZH_DIGITS[tens] if tens > 1 else "") + "十" + (ZH_DIGITS[ones] if ones else "")
+
+def ep_token(rng: random.Random, style: int, season: int, ep: int) -> str:
+    if style == 0: return f"[{ep:02d}]"
+    if style == 1: return f"- {ep:02d}"
+    if style == 2: return f"S{season:02d}E{ep:02d}"
+    if style == 3: return f"第{zh_num(ep)}话"
+    return f"EP{ep:02d}"
+
+def gen_corpus(n: int, seed: int = 0) -> List[str]:
+    """
+    确定性地生成 n 个相对路径（同一 seed 结果不变）。每个系列一个目录：正片 + 0~3 个字幕 + 少量杂项，
+    部分系列带 SPs/ 目录，部分 extras 直接混在正片目录里。
+    """
+    rng = random.Random(seed)
+    out: List[str] = []
+    sid = 0
+    while len(out) < n:
+        sid += 1
+        group = rng.choice(GROUPS)
+        title = rng.choice(TITLES) + rng.choice(SUFFIXES)
+        season = rng.choice((1, 1, 1, 2, 3))
+        style = rng.randrange(5)
+        tech = rng.choice(TECH)
+        ext = rng.choice((".mkv", ".mkv", ".mkv", ".mp4"))
+        folder = f"{title} S{season} #{sid}"
+        langs = rng.sample(SUB_LANGS, rng.randrange(4))
+        for ep in range(1, rng.randint(12, 26) + 1):
+            base = f"[{group}] {title} {ep_token(rng, style, season, ep)} {tech}".rstrip()
+            out.append(f"{folder}/{base}{ext}")
+            for lang in langs:
+                out.append(f"{folder}/{base}{lang}{rng.choice(('.ass', '.ass', '.srt'))}")
+        if rng.random() < 0.3:
+            out.append(f"{folder}/[{group}] {title} [{season:02d}].nfo")
+        if rng.random() < 0.5:
+            sp = rng.choice(("SPs", "SP", "extras"))
+            for tag in rng.sample(EXTRAS, rng.randint(1, 6)):
+                out.append(f"{folder}/{sp}/[{group}] {title} [{tag}]{tech}{ext}")
+        elif rng.random() < 0.5:
+            for tag in rng.sample(EXTRAS, rng.randint(1, 3)):
+                out.append(f"{folder}/[{group}] {title} [{tag}]{tech}{ext}")
+    return out[:n]
+
+def materialize(root: Path, rels: List[str]):
+    """在 root 下建出空文件（tmpfs 上很快）。"""
+    made = set()
+    for rel in rels:
+        d = os.path.join(root, os.path.dirname(rel))
+        if d not in made:
+            os.makedirs(d, exist_ok=True); made.add(d)
+        os.close(os.open(os.path.join(root, rel), os.O_CREAT | os.O_WRONLY, 0o644))
+
+def synthetic_entries(root: Path, rels: List[str]) -> List[aniarr.ScanEntry]:
+    """--no-fs：不落盘，直接构造与 scan_tree(depth=2) 等价的条目。"""
+    out = []
+    for rel in rels:
+        parts = rel.split("/")
+        extras = len(parts) > 2 and parts[1].lower() in aniarr.EXTRAS_DIRS
+        out.append(aniarr.ScanEntry(os.path.join(root, rel), parts[-1], os.path.join(*parts),
+                                    len(parts) - 1, 'file', extras, None))
+    return out
+
+def tmpfs_dir() -> str:
+    return "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+
+# ---------- stages ----------
+
+def best_of(repeat: int, fn: Callable[[], Any], setup: Optional[Callable[[], None]] = None) -> Tuple[float, Any]:
+    best, res = float("inf"), None
+    for _ in range(repeat):
+        if setup: setup()
+        t0 = time.perf_counter()
+        res = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, res
+
+def run_size(n: int, args, cfg: Dict[str, Any]) -> Dict[str, float]:
+    rels = gen_corpus(n, args.seed)
+    work = Path(tempfile.mkdtemp(prefix="aniarr-bench-", dir=args.tmp))
+    src, dst = work / "src", work / "dst"
+    rules, fallback = cfg["rule_set"], cfg["fallback_category"]
+    rates: Dict[str, float] = {}
+    try:
+        if args.no_fs:
+            entries = synthetic_entries(src, rels)
+        else:
+            materialize(src, rels)
+            secs, entries = best_of(args.repeat, lambda: list(aniarr.scan_tree(src, 2, aniarr.DEFAULT_IGNORE)))
+            rates["scan"] = len(entries) / secs
+
+        files = [e for e in entries if e.kind == 'file']
+        main_names = [e.name for e in files if not e.extras]
+        extra_names = [e.name for e in files if e.extras]
+        videos = [e.name for e in files if aniarr.name_ext(e.name) in aniarr.VIDEO_EXTS]
+
+        def parse():
+            for nm in main_names: aniarr.PARSER.parse(nm)
+            for nm in extra_names: aniarr.PARSER.parse_extra(nm)
+        secs, _ = best_of(args.repeat, parse, aniarr.PARSER.clear)
+        rates["parse"] = len(files) / secs
+
+        def classify():
+            for nm in videos:
+                if rules.matches(nm): aniarr.classify_extra(nm, rules, fallback)
+        secs, _ = best_of(args.repeat, classify)
+        rates["classify"] = len(videos) / secs
+
+        plan_fn = lambda: aniarr.plan_entries(entries, dst, None, None, None, True, "series", rules, fallback, None,
+                                             resolve=False)[0]
+        secs, plan = best_of(args.repeat, plan_fn, aniarr.PARSER.clear)
+        rates["plan"] = len(entries) / secs
+
+        shuffled = plan[:]
+        random.Random(args.seed).shuffle(shuffled)
+        secs, _ = best_of(args.repeat, lambda: sorted(shuffled, key=aniarr.plan_sort_key))
+        rates["sort"] = len(plan) / secs
+
+        def resolve():
+            items = plan_fn()
+            t0 = time.perf_counter()
+            aniarr.resolve_collisions(items, aniarr.DestIndex())
+            return time.perf_counter() - t0, items
+        timings = [resolve() for _ in range(args.repeat)]
+        rates["resolve"] = len(plan) / min(t for t, _ in timings)
+        plan = timings[-1][1]
+
+        secs, _ = best_of(args.repeat, lambda: sum(1 for _ in aniarr.render_plan(plan, dst, 100)))
+        rates["render"] = len(plan) / secs
+
+        if not args.no_fs:
+            def link():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    return aniarr.PlanExecutor(dst, False, jobs=args.jobs).run(plan, summary=False)
+            secs, (ok, fail) = best_of(args.repeat, link, lambda: shutil.rmtree(dst, ignore_errors=True))
+            if fail: print(f"[WARN] {fail} hardlinks failed at n={n}", file=sys.stderr)
+            rates["link"] = len(plan) / secs
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        aniarr.PARSER.clear()
+    return rates
+
+# ---------- report ----------
+
+def fmt_rate(r: Optional[float]) -> str:
+    if r is None: return "-"
+    for unit, div in (("M", 1e6), ("k", 1e3)):
+        if r >= div: return f"{r / div:.2f}{unit}/s"
+    return f"{r:.0f}/s"
+
+def report(results: Dict[str, Dict[str, float]], base: Optional[Dict[str, Dict[str, float]]]) -> Tuple[List[str], List[str]]:
+    """返回（报表行，各 "size/stage=比值" 列表；没有基线时比值列表为空）。"""
+    lines = []
+    head = f"{'size':>9}  " + "  ".join(f"{s:>16}" for s in STAGES)
+    lines.append(head); lines.append("-" * len(head))
+    ratios: List[str] = []
+    for size, rates in results.items():
+        cells = []
+        for s in STAGES:
+            r = rates.get(s)
+            b = (base or {}).get(size, {}).get(s)
+            if r is not None and b:
+                ratios.append(f"{size}/{s}={r / b:.2f}")
+                cells.append(f"{fmt_rate(r)} {r / b:4.2f}x")
+            else:
+                cells.append(fmt_rate(r))
+        lines.append(f"{int(size):>9}  " + "  ".join(f"{c:>16}" for c in cells))
+    return lines, ratios
+
+def load_baseline(path: Path) -> Optional[Dict[str, Dict[str, float]]]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))["results"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark aniarr's scan/parse/classify/plan/sort/render/link stages on a synthetic corpus.")
+    ap.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma-separated corpus sizes (default: 1000,10000,100000; up to 1000000)")
+    ap.add_argument("--repeat", type=int, default=3, help="Runs per stage; the best one is reported (default: 3)")
+    ap.add_argument("--seed", type=int, default=0, help="Corpus seed (default: 0)")
+    ap.add_argument("--jobs", type=int, default=1, help="Parallel hardlink jobs for the link stage (default: 1)")
+    ap.add_argument("--no-fs", action="store_true", help="Skip the scan and link stages and do not create files")
+    ap.add_argument("--tmp", default=tmpfs_dir(), help="Scratch directory, ideally tmpfs (default: /dev/shm when writable)")
+    ap.add_argument("--baseline", type=Path, default=BASELINE, help=f"Baseline JSON to compare against (default: {BASELINE.name})")
+    ap.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    ap.add_argument("--check", action="store_true", help="Exit 1 when any stage falls below --tolerance x baseline")
+    ap.add_argument("--tolerance", type=float, default=0.8, help="Slowest acceptable ratio to baseline for --check (default: 0.8)")
+    ap.add_argument("-o", "--output", type=Path, help="Also write the report to this file (e.g. bench_output.txt)")
+    args = ap.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    cfg = aniarr.load_config(None)
+    base = None if args.save_baseline else load_baseline(args.baseline)
+
+    results: Dict[str, Dict[str, float]] = {}
+    for n in sizes:
+        print(f"[BENCH] n={n} ...", file=sys.stderr, flush=True)
+        results[str(n)] = {s: round(r, 1) for s, r in run_size(n, args, cfg).items()}
+
+    lines, ratios = report(results, base)
+    lines.insert(0, f"# python {platform.python_version()} on {platform.system()} {platform.machine()}, "
+                    f"repeat={args.repeat}, seed={args.seed}, tmp={args.tmp}"
+                    + (f", baseline={args.baseline.name}" if base else ""))
+    text = "\n".join(lines)
+    print(text)
+    if args.output: args.output.write_text(text + "\n", encoding="utf-8")
+
+    if args.save_baseline:
+        meta = {"python": platform.python_version(), "platform": platform.platform(), "repeat": args.repeat,
+                "seed": args.seed, "date": time.strftime("%Y-%m-%d")}
+        args.baseline.write_text(json.dumps({"meta": meta, "results": results}, indent=2) + "\n", encoding="utf-8")
+        print(f"[BENCH] baseline saved to {args.baseline}", file=sys.stderr)
+    elif args.check:
+        slow = [r for r in ratios if float(r.rsplit("=", 1)[1]) < args.tolerance]
+        if base is None:
+            print(f"[ERROR] no baseline at {args.baseline}", file=sys.stderr); sys.exit(1)
+        if slow:
+            print("[FAIL] below tolerance: " + ", ".join(slow), file=sys.stderr); sys.exit(1)
+
+if __name__ == "__main__":
+    main()
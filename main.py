@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import argparse, os, re, shutil, sys, textwrap, json
+import argparse, errno, os, re, shutil, sys, textwrap, json, fnmatch, sqlite3, time, contextlib, threading, hashlib, mmap, unicodedata, atexit, math, socket, queue, signal, struct, itertools, heapq, pickle, tempfile, urllib.request, urllib.error
 from pathlib import Path
-from typing import Optional, List, Tuple, Dict, Any
+from typing import Optional, List, Tuple, Dict, Any, NamedTuple, Iterator, Iterable, Sequence, Callable
 from shutil import get_terminal_size
 from collections import defaultdict, Counter
 
@@ -34,29 +34,66 @@ JF_CATEGORIES = {
 def is_video(p: Path) -> bool: return p.suffix.lower() in VIDEO_EXTS
 def is_sub(p: Path)   -> bool: return p.suffix.lower() in SUB_EXTS
 
+def name_ext(name: str) -> str:
+    # 与 Path(name).suffix.lower() 相同，但不构造 Path
+    return os.path.splitext(name)[1].lower()
+
+# 所有文件名相关的正则在导入时编译一次
+_RE_UNSAFE       = re.compile(r'[/\\:*?"<>|]')
+_RE_TECH_BRACKET = re.compile(r'\[(?:1080p|2160p|720p|x26[45]|HEVC|AVC|WEB[- ]?DL|BluRay|FLAC|AAC|HDR|DV|Ma10p_[^\]]+)\]', re.I)
+_RE_TECH_WORD    = re.compile(r'\b(1080p|2160p|720p|x26[45]|HEVC|AVC|WEB[- ]?DL|BluRay|FLAC|AAC|HDR|DV)\b', re.I)
+_RE_SEPS         = re.compile(r'[ _\-]{2,}')
+_RE_ANY_BRACKET  = re.compile(r'\s*\[[^\[\]]+\]\s*')
+_RE_LEAD_BRACKET = re.compile(r'^\s*\[[^\[\]]+\]\s*')
+_RE_TAIL_BRACKET = re.compile(r'\s*\[[^\[\]]+\]\s*$')
+_RE_GROUP        = re.compile(r'\s*\[([^\[\]]+)\]\s*')
+_LANG_TOKENS     = r'((?:zh[-_ ]?(?:cn|tw)|chs|cht|sc|tc|zhs|zht|gb|cn|tw|ja|jp|en|eng|ko|kor|jpsc|jptc))'
+_RE_LANG_SUFFIX  = re.compile(r'[\._-]' + _LANG_TOKENS + r'(?:[-_](\d+))?(?=\.(ass|srt|vtt|ssa|sup)\b)', re.I)
+_RE_LANG_ANY     = re.compile(r'[\._-]' + _LANG_TOKENS + r'(?:[_\-](\d+))?', re.I)
+_RE_LANG_SPLIT   = re.compile(r'[-_ ]+')
+_RE_ZH_LANG_TAIL = re.compile(r'[\._-](zh[-_ ]?(?:cn|tw))(?:[_\-]\d+)?$', re.I)
+_RE_SXXEXX       = re.compile(r'[Ss](\d{1,2})[Ee](\d{1,3})')
+_RE_EP_BRACKET   = re.compile(r'[\[\(]\s*(\d{1,3})(?:v\d)?\s*[\]\)]')          # [03] / [03v2]
+_RE_EP_BARE      = re.compile(r'[\s\-_](\d{1,3})(?:v\d)?(?=[\s\-_\.])')
+_RE_EP_PREFIX    = re.compile(r'\b(?:EP|Ep|ep|E)(\d{1,3})(?:v\d)?\b')
+_RE_EP_ZH        = re.compile(r'第([零〇一二两三四五六七八九十\d]{1,3})\s*(?:話|话|集)')
+_RE_YEAR_PAREN   = re.compile(r'\((19|20)\d{2}\)')
+_RE_YEAR_BARE    = re.compile(r'\b(19|20)\d{2}\b')
+_RE_TITLE_SPLIT  = [re.compile(p) for p in (
+    r'[Ss]\d{1,2}[Ee]\d{1,3}', r'[\[\(]\s*\d{1,3}\s*[\]\)]',
+    r'\b(?:EP|Ep|ep|E)\d{1,3}\b', r'第[零〇一二两三四五六七八九十\d]{1,3}\s*(?:話|话|集)')]
+_ZH_NUM = {'零':0,'〇':0,'一':1,'二':2,'两':2,'三':3,'四':4,'五':5,'六':6,'七':7,'八':8,'九':9,'十':10}
+_LANG_SHORT = {'ja':'ja','jp':'ja','en':'en','eng':'en','ko':'ko','kor':'ko'}
+
 def safe_folder(name: str) -> str:
-    return re.sub(r'[/\\:*?"<>|]', '_', name).strip()
+    return _RE_UNSAFE.sub('_', name).strip()
 
-def clean_tokens(s: str) -> str:
+def clean_tokens(s: str, tech: Optional[List[str]] = None) -> str:
     s = str(Path(s).with_suffix(''))
-    # 去掉常见技术标签
-    s = re.sub(r'\[(?:1080p|2160p|720p|x26[45]|HEVC|AVC|WEB[- ]?DL|BluRay|FLAC|AAC|HDR|DV|Ma10p_[^\]]+)\]', '', s, flags=re.I)
-    s = re.sub(r'\b(1080p|2160p|720p|x26[45]|HEVC|AVC|WEB[- ]?DL|BluRay|FLAC|AAC|HDR|DV)\b', '', s, flags=re.I)
-    s = re.sub(r'[ _\-]{2,}', ' ', s).strip(' -_')
+    # 去掉常见技术标签（传入 tech 列表时顺便收集被去掉的标签）
+    if tech is None:
+        s = _RE_TECH_BRACKET.sub('', s)
+        s = _RE_TECH_WORD.sub('', s)
+    else:
+        def _take(m):
+            tech.append(m.group(0).strip('[]')); return ''
+        s = _RE_TECH_BRACKET.sub(_take, s)
+        s = _RE_TECH_WORD.sub(_take, s)
+    s = _RE_SEPS.sub(' ', s).strip(' -_')
     return s
 
 def strip_all_brackets(s: str) -> str:
     # 删除任意位置的 [xxx] 模块（给 extras 提取系列名时用）
-    return re.sub(r'\s*\[[^\[\]]+\]\s*', ' ', s).strip()
+    return _RE_ANY_BRACKET.sub(' ', s).strip()
 
 def normalize_lang(name: str) -> Optional[str]:
     lower = name.lower()
     # 允许末尾形式： .jpsc.ass / .jptc.ass / .sc.ass / .zh-cn.srt / ... 也允许文件名中部的连接符
     # 捕获 token 和可选的编号，比如 -2： *.zh-cn-2.ass
-    m = re.search(r'[\._-]((?:zh[-_ ]?(?:cn|tw)|chs|cht|sc|tc|zhs|zht|gb|cn|tw|ja|jp|en|eng|ko|kor|jpsc|jptc))(?:[-_](\d+))?(?=\.(ass|srt|vtt|ssa|sup)\b)', lower, flags=re.I)
+    m = _RE_LANG_SUFFIX.search(lower)
     if not m:
         # 兼容旧规则（在名字中任何位置出现语言码）
-        m = re.search(r'[\._-]((?:zh[-_ ]?(?:cn|tw)|chs|cht|sc|tc|zhs|zht|gb|cn|tw|ja|jp|en|eng|ko|kor|jpsc|jptc))(?:[_\-](\d+))?', lower, flags=re.I)
+        m = _RE_LANG_ANY.search(lower)
         if not m:
             return None
 
@@ -66,80 +103,253 @@ def normalize_lang(name: str) -> Optional[str]:
     norm = LANG_ALIASES.get(raw)
     if not norm and raw.startswith('zh'):
         # 规范化 zh-cn/zh-tw 大小写
-        parts = re.split(r'[-_ ]+', raw)
+        parts = _RE_LANG_SPLIT.split(raw)
         if len(parts) == 2 and parts[0] == 'zh' and parts[1] in ('cn','tw'):
             norm = f"zh-{parts[1].upper()}"
-    if not norm and raw in ('ja','jp','en','eng','ko','kor'):
-        norm = {'ja':'ja','jp':'ja','en':'en','eng':'en','ko':'ko','kor':'ko'}[raw]
+    if not norm and raw in _LANG_SHORT:
+        norm = _LANG_SHORT[raw]
 
     return f"{norm}_{idx}" if (norm and idx) else norm
 
-def apply_lang(final_name: str, src_name: str) -> str:
-    lang = normalize_lang(src_name) or normalize_lang(final_name)
+def apply_lang(final_name: str, src_name: str, lang: Optional[str] = None) -> str:
+    # lang 已由解析器算好时直接传入，避免重复 normalize_lang
+    lang = lang or normalize_lang(src_name) or normalize_lang(final_name)
     if not lang: return final_name
     stem = str(Path(final_name).with_suffix(''))
     ext  = Path(final_name).suffix
-    stem = re.sub(r'[\._-](zh[-_ ]?(?:cn|tw))(?:[_\-]\d+)?$', '', stem, flags=re.I)
+    stem = _RE_ZH_LANG_TAIL.sub('', stem)
     return f"{stem}.{lang}{ext}"
 
 def parse_group_from_prefix(raw: str) -> Optional[str]:
-    m = re.match(r'\s*\[([^\[\]]+)\]\s*', raw)
+    m = _RE_GROUP.match(raw)
     return f"[{m.group(1).strip()}]" if m else None
 
-def extract_season_ep(s: str) -> Tuple[Optional[int], int]:
-    m = re.search(r'[Ss](\d{1,2})[Ee](\d{1,3})', s)
+def _zh2num(t: str) -> int:
+    if t.isdigit(): return int(t)
+    if len(t)==1: return _ZH_NUM.get(t,0)
+    if '十' in t:
+        L,_,R = t.partition('十')
+        l = _ZH_NUM.get(L,1) if L else 1
+        r = _ZH_NUM.get(R,0) if R else 0
+        return l*10+r
+    return 0
+
+def find_season_ep(s: str) -> Tuple[Optional[int], Optional[int]]:
+    m = _RE_SXXEXX.search(s)
     if m: return int(m.group(1)), int(m.group(2))
-    m = re.search(r'[\[\(]\s*(\d{1,3})\s*[\]\)]', s) or re.search(r'[\s\-_](\d{1,3})(?=[\s\-_\.])', s)
+    m = _RE_EP_BRACKET.search(s) or _RE_EP_BARE.search(s)
     if m: return None, int(m.group(1))
-    m = re.search(r'\b(?:EP|Ep|ep|E)(\d{1,3})\b', s)
+    m = _RE_EP_PREFIX.search(s)
     if m: return None, int(m.group(1))
-    zh_map = {'零':0,'〇':0,'一':1,'二':2,'两':2,'三':3,'四':4,'五':5,'六':6,'七':7,'八':8,'九':9,'十':10}
-    def zh2num(t):
-        if t.isdigit(): return int(t)
-        if len(t)==1: return zh_map.get(t,0)
-        if '十' in t:
-            L,_,R = t.partition('十')
-            l = zh_map.get(L,1) if L else 1
-            r = zh_map.get(R,0) if R else 0
-            return l*10+r
-        return 0
-    m = re.search(r'第([零〇一二两三四五六七八九十\d]{1,3})\s*(?:話|话|集)', s)
-    if m: return None, zh2num(m.group(1))
-    return None, 1
+    m = _RE_EP_ZH.search(s)
+    if m: return None, _zh2num(m.group(1))
+    return None, None
+
+def extract_season_ep(s: str) -> Tuple[Optional[int], int]:
+    # 文件名里没有集数时按第 1 集
+    season, ep = find_season_ep(s)
+    return season, (1 if ep is None else ep)
 
 def extract_year(s: str) -> Optional[str]:
-    m = re.search(r'\((19|20)\d{2}\)', s)
+    m = _RE_YEAR_PAREN.search(s)
     if m: return m.group(0).strip('()')
-    m = re.search(r'\b(19|20)\d{2}\b', s)
+    m = _RE_YEAR_BARE.search(s)
     if m: return m.group(0)
     return None
 
+UNKNOWN_TITLE = "Unknown"   # 文件名里解析不出标题时的占位
+
 def extract_title(s: str, forced: Optional[str]) -> str:
     if forced: return forced
-    s2 = re.sub(r'^\s*\[[^\[\]]+\]\s*', '', s).strip()
+    s2 = _RE_LEAD_BRACKET.sub('', s).strip()
     split_pos = None
-    for pat in [r'[Ss]\d{1,2}[Ee]\d{1,3}', r'[\[\(]\s*\d{1,3}\s*[\]\)]',
-                r'\b(?:EP|Ep|ep|E)\d{1,3}\b', r'第[零〇一二两三四五六七八九十\d]{1,3}\s*(?:話|话|集)']:
-        m = re.search(pat, s2)
+    for pat in _RE_TITLE_SPLIT:
+        m = pat.search(s2)
         if m: split_pos = m.start(); break
     title = s2[:split_pos] if split_pos not in (None, 0) else s2
     # 仅去掉**末尾**的 [xxx]
-    title = re.sub(r'\s*\[[^\[\]]+\]\s*$', '', title).strip()
-    title = re.sub(r'[ _\-]{2,}', ' ', title).strip(' -_')
-    return title or "Unknown"
+    title = _RE_TAIL_BRACKET.sub('', title).strip()
+    title = _RE_SEPS.sub(' ', title).strip(' -_')
+    return title or UNKNOWN_TITLE
+
+# ---------- name parser ----------
+
+class ParsedName(NamedTuple):
+    group: Optional[str]          # 开头的 [字幕组]
+    title: str                    # 未被 --title 覆盖时的系列名
+    year: Optional[str]
+    season: Optional[int]         # 文件名里没有 SxxExx 时为 None
+    ep: int
+    lang: Optional[str]           # 字幕语言（仅主文件）
+    tech: Tuple[str, ...]         # 被 clean_tokens 去掉的技术标签
+    ep_found: bool                # False：文件名里没有集数，ep 只是默认的 1
+
+PARSER_CACHE_MAX = 200_000  # 解析缓存每张表最多的条数；满了先丢最早的（--serve/--watch 常驻时不会一直增长）
+
+class NameParser:
+    """
+    文件名 -> ParsedName。清洗只做一次，主文件与 extras 各自按文件名缓存（有上限），
+    stage1_confirm 反复重建计划时不会再次解析同一个名字。
+    """
+    def __init__(self):
+        self._main: Dict[str, ParsedName] = {}
+        self._extra: Dict[str, ParsedName] = {}
+
+    def parse(self, name: str) -> ParsedName:
+        rec = self._main.get(name)
+        if rec is None:
+            if len(self._main) >= PARSER_CACHE_MAX: del self._main[next(iter(self._main))]
+            if not STATS.enabled:
+                rec = self._main[name] = self._parse(name, extra=False)
+            else:
+                with STATS.phase("parse"):
+                    rec = self._main[name] = self._parse(name, extra=False)
+        return rec
+
+    def parse_extra(self, name: str) -> ParsedName:
+        rec = self._extra.get(name)
+        if rec is None:
+            if len(self._extra) >= PARSER_CACHE_MAX: del self._extra[next(iter(self._extra))]
+            if not STATS.enabled:
+                rec = self._extra[name] = self._parse(name, extra=True)
+            else:
+                with STATS.phase("parse"):
+                    rec = self._extra[name] = self._parse(name, extra=True)
+        return rec
+
+    def clear(self):
+        self._main.clear(); self._extra.clear()
+
+    @staticmethod
+    def _parse(name: str, extra: bool) -> ParsedName:
+        tech: List[str] = []
+        base = clean_tokens(name, tech)
+        if extra:
+            # extras：系列名更激进，移除所有 [xxx]
+            base = strip_all_brackets(base)
+        season, ep = find_season_ep(base)
+        return ParsedName(
+            group=parse_group_from_prefix(name),
+            title=extract_title(base, None),
+            year=extract_year(base),
+            season=season, ep=1 if ep is None else ep,
+            lang=None if extra else normalize_lang(name),
+            tech=tuple(tech),
+            ep_found=ep is not None,
+        )
+
+PARSER = NameParser()
+
+_TERM_W_CACHE: List[float] = [0.0, 0]     # [取值时间, 宽度]：1 秒内复用，窗口缩放后仍会更新
 
 def term_width(default: int = 88) -> int:
+    now = time.monotonic()
+    if now - _TERM_W_CACHE[0] < 1.0:
+        return int(_TERM_W_CACHE[1])
     try:
         cols = get_terminal_size((default, 20)).columns
-        return max(60, min(cols, 160))
+        w = max(60, min(cols, 160))
     except Exception:
-        return default
+        w = default
+    _TERM_W_CACHE[0], _TERM_W_CACHE[1] = now, w
+    return w
 
 def wrap_line(line: str, width: Optional[int] = None, indent: int = 2) -> str:
     if width is None: width = term_width()
+    # 放得下的行（绝大多数）不走 textwrap；含制表/换行/行尾空白的交给 textwrap 保持原有输出
+    if len(line) <= width and not line.endswith(' ') and '\t' not in line and '\n' not in line:
+        return line
     return textwrap.fill(line, width=width, subsequent_indent=' ' * indent,
                          break_long_words=False, break_on_hyphens=False)
 
+def write_lines(lines: Iterable[str], out=None, chunk: int = 512):
+    """把逐行生成的输出攒成块再写，避免每行一次 print/flush。"""
+    out = out or sys.stdout
+    buf: List[str] = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= chunk:
+            out.write("\n".join(buf) + "\n"); buf.clear()
+    if buf:
+        out.write("\n".join(buf) + "\n")
+    out.flush()
+
+# ---------- stats ----------
+
+class Stats:
+    """
+    --stats：各阶段的墙钟耗时与文件系统调用计数。默认关闭，关闭时 phase()/count() 直接返回。
+    阶段可以嵌套（parse 计入 plan），同名阶段累加；计数在并行执行时加锁。
+    """
+    PHASES = ("scan", "verify", "plan", "parse", "probe", "sort", "merge", "dedupe", "library", "resolve", "render", "execute")
+
+    def __init__(self):
+        self.enabled = False
+        self.phases: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1):
+        if not self.enabled: return
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield; return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + dt
+
+    def report(self) -> Iterator[str]:
+        yield "\n--- Stats ---"
+        for name in sorted(self.phases, key=lambda p: self.PHASES.index(p) if p in self.PHASES else 99):
+            yield f"  {name:<8} {self.phases[name] * 1000:10.1f} ms" + ("  (part of plan)" if name == "parse" else "")
+        files = {k: v for k, v in self.counts.items() if k.startswith("files_")}
+        calls = {k: v for k, v in self.counts.items() if k not in files}
+        if calls:
+            yield wrap_line("  calls    " + "  ".join(f"{k}={v}" for k, v in sorted(calls.items())), indent=11)
+        if files:
+            line = "  files    " + "  ".join(f"{k[6:]}={v}" for k, v in sorted(files.items()))
+            secs = self.phases.get("execute")
+            if secs: line += f"  ({(files.get('files_ok', 0) + files.get('files_fail', 0)) / secs:.1f}/s)"
+            yield line
+
+    def openmetrics(self) -> Iterator[str]:
+        yield "# HELP aniarr_phase_seconds Wall time spent in each phase."
+        yield "# TYPE aniarr_phase_seconds gauge"
+        for name, secs in sorted(self.phases.items()):
+            yield f'aniarr_phase_seconds{{phase="{name}"}} {secs:.6f}'
+        yield "# HELP aniarr_calls Filesystem calls and collision retries."
+        yield "# TYPE aniarr_calls gauge"
+        for name, n in sorted(self.counts.items()):
+            if not name.startswith("files_"): yield f'aniarr_calls{{op="{name}"}} {n}'
+        yield "# HELP aniarr_files Plan items by outcome."
+        yield "# TYPE aniarr_files gauge"
+        for name, n in sorted(self.counts.items()):
+            if name.startswith("files_"): yield f'aniarr_files{{result="{name[6:]}"}} {n}'
+        yield "# HELP aniarr_last_run_timestamp_seconds Time the stats were written."
+        yield "# TYPE aniarr_last_run_timestamp_seconds gauge"
+        yield f"aniarr_last_run_timestamp_seconds {time.time():.3f}"
+        yield "# EOF"
+
+    def write_textfile(self, path: Path):
+        """写 OpenMetrics 文本（node_exporter textfile collector）；先写临时文件再改名，避免被读到半个文件。"""
+        path = Path(path)
+        tmp = path.with_name(f".{path.name}.tmp")
+        try:
+            tmp.write_text("\n".join(self.openmetrics()) + "\n", encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[WARN] cannot write stats file '{path}': {e}", file=sys.stderr)
+
+STATS = Stats()
+
 def lang_sort_key(lang: Optional[str]) -> int:
     if not lang: return 99
     return {'zh-CN': 0, 'zh-TW': 1}.get(lang.split('_')[0], 50)
@@ -157,6 +367,8 @@ DEFAULT_RULES = [
     {"pattern": r"\bSP\d+\b",      "category": "shorts"}
 ]
 DEFAULT_FALLBACK = "extras"
+DEFAULT_SCAN_DEPTH = 0      # 默认只处理顶层；SPs/SP/extras 目录不受深度限制
+DEFAULT_IGNORE = [".*", "@eaDir", "#recycle", "$RECYCLE.BIN", "Fonts", "*.!qB", "*.part"]
 
 def default_config_path() -> Path:
     try:
@@ -177,7 +389,8 @@ def load_config(path_arg: Optional[str]) -> Dict[str, Any]:
         if p.exists():
             chosen = p
 
-    cfg = {"rules": DEFAULT_RULES, "fallback_category": DEFAULT_FALLBACK, "extras_scope": None, "_config_path": "(built-in)"}
+    cfg = {"rules": DEFAULT_RULES, "fallback_category": DEFAULT_FALLBACK, "extras_scope": None,
+           "scan_depth": DEFAULT_SCAN_DEPTH, "ignore": list(DEFAULT_IGNORE), "_config_path": "(built-in)"}
     if chosen:
         try:
             user = json.loads(chosen.read_text(encoding="utf-8"))
@@ -187,16 +400,157 @@ def load_config(path_arg: Optional[str]) -> Dict[str, Any]:
                 cfg["fallback_category"] = user["fallback_category"]
             if user.get("extras_scope") in ("series", "season"):
                 cfg["extras_scope"] = user["extras_scope"]
+            if isinstance(user.get("scan_depth"), int) and user["scan_depth"] >= 0:
+                cfg["scan_depth"] = user["scan_depth"]
+            if isinstance(user.get("ignore"), list):
+                cfg["ignore"] = [str(g) for g in user["ignore"]]
+            if user.get("state_db"):
+                cfg["state_db"] = str(user["state_db"])
+            if user.get("alias_db"):
+                cfg["alias_db"] = str(user["alias_db"])
+            if isinstance(user.get("alias_fuzzy"), bool):
+                cfg["alias_fuzzy"] = user["alias_fuzzy"]
+            if isinstance(user.get("jellyfin"), dict):
+                cfg["jellyfin"] = user["jellyfin"]
+            if isinstance(user.get("skip_existing"), bool):
+                cfg["skip_existing"] = user["skip_existing"]
+            if isinstance(user.get("max_memory"), (str, int)):
+                cfg["max_memory"] = user["max_memory"]
+            if isinstance(user.get("probe"), bool):
+                cfg["probe"] = user["probe"]
+            if isinstance(user.get("dedupe"), bool):
+                cfg["dedupe"] = user["dedupe"]
+            if isinstance(user.get("dedupe_prefer"), (list, str)):
+                cfg["dedupe_prefer"] = parse_prefer(user["dedupe_prefer"])
             cfg["_config_path"] = str(chosen)
         except Exception as e:
             print(f"[WARN] Failed to parse config '{chosen}': {e}. Using defaults.")
+    cfg["rule_set"] = compile_rules(cfg["rules"])
     return cfg
 
 def validate_category(cat: str) -> str:
     return cat if cat in JF_CATEGORIES else "extras"
 
+# ---------- extras rules ----------
+
+try:
+    import re._parser as _sre_parse          # 3.11+
+except ImportError:                          # pragma: no cover
+    import sre_parse as _sre_parse
+
+_REPEAT_OPS = ('MAX_REPEAT', 'MIN_REPEAT')
+
+def _nested_unbounded_repeat(sub, inside: bool = False) -> bool:
+    r"""(a+)+ / (\w*\s*)* 这类嵌套的无上限重复，在不匹配时会指数级回溯。"""
+    for op, av in sub:
+        name = str(op)
+        if name in _REPEAT_OPS:
+            lo, hi, inner = av
+            unbounded = hi == _sre_parse.MAXREPEAT
+            if unbounded and inside:
+                return True
+            if _nested_unbounded_repeat(inner, inside or unbounded):
+                return True
+        elif name == 'SUBPATTERN':
+            if _nested_unbounded_repeat(av[-1], inside): return True
+        elif name == 'BRANCH':
+            if any(_nested_unbounded_repeat(b, inside) for b in av[1]): return True
+        elif name in ('ASSERT', 'ASSERT_NOT'):
+            if _nested_unbounded_repeat(av[1], inside): return True
+    return False
+
+def _has_groupref(sub) -> bool:
+    for op, av in sub:
+        name = str(op)
+        if name in ('GROUPREF', 'GROUPREF_EXISTS'):
+            return True
+        if name in _REPEAT_OPS and _has_groupref(av[2]): return True
+        if name == 'SUBPATTERN' and _has_groupref(av[-1]): return True
+        if name == 'BRANCH' and any(_has_groupref(b) for b in av[1]): return True
+        if name in ('ASSERT', 'ASSERT_NOT') and _has_groupref(av[1]): return True
+    return False
+
+class RuleSet:
+    """
+    extras 规则在 load_config 时编译：
+    - matches(s)：所有规则合成一个 (?:r0)|(?:r1)|... ，一次 search 判断是否命中任一规则；
+    - category(s)：^(?:(?=.*?(?P<_r0>r0))|(?=.*?(?P<_r1>r1))|...)，按规则顺序取首条命中，
+      通过 lastgroup 直接映射到分类。
+    带反向引用/命名分组/全局内联标志、无法拼接的规则单独编译，此时 category() 退回逐条匹配。
+    """
+    def __init__(self, rules: List[Dict[str, Any]], warn: bool = True):
+        self.rules: List[Tuple[Any, str]] = []      # (compiled, category)，保持配置顺序
+        self._standalone = False
+        for i, rule in enumerate(rules):
+            pat = rule.get("pattern") if isinstance(rule, dict) else None
+            if not pat:
+                continue
+            try:
+                compiled = re.compile(pat, re.I)
+                parsed = _sre_parse.parse(pat, re.I)
+            except (re.error, TypeError) as e:
+                if warn: print(f"[WARN] Rule #{i + 1} {pat!r} rejected: {e}")
+                continue
+            if _nested_unbounded_repeat(parsed):
+                if warn: print(f"[WARN] Rule #{i + 1} {pat!r} rejected: nested unbounded repeat (catastrophic backtracking)")
+                continue
+            if compiled.groupindex or _has_groupref(parsed):
+                self._standalone = True
+            else:
+                try:
+                    re.compile(f'x|(?:{pat})', re.I)
+                except re.error:
+                    self._standalone = True
+            self.rules.append((compiled, validate_category(str(rule.get("category", "")))))
+
+        self._any = self._first = None
+        if self.rules and not self._standalone:
+            pats = [c.pattern for c, _ in self.rules]
+            self._any = re.compile('|'.join(f'(?:{p})' for p in pats), re.I)
+            self._first = re.compile(
+                '^(?:' + '|'.join(f'(?=[\\s\\S]*?(?P<_r{i}>{p}))' for i, p in enumerate(pats)) + ')', re.I)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def matches(self, s: str) -> bool:
+        if self._any is not None:
+            return self._any.search(s) is not None
+        return any(c.search(s) for c, _ in self.rules)
+
+    def category(self, s: str) -> Optional[str]:
+        if self._first is not None:
+            m = self._first.match(s)
+            return self.rules[int(m.lastgroup[2:])][1] if m else None
+        for c, cat in self.rules:
+            if c.search(s):
+                return cat
+        return None
+
+def compile_rules(rules, warn: bool = True) -> RuleSet:
+    return rules if isinstance(rules, RuleSet) else RuleSet(rules, warn=warn)
+
 # ---------- extra classifier ----------
 
+# 技术标签黑名单（可按需扩充）
+_RE_EXTRA_TECH = re.compile(
+    r'^(?:'
+    r'Ma\d+p_[^ ]+|'
+    r'(?:x|h)26[45].*|'
+    r'hevc|avc|h264|h265|'
+    r'(?:10|8)bit|'
+    r'web[- ]?dl|blu[- ]?ray|bdrip|remux|source|'
+    r'1080p|2160p|720p|4k|hdr|dv|'
+    r'flac|aac|opus|mp3|'
+    r'fonts?'
+    r')$',
+    re.IGNORECASE
+)
+_RE_BRACKET_PARTS = re.compile(r'\[([^\[\]]+)\]')
+_RE_GROUPISH      = re.compile(r'(sub|vcb|group|studio|rip|encode)', re.I)
+_RE_BRACKET_BLOCK = re.compile(r'\[[^\[\]]+\]')
+_RE_SPACES        = re.compile(r'\s+')
+
 # ===== 替换原函数：从文件名中猜测 fallback token（取第一个有效的 []） =====
 def guess_extra_token_from_name(name: str) -> str:
     """
@@ -206,247 +560,2158 @@ def guess_extra_token_from_name(name: str) -> str:
     stem = str(Path(name).with_suffix(''))
 
     # 抓出所有 [ ... ] 段
-    bracket_parts = re.findall(r'\[([^\[\]]+)\]', stem)
-
-    # 技术标签黑名单（可按需扩充）
-    tech_pat = re.compile(
-        r'^(?:'
-        r'Ma\d+p_[^ ]+|'
-        r'(?:x|h)26[45].*|'
-        r'hevc|avc|h264|h265|'
-        r'(?:10|8)bit|'
-        r'web[- ]?dl|blu[- ]?ray|bdrip|remux|source|'
-        r'1080p|2160p|720p|4k|hdr|dv|'
-        r'flac|aac|opus|mp3|'
-        r'fonts?'
-        r')$',
-        re.IGNORECASE
-    )
+    bracket_parts = _RE_BRACKET_PARTS.findall(stem)
 
     # 第一个有效候选：跳过第一个看起来是“字幕组/作者”的块 & 技术块
     for idx, part in enumerate(bracket_parts):
         p = part.strip()
         # 开头的 [XxxSub]/[VCB-Studio] 等视为“字幕组”
-        if idx == 0 and re.search(r'(sub|vcb|group|studio|rip|encode)', p, flags=re.I):
+        if idx == 0 and _RE_GROUPISH.search(p):
             continue
-        if tech_pat.match(p):
+        if _RE_EXTRA_TECH.match(p):
             continue
         # 命中第一个有效 bracket，直接用它
         return p
 
     # 没有 [] 候选：退而求其次，用去技术标签后的 stem
-    cleaned = re.sub(r'\[[^\[\]]+\]', ' ', stem)
-    cleaned = re.sub(r'\s+', ' ', cleaned).strip()
+    cleaned = _RE_BRACKET_BLOCK.sub(' ', stem)
+    cleaned = _RE_SPACES.sub(' ', cleaned).strip()
     return cleaned or "EXTRA"
 
 # === 替换：分类器先取 token，再用 token 匹配规则；重命名始终用 token ===
-def classify_extra(name: str, rules: List[Dict[str, Any]], fallback: str) -> Tuple[str, str]:
+def classify_extra(name: str, rules, fallback: str) -> Tuple[str, str]:
     """
     返回 (category, token)。token 总是 guess 自文件名；
-    category 用 token 去匹配 rules，首条命中即用其 category，否则 fallback。
+    category 用 token 去匹配 rules（RuleSet 或原始规则列表），首条命中即用其 category，否则 fallback。
     """
     token = guess_extra_token_from_name(name)
-    for rule in rules:
-        pat = rule.get("pattern")
-        if not pat:
-            continue
-        if re.search(pat, token, flags=re.I):
-            # 只取分类，不再用规则来改 token（保持 token = guess）
-            cat = validate_category(str(rule.get("category", "")))
-            return cat, token
-    return validate_category(fallback), token
+    # 只取分类，不再用规则来改 token（保持 token = guess）
+    cat = compile_rules(rules, warn=False).category(token)
+    return (cat or validate_category(fallback)), token
+
+# ---------- scanner ----------
+
+EXTRAS_DIRS = ('sps', 'sp', 'extras')
+
+class ScanEntry(NamedTuple):
+    path: str          # 完整路径（os.DirEntry.path）
+    name: str
+    rel: str           # 相对 src_dir 的路径，用于 skipped 列表
+    depth: int         # 0 = src_dir 下的直接条目
+    kind: str          # 'file' | 'dir'（未进入的目录）| 'other'
+    extras: bool       # 位于 sps/sp/extras 目录内
+    entry: Any         # 原始 os.DirEntry，后续需要 stat()/inode() 时复用其缓存；单独构造时为 None
+
+def compile_ignore(globs: Optional[Sequence[str]]):
+    if not globs: return None
+    return re.compile('|'.join(f'(?:{fnmatch.translate(g)})' for g in globs))
+
+def scan_tree(root: Path, max_depth: int = DEFAULT_SCAN_DEPTH, ignore: Optional[Sequence[str]] = None,
+              extras_on: bool = True, exclude: Iterable[Path] = ()) -> Iterator[ScanEntry]:
+    """
+    基于 os.scandir 的惰性递归遍历：类型判断直接用 DirEntry 的 d_type（除符号链接外不额外 stat），
+    每个目录只列一次。目录内按名字（忽略大小写）排序后深度优先产出。
+    超过 max_depth、名字命中 ignore 的目录不会进入（extras 目录开启时总会进入）；前者和 exclude
+    （例如位于 source 内的 destination）作为 kind='dir' 产出，供调用方记录到 skipped。
+    """
+    ignore_re = compile_ignore(ignore)
+    excluded = {os.path.abspath(p) for p in exclude}
+
+    def walk(dir_path: str, rel_prefix: str, depth: int, in_extras: bool) -> Iterator[ScanEntry]:
+        STATS.count("scandir")
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name.lower())
+        except OSError:
+            return
+        for e in entries:
+            name = e.name
+            if ignore_re is not None and ignore_re.match(name):
+                continue
+            rel = rel_prefix + name
+            try:
+                is_dir = e.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                extras_dir = name.lower() in EXTRAS_DIRS
+                if ((depth >= max_depth and not (extras_dir and extras_on)) or (extras_dir and not extras_on)
+                        or os.path.abspath(e.path) in excluded):
+                    yield ScanEntry(e.path, name, rel, depth, 'dir', in_extras, e)
+                else:
+                    # 允许用户把 extras 放一个子目录里（例如 SPs/extras），该目录下的视频都当作 extras
+                    yield from walk(e.path, rel + os.sep, depth + 1, in_extras or extras_dir)
+                continue
+            try:
+                kind = 'file' if e.is_file() else 'other'
+            except OSError:
+                kind = 'other'
+            yield ScanEntry(e.path, name, rel, depth, kind, in_extras, e)
+
+    yield from walk(str(root), '', 0, False)
+
+# ---------- state db ----------
+
+FileKey = Tuple[int, int, int, int]   # (st_dev, st_ino, st_size, st_mtime_ns)
+
+class StateDB:
+    """
+    可选的 SQLite 增量状态库。每个源文件以 (dev, ino, size, mtime_ns) + 目标根目录为键，
+    记录解析出的字段、计划目标以及是否已执行；build_plan 会跳过未变化且已执行的文件。
+    目标根目录按 realpath 归一化（"dst" 与 "/abs/dst" 是同一行），src/dst 列记绝对路径。
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+        dst_root TEXT NOT NULL,
+        src TEXT, dst TEXT, kind TEXT, series_dir TEXT, title TEXT, year TEXT,
+        season INTEGER, ep INTEGER, lang TEXT,
+        done INTEGER NOT NULL DEFAULT 0, updated REAL,
+        PRIMARY KEY (dev, ino, size, mtime_ns, dst_root)
+    );
+    CREATE TABLE IF NOT EXISTS hashes (
+        dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+        sample TEXT, full TEXT,
+        PRIMARY KEY (dev, ino)
+    );
+    CREATE TABLE IF NOT EXISTS probes (
+        dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+        duration REAL, tracks INTEGER,
+        PRIMARY KEY (dev, ino)
+    );
+    CREATE TABLE IF NOT EXISTS lib_dirs (
+        root TEXT NOT NULL, dir TEXT NOT NULL, mtime_ns INTEGER NOT NULL, dev INTEGER NOT NULL, subdirs TEXT,
+        PRIMARY KEY (root, dir)
+    );
+    CREATE TABLE IF NOT EXISTS lib_files (
+        root TEXT NOT NULL, dir TEXT NOT NULL, name TEXT NOT NULL, ino INTEGER NOT NULL,
+        PRIMARY KEY (root, dir, name)
+    );
+    """
+    COMMIT_EVERY = 500
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.keys: Dict[str, FileKey] = {}          # 本次扫描：src 路径 -> FileKey
+        self._done: Dict[str, set] = {}              # dst_root -> 已执行 FileKey 集合（按需一次性加载）
+        self._roots: Dict[str, str] = {}             # 传入的目标根目录 -> realpath
+        self._pending = 0
+
+    def root_of(self, dst_root) -> str:
+        p = str(dst_root)
+        root = self._roots.get(p)
+        if root is None: root = self._roots[p] = os.path.realpath(p)
+        return root
+
+    @staticmethod
+    def key_of(st: os.stat_result) -> FileKey:
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def identify(self, e: "ScanEntry") -> Optional[FileKey]:
+        try:
+            STATS.count("stat")
+            key = self.key_of(e.entry.stat() if e.entry is not None else os.stat(e.path))
+        except OSError:
+            return None
+        self.keys[e.path] = key
+        return key
+
+    def done_keys(self, dst_root: Path) -> set:
+        root = self.root_of(dst_root)
+        if root not in self._done:
+            rows = self.conn.execute(
+                "SELECT dev, ino, size, mtime_ns FROM files WHERE dst_root=? AND done=1", (root,))
+            self._done[root] = {tuple(r) for r in rows}
+        return self._done[root]
+
+    def done_lookup(self, dst_root: Path) -> "DoneLookup":
+        """done_keys 的有界内存版本（--max-memory）：按主键逐个查询，不把整张表读进内存。"""
+        return DoneLookup(self.conn, self.root_of(dst_root))
+
+    def record_plan(self, items: List["PlanItem"], dst_root: Path):
+        root, now = self.root_of(dst_root), time.time()
+        rows = []
+        for it in items:
+            key = self.keys.get(str(it.src))
+            if key is None: continue
+            rows.append((*key, root, os.path.abspath(it.src), os.path.abspath(it.dst), it.kind, it.series_dir, it.title, it.year,
+                         it.season, it.ep, it.lang, now))
+        self.conn.executemany(
+            "INSERT INTO files (dev, ino, size, mtime_ns, dst_root, src, dst, kind, series_dir, title, year,"
+            " season, ep, lang, done, updated) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,0,?)"
+            " ON CONFLICT (dev, ino, size, mtime_ns, dst_root) DO UPDATE SET"
+            " src=excluded.src, dst=excluded.dst, kind=excluded.kind, series_dir=excluded.series_dir,"
+            " title=excluded.title, year=excluded.year, season=excluded.season, ep=excluded.ep,"
+            " lang=excluded.lang, updated=excluded.updated",
+            rows)
+        self.conn.commit()
+
+    def mark_done(self, src: Path, final: Path, dst_root: Path):
+        key = self.keys.get(str(src))
+        if key is None: return
+        self.conn.execute(
+            "UPDATE files SET done=1, dst=?, updated=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND dst_root=?",
+            (os.path.abspath(final), time.time(), *key, self.root_of(dst_root)))
+        done = self._done.get(self.root_of(dst_root))
+        if done is not None: done.add(key)             # 只更新已加载的集合，不为此加载整张表
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self.conn.commit(); self._pending = 0
+
+    def get_hash(self, st: os.stat_result) -> Optional[Tuple[int, int, Optional[str], Optional[str]]]:
+        """去重用的哈希缓存；size/mtime 变了视为失效。"""
+        row = self.conn.execute("SELECT size, mtime_ns, sample, full FROM hashes WHERE dev=? AND ino=?",
+                                (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns: return tuple(row)
+        return None
+
+    def put_hash(self, st: os.stat_result, sample: Optional[str], full: Optional[str]):
+        self.conn.execute(
+            "INSERT INTO hashes (dev, ino, size, mtime_ns, sample, full) VALUES (?,?,?,?,?,?)"
+            " ON CONFLICT (dev, ino) DO UPDATE SET size=excluded.size, mtime_ns=excluded.mtime_ns,"
+            " sample=excluded.sample, full=excluded.full",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, sample, full))
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self.conn.commit(); self._pending = 0
+
+    def get_probe(self, st: os.stat_result) -> Optional[Tuple[Optional[float], Optional[int]]]:
+        """容器探测结果缓存，同 get_hash 按 size/mtime 校验。"""
+        row = self.conn.execute("SELECT size, mtime_ns, duration, tracks FROM probes WHERE dev=? AND ino=?",
+                                (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns: return row[2], row[3]
+        return None
+
+    def put_probe(self, st: os.stat_result, duration: Optional[float], tracks: Optional[int]):
+        self.conn.execute(
+            "INSERT INTO probes (dev, ino, size, mtime_ns, duration, tracks) VALUES (?,?,?,?,?,?)"
+            " ON CONFLICT (dev, ino) DO UPDATE SET size=excluded.size, mtime_ns=excluded.mtime_ns,"
+            " duration=excluded.duration, tracks=excluded.tracks",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, duration, tracks))
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self.conn.commit(); self._pending = 0
+
+    def load_library(self, root: str) -> Dict[str, Tuple[int, int, List[Tuple[str, int]], List[str]]]:
+        """LibraryIndex 的持久化目录列表：相对目录 -> (mtime_ns, dev, [(文件名, inode)], [子目录])。"""
+        out = {d: (mt, dev, [], json.loads(sub or "[]")) for d, mt, dev, sub in self.conn.execute(
+            "SELECT dir, mtime_ns, dev, subdirs FROM lib_dirs WHERE root=?", (self.root_of(root),))}
+        for d, name, ino in self.conn.execute("SELECT dir, name, ino FROM lib_files WHERE root=?", (self.root_of(root),)):
+            if d in out: out[d][2].append((name, ino))
+        return out
+
+    def save_library(self, root: str, changed: Dict[str, Tuple[int, int, List[Tuple[str, int]], List[str]]],
+                     gone: Iterable[str]):
+        root = self.root_of(root)
+        for d in list(changed) + list(gone):
+            self.conn.execute("DELETE FROM lib_dirs WHERE root=? AND dir=?", (root, d))
+            self.conn.execute("DELETE FROM lib_files WHERE root=? AND dir=?", (root, d))
+        self.conn.executemany("INSERT INTO lib_dirs (root, dir, mtime_ns, dev, subdirs) VALUES (?,?,?,?,?)",
+                              [(root, d, mt, dev, json.dumps(sub)) for d, (mt, dev, _f, sub) in changed.items()])
+        self.conn.executemany("INSERT INTO lib_files (root, dir, name, ino) VALUES (?,?,?,?)",
+                              [(root, d, name, ino) for d, row in changed.items() for name, ino in row[2]])
+        self.conn.commit()
+
+    def flush(self):
+        self.conn.commit(); self._pending = 0
+
+    def close(self):
+        self.flush(); self.conn.close()
+
+class DoneLookup:
+    """`key in lookup`：该源文件（FileKey）是否已执行到这个目标根目录。查询走 files 表主键。"""
+    def __init__(self, conn: sqlite3.Connection, root: str):
+        self.conn, self.root = conn, root
+
+    def __contains__(self, key) -> bool:
+        if key is None: return False
+        return self.conn.execute(
+            "SELECT 1 FROM files WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND dst_root=? AND done=1",
+            (*key, self.root)).fetchone() is not None
+
+def open_state(path_arg: Optional[str], cfg: Dict[str, Any]) -> Optional[StateDB]:
+    path = path_arg or cfg.get("state_db")
+    if not path: return None
+    try:
+        return StateDB(Path(path).expanduser())
+    except (OSError, sqlite3.Error) as e:
+        print(f"[WARN] Cannot open state db '{path}': {e}. Continuing without it.")
+        return None
+
+# ---------- destination index ----------
+
+def numbered(dst: Path, i: int) -> Path:
+    # 冲突时的编号名：始终基于原始 stem（x_1, x_2 …，不会叠成 x_1_2）
+    return dst.with_stem(f"{dst.stem}_{i}")
+
+def numbered_name(name: str, i: int) -> str:
+    # 同 numbered，只处理文件名字符串
+    stem, ext = os.path.splitext(name)
+    return f"{stem}_{i}{ext}"
+
+class DestIndex:
+    """
+    目标目录的文件名索引：每个目录只 listdir 一次（不存在的目录视为空），
+    规划时据此解决重名，包括同一计划内多个条目落到同一名字的情况。
+    """
+    def __init__(self):
+        self._dirs: Dict[str, set] = {}        # 磁盘上已有的名字（每个目录只读一次）
+        self._claimed: Dict[str, set] = {}     # 本次规划已占用的名字
+
+    def names(self, d) -> set:
+        key = str(d)
+        s = self._dirs.get(key)
+        if s is None:
+            STATS.count("listdir")
+            try:
+                s = set(os.listdir(key))
+            except OSError:
+                s = set()
+            self._dirs[key] = s
+        return s
+
+    def claim(self, dst: Path) -> Path:
+        """占用 dst（已被占用时改用第一个空闲的编号名），返回实际名字。"""
+        return dst.with_name(self.claim_name(str(dst.parent), dst.name))
+
+    def claim_name(self, d: str, name: str) -> str:
+        names = self.names(d)
+        claimed = self._claimed.setdefault(d, set())
+        final = name; i = 1
+        while final in names or final in claimed:
+            final = numbered_name(name, i); i += 1
+        if i > 1: STATS.count("collision_plan", i - 1)
+        claimed.add(final)
+        return final
+
+    def reset(self):
+        """丢弃已占用的名字（保留目录列表），用于对同一目标重新规划。"""
+        self._claimed.clear()
+
+def resolve_collisions(items: List["PlanItem"], index: "DestIndex"):
+    # 按计划顺序占名，排在前面的条目拿到原名
+    for it in items:
+        it.dst_name = index.claim_name(it.dst_dir, it.dst_name)
+
+# ---------- library index ----------
+
+LibKey = Tuple[str, int, int, str, Optional[str]]   # (系列目录, 季, 集, 'VID'|'SUB', 字幕语言)
+_RE_SEASON_DIR = re.compile(r'Season (\d+)', re.I)
+
+def _lib_key(rel_dir: str, name: str) -> Optional[LibKey]:
+    # 只有 <系列>/Season NN/ 下、带 SxxEyy 的视频/字幕算作某一集
+    parts = rel_dir.split(os.sep) if rel_dir else []
+    if len(parts) != 2 or not _RE_SEASON_DIR.fullmatch(parts[1]): return None
+    ext = name_ext(name)
+    kind = 'VID' if ext in VIDEO_EXTS else 'SUB' if ext in SUB_EXTS else None
+    m = _RE_SXXEXX.search(name) if kind else None
+    if not m: return None
+    return (parts[0], int(m.group(1)), int(m.group(2)), kind, normalize_lang(name) if kind == 'SUB' else None)
+
+def item_lib_key(it: "PlanItem") -> Optional[LibKey]:
+    if it.kind == 'EXTRA' or it.ep is None: return None
+    return (it.series_dir, it.season, it.ep, it.kind, it.lang if it.kind == 'SUB' else None)
+
+class LibraryIndex:
+    """
+    目标媒体库索引：(系列目录, 季, 集, 类型, 字幕语言) -> 已有文件；另有全部已有文件的相对路径与 (st_dev, st_ino)。
+    第一次完整遍历，之后 refresh() 对已知目录各 stat 一次，只重新列出 mtime 变化的目录。
+    有状态库时目录列表持久化在 lib_dirs / lib_files 表里，下次启动同样只列变化的目录。
+    """
+    MAX_DEPTH = 3           # 系列 / Season NN / extras 目录
+
+    def __init__(self, root: Path, state: Optional["StateDB"] = None):
+        self.root = str(root)
+        self.state = state
+        # 相对目录 -> (mtime_ns, st_dev, [(文件名, inode)], [子目录相对路径])
+        self._dirs: Dict[str, Tuple[int, int, List[Tuple[str, int]], List[str]]] = {}
+        self.episodes: Dict[LibKey, str] = {}
+        self.paths: set = set()                        # (相对目录, 文件名)
+        self.inodes: Dict[Tuple[int, int], str] = {}   # (st_dev, st_ino) -> 相对路径
+        if state:
+            for rel, row in state.load_library(self.root).items():
+                self._dirs[rel] = row; self._add(rel, row)
+        self.refresh()
+
+    def _add(self, rel: str, row):
+        _mt, dev, files, _sub = row
+        for name, ino in files:
+            path = os.path.join(rel, name)
+            self.paths.add((rel, name))
+            self.inodes[(dev, ino)] = path
+            key = _lib_key(rel, name)
+            if key: self.episodes.setdefault(key, path)
+
+    def _drop(self, rel: str, row):
+        _mt, dev, files, _sub = row
+        for name, ino in files:
+            path = os.path.join(rel, name)
+            self.paths.discard((rel, name))
+            if self.inodes.get((dev, ino)) == path: del self.inodes[(dev, ino)]
+            key = _lib_key(rel, name)
+            if key and self.episodes.get(key) == path: del self.episodes[key]
+
+    def _list(self, rel: str, full: str, st: os.stat_result):
+        files: List[Tuple[str, int]] = []; subdirs: List[str] = []
+        depth = rel.count(os.sep) + 1 if rel else 0
+        STATS.count("scandir")
+        try:
+            with os.scandir(full) as it:
+                for e in it:
+                    if e.name.startswith('.'): continue     # 隐藏文件、未完成的 .aniarr-part
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if depth < self.MAX_DEPTH: subdirs.append(os.path.join(rel, e.name))
+                        elif e.is_file(follow_symlinks=False):
+                            files.append((e.name, e.inode()))
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_dev, files, subdirs)
+
+    def refresh(self):
+        seen: set = set(); changed: List[str] = []
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            full = os.path.join(self.root, rel) if rel else self.root
+            STATS.count("stat")
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            old = self._dirs.get(rel)
+            if old is None or old[0] != st.st_mtime_ns or old[1] != st.st_dev:
+                new = self._list(rel, full, st)
+                if new is None: continue
+                if old: self._drop(rel, old)
+                self._dirs[rel] = new; self._add(rel, new); changed.append(rel)
+                old = new
+            seen.add(rel)
+            stack.extend(old[3])
+        gone = [d for d in self._dirs if d not in seen]
+        for d in gone:
+            self._drop(d, self._dirs.pop(d))
+        if self.state and (changed or gone):
+            self.state.save_library(self.root, {d: self._dirs[d] for d in changed}, gone)
+
+    def existing(self, it: "PlanItem", src_id: Optional[Tuple[int, int]]) -> Optional[str]:
+        """条目在库里已有时返回已有文件的相对路径：源文件本身已链接进库、同一集已存在、或 extras 同名文件已存在。"""
+        if src_id is not None and src_id in self.inodes: return self.inodes[src_id]
+        key = item_lib_key(it)
+        if key is not None: return self.episodes.get(key)
+        root = self.root + os.sep
+        rel = it.dst_dir[len(root):] if it.dst_dir.startswith(root) else None
+        if rel is not None and (rel, it.dst_name) in self.paths: return os.path.join(rel, it.dst_name)
+        return None
+
+LIBRARY_CACHE_MAX = 8       # 进程内最多保留这么多个目标库索引（--serve 可能收到很多不同的目标目录）
+_LIBRARIES: Dict[str, LibraryIndex] = {}
+
+def library_for(dst_root: Path, state: Optional["StateDB"] = None) -> LibraryIndex:
+    """同一进程内每个目标根目录一个索引；再次使用时增量刷新。超过上限时丢掉最久没用的（有状态库时下次从库里加载）。"""
+    lib = _LIBRARIES.pop(str(dst_root), None)
+    if lib is None:
+        while len(_LIBRARIES) >= LIBRARY_CACHE_MAX: del _LIBRARIES[next(iter(_LIBRARIES))]
+        lib = LibraryIndex(dst_root, state)
+    else:
+        lib.refresh()
+    _LIBRARIES[str(dst_root)] = lib
+    return lib
+
+def skip_existing(items: List["PlanItem"], library: LibraryIndex, src_inodes: Dict[str, int],
+                  skipped: Dict[str, List[str]]) -> List["PlanItem"]:
+    # 源文件 inode 来自扫描时的 DirEntry（不额外 stat）；设备号每个源目录 stat 一次
+    devs: Dict[str, Optional[int]] = {}
+    kept = []
+    for it in items:
+        dev = devs.get(it.src_dir, -1)
+        if dev == -1:
+            try:
+                dev = devs[it.src_dir] = os.stat(it.src_dir).st_dev
+            except OSError:
+                dev = devs[it.src_dir] = None
+        ino = src_inodes.get(os.path.join(it.src_dir, it.src_name))
+        hit = library.existing(it, (dev, ino) if dev is not None and ino is not None else None)
+        if hit is None:
+            kept.append(it)
+        else:
+            skipped["EXISTS"].append(f"{it.src_name}  (-> {hit})")
+    return kept
+
+def skip_linked(items: List["PlanItem"], library: LibraryIndex, skipped: Dict[str, List[str]]) -> List["PlanItem"]:
+    """只跳过源文件本身（同一 st_dev/st_ino）已在库里的条目；源文件逐个 stat（条目不是扫描得到的）。"""
+    kept = []
+    for it in items:
+        STATS.count("stat")
+        try:
+            st = os.stat(os.path.join(it.src_dir, it.src_name))
+            hit = library.inodes.get((st.st_dev, st.st_ino))
+        except OSError:
+            hit = None
+        if hit is None:
+            kept.append(it)
+        else:
+            skipped["EXISTS"].append(f"{it.src_name}  (-> {hit})")
+    return kept
 
 # ---------- plan items ----------
 
+class SeriesInfo(NamedTuple):
+    dir: str                      # 目标系列目录名（safe_folder 之后）
+    name: str                     # "Title (Year)"
+    title: str
+    year: Optional[str]
+    sort: str                     # dir.lower()，排序用
+
+class SeriesTable:
+    """每个系列的字符串只存一份，PlanItem 里只放 id。"""
+    def __init__(self):
+        self._rows: List[SeriesInfo] = []
+        self._ids: Dict[Tuple[str, str, str, Optional[str]], int] = {}
+
+    def id_of(self, series_dir: str, series_name: str, title: str, year: Optional[str]) -> int:
+        key = (series_dir, series_name, title, year)
+        sid = self._ids.get(key)
+        if sid is None:
+            sid = self._ids[key] = len(self._rows)
+            self._rows.append(SeriesInfo(series_dir, series_name, title, year, series_dir.lower()))
+        return sid
+
+    def __getitem__(self, sid: int) -> SeriesInfo:
+        return self._rows[sid]
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def clear(self):
+        """清空表。已有的 PlanItem 会失效，只在一次计划执行完、不再引用它们之后调用（--serve 每批、--watch 每轮）。"""
+        self._rows.clear(); self._ids.clear()
+
+SERIES = SeriesTable()
+
+def release_plan_caches():
+    """常驻模式（--serve 每批、--watch 每轮）执行完一次计划后调用：清掉只对这次计划有用的解析缓存与系列表。"""
+    PARSER.clear(); SERIES.clear()
+
+_KIND_ORDER = {'VID': 0, 'SUB': 1, 'EXTRA': 2}
+
+def _lang_rank(lang: Optional[str]) -> int:
+    return 0 if lang == 'zh-CN' else 1 if lang == 'zh-TW' else 9
+
 class PlanItem:
-    def __init__(self, src: Path, dst: Path, kind: str,
+    """
+    一条计划。为了几十万条的计划也能放进内存：__slots__，路径拆成（驻留的目录字符串, 文件名），
+    src/dst 的 Path 只在访问时构造；系列相关字符串放在 SERIES 表里；排序键在创建时算好。
+    """
+    __slots__ = ('src_dir', 'src_name', 'dst_dir', 'dst_name', 'kind', 'sid',
+                 'season', 'ep', 'lang', 'extra_folder', 'extra_token', 'sort_key')
+
+    def __init__(self, src, dst, kind: str,
                  series_dir: str, series_name: str, title: str, year: Optional[str],
                  season: int, ep: Optional[int] = None, lang: Optional[str] = None,
                  extra_folder: Optional[str] = None, extra_token: Optional[str] = None):
-        self.src = src; self.dst = dst; self.kind = kind
-        self.series_dir = series_dir; self.series_name = series_name
-        self.title = title; self.year = year; self.season = season
-        self.ep = ep; self.lang = lang
+        # src/dst 可以是 Path，也可以是已经拆好的 (目录, 文件名)
+        self.src_dir, self.src_name = (src[0], src[1]) if isinstance(src, tuple) else _split_path(src)
+        self.dst_dir, self.dst_name = (dst[0], dst[1]) if isinstance(dst, tuple) else _split_path(dst)
+        self.kind = kind
+        self.sid = SERIES.id_of(series_dir, series_name, title, year)
+        self.season = season; self.ep = ep; self.lang = lang
         self.extra_folder = extra_folder; self.extra_token = extra_token
+        self.sort_key = (SERIES[self.sid].sort, season, _KIND_ORDER.get(kind, 9), ep or 0,
+                         _lang_rank(lang), self.src_name.lower())
+
+    @property
+    def src(self) -> Path: return Path(os.path.join(self.src_dir, self.src_name))
+    @property
+    def dst(self) -> Path: return Path(os.path.join(self.dst_dir, self.dst_name))
+    @dst.setter
+    def dst(self, p: Path): self.dst_dir, self.dst_name = _split_path(p)
+
+    series_dir  = property(lambda self: SERIES[self.sid].dir)
+    series_name = property(lambda self: SERIES[self.sid].name)
+    title       = property(lambda self: SERIES[self.sid].title)
+    year        = property(lambda self: SERIES[self.sid].year)
+
+    # SERIES 是进程内的表（--batch 的规划进程会把计划传回主进程），序列化时带上系列本身
+    def __getstate__(self):
+        return (self.src_dir, self.src_name, self.dst_dir, self.dst_name, self.kind, tuple(SERIES[self.sid][:4]),
+                self.season, self.ep, self.lang, self.extra_folder, self.extra_token, self.sort_key)
+
+    def __setstate__(self, st):
+        (self.src_dir, self.src_name, self.dst_dir, self.dst_name, self.kind, series,
+         self.season, self.ep, self.lang, self.extra_folder, self.extra_token, self.sort_key) = st
+        self.sid = SERIES.id_of(*series)
+
+def _split_path(p) -> Tuple[str, str]:
+    d, name = os.path.split(str(p))
+    return sys.intern(d), name
+
+# ---------- series aliases ----------
+
+_RE_TITLE_NOISE = re.compile(r'[\W_]+')
+
+def title_key(title: str) -> str:
+    """别名表的键：NFKC + casefold，去掉空格与标点（"Dan Da Dan" / "DANDADAN" -> "dandadan"）。"""
+    return _RE_TITLE_NOISE.sub('', unicodedata.normalize('NFKC', title).casefold())
+
+def _trigrams(key: str) -> set:
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+# 标题末尾的续作 / 季标记（II、2、2nd Season、Season 2、S2、Part 2、第二季、Final Season ...）
+_RE_SEQUEL_TAIL = re.compile(
+    r'(?:\b(?:season|part|cour|s)\s*\d+|\b\d+(?:st|nd|rd|th)\s*(?:season|cour)'
+    r'|\b(?:the\s+)?final\s+season|第\s*\S+?\s*[季期部]|\b(?:ii|iii|iv|vi{0,3}|ix|x)|\b\d+|\bs)\W*$')
+
+def sequel_token(title: str) -> str:
+    """标题末尾的续作标记，归一化后返回（"Overlord II" -> "ii"）；没有时返回空串。"""
+    m = _RE_SEQUEL_TAIL.search(unicodedata.normalize('NFKC', title).casefold().strip())
+    return _RE_TITLE_NOISE.sub('', m.group(0)) if m else ""
+
+class AliasIndex:
+    """
+    系列名别名表，JSON 文件：{"规范名": ["别名", ...], ...}。查找按 title_key 归一化后走字典，每个文件 O(1)。
+    --title 覆盖时把解析出的原始标题记为该规范名的别名（dry-run 不学习），退出时写回文件。
+    """
+    SIMILAR = 0.8           # --fuzzy-titles：同一批内标题三元组 Jaccard 相似度达到该值视为同一系列
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path) if path else None
+        self.canon: Dict[str, set] = {}         # 规范名 -> 别名
+        self._map: Dict[str, str] = {}          # title_key -> 规范名
+        self.learned: List[Tuple[str, str]] = []
+        self.learn = True
+        self.fuzzy = False
+        if self.path and self.path.exists():
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                for canon, aliases in data.items():
+                    self.add(canon, canon)
+                    for a in aliases or (): self.add(str(a), canon)
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"[WARN] Failed to read alias file '{self.path}': {e}. Starting empty.")
+
+    def add(self, alias: str, canon: str):
+        if canon not in self.canon:
+            self.canon[canon] = set(); self._map[title_key(canon)] = canon
+        if alias != canon:
+            self.canon[canon].add(alias); self._map[title_key(alias)] = canon
+
+    def resolve(self, title: str) -> Optional[str]:
+        return self._map.get(title_key(title))
+
+    def get(self, title: str, default: str) -> str:
+        # 与 plan_titles 的结果同样的用法：只查别名表，不做同批分组
+        return self.resolve(title) or default
+
+    def observe(self, raw: str, canon: str):
+        if not self.learn or not raw.strip() or raw == UNKNOWN_TITLE: return
+        known = self.resolve(raw)
+        # 已是别的系列的规范名时不改写（例如 --title "Dandadan X" 不会吞掉 "Dandadan"）
+        if known == canon or (known and title_key(known) == title_key(raw)): return
+        self.add(raw, canon); self.learned.append((raw, canon))
+
+    def learn_titles(self, counts: Dict[str, int], canon: str):
+        """
+        --title：只把本批的主标题（文件数最多的写法）记为 canon 的别名，其余写法只有与主标题 title_key 相同、
+        或三元组相似且末尾续作标记相同时才记。"Unknown"、空标题与 "Dandadan 01" 之类的噪声不会学进去。
+        """
+        counts = {t: n for t, n in counts.items() if t.strip() and t != UNKNOWN_TITLE}
+        if not counts: return
+        main = max(counts, key=lambda t: (counts[t], -len(t), t))
+        key, seq = title_key(main), sequel_token(main)
+        grams = _trigrams(key)
+        for t in counts:
+            k = title_key(t)
+            if t != main and k != key:
+                g = _trigrams(k)
+                inter = len(grams & g)
+                if sequel_token(t) != seq or not g or inter < self.SIMILAR * (len(grams) + len(g) - inter): continue
+            self.observe(t, canon)
+
+    def plan_titles(self, counts: Dict[str, int]) -> Dict[str, str]:
+        """
+        本批的 {原始标题: 系列名}：已知别名直接映射；其余按 title_key 相同分组（fuzzy 时再按三元组相似度，
+        但末尾续作标记不同的标题不合并），每组取别名表里的规范名，没有时取文件数最多的写法。
+        只处理去重后的标题，与文件数无关。
+        """
+        keys = {t: title_key(t) for t in counts}
+        parent = {t: t for t in counts}
+        def find(t: str) -> str:
+            while parent[t] != t:
+                parent[t] = parent[parent[t]]; t = parent[t]
+            return t
+        def union(a: str, b: str):
+            ra, rb = find(a), find(b)
+            if ra != rb: parent[rb] = ra
+        by_key: Dict[str, str] = {}
+        for t, k in keys.items():
+            if k in by_key: union(by_key[k], t)
+            else: by_key[k] = t
+        if self.fuzzy: self._join_similar(by_key, union)
+        groups: Dict[str, List[str]] = defaultdict(list)
+        for t in counts: groups[find(t)].append(t)
+        out: Dict[str, str] = {}
+        for members in groups.values():
+            known = next((c for c in map(self.resolve, members) if c), None)
+            name = known or max(members, key=lambda t: (counts[t], -len(t), t))
+            for t in members: out[t] = name
+        return out
+
+    def _join_similar(self, by_key: Dict[str, str], union):
+        """三元组 Jaccard 相似度达到 SIMILAR 的 title_key 合并；末尾续作标记（sequel_token）不同的不合并。"""
+        # 相似度连接（prefix filtering）：三元组按出现频率从低到高排序，Jaccard >= s 的两个集合
+        # 必然在各自前 |g| - ceil(s*|g|) + 1 个三元组里有交集，因此只索引、只探测这段前缀。
+        # 键按集合大小升序处理，倒排表里太短的条目以后也不会再满足长度条件，用 start 游标跳过；
+        # 倒排表还记下三元组在对方前缀里的位置，剩余长度凑不满所需交集的候选直接剪掉（PPJoin）
+        s = self.SIMILAR
+        tri = sorted(((len(g), k, g) for k, g in ((k, _trigrams(k)) for k in by_key) if len(g) >= 3),
+                     key=lambda r: r[:2])
+        ks = [k for _, k, _ in tri]
+        grams = [g for _, _, g in tri]
+        size = [len(g) for g in grams]
+        df: Counter = Counter(x for g in grams for x in g)
+        index: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        start: Dict[str, int] = defaultdict(int)
+        for a, g in enumerate(grams):
+            n = size[a]
+            prefix = sorted(g, key=lambda x: (df[x], x))[:n - math.ceil(s * n) + 1]
+            minlen = s * n
+            overlap: Dict[int, int] = {}
+            for i, x in enumerate(prefix):
+                post = index[x]
+                lo = start[x]
+                while lo < len(post) and size[post[lo][0]] < minlen: lo += 1
+                start[x] = lo
+                rest = n - i - 1
+                for b, j in post[lo:]:
+                    c = overlap.get(b, 0)
+                    if c < 0: continue
+                    m = size[b]
+                    ub = c + 1 + (rest if rest < m - j - 1 else m - j - 1)
+                    overlap[b] = c + 1 if ub * (1 + s) >= s * (n + m) else -1
+                post.append((a, i))
+            me = by_key[ks[a]]
+            for b, c in overlap.items():
+                if c <= 0: continue
+                inter = len(g & grams[b])
+                other = by_key[ks[b]]
+                if inter >= s * (n + size[b] - inter) and sequel_token(me) == sequel_token(other):
+                    union(me, other)
+
+    def save(self):
+        if not self.path or not self.learned: return
+        data = {c: sorted(a) for c, a in sorted(self.canon.items())}
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+            os.replace(tmp, self.path)
+            self.learned.clear()
+        except OSError as e:
+            print(f"[WARN] Cannot write alias file '{self.path}': {e}", file=sys.stderr)
+
+def _collect_titles(entries: Sequence[ScanEntry], rules: RuleSet, extras_on: bool) -> Dict[str, int]:
+    # 与 plan_entries 相同的主文件/extras 判断；解析结果有缓存，第二遍只是查字典
+    counts: Dict[str, int] = Counter()
+    for e in entries:
+        if e.kind != 'file': continue
+        ext = name_ext(e.name)
+        if e.extras:
+            if extras_on and ext in VIDEO_EXTS: counts[PARSER.parse_extra(e.name).title] += 1
+        elif ext in SUB_EXTS:
+            counts[PARSER.parse(e.name).title] += 1
+        elif ext in VIDEO_EXTS:
+            rec = PARSER.parse_extra(e.name) if extras_on and rules.matches(e.name) else PARSER.parse(e.name)
+            counts[rec.title] += 1
+    return counts
+
+def open_aliases(path_arg: Optional[str], cfg: Dict[str, Any]) -> Optional[AliasIndex]:
+    path = path_arg or cfg.get("alias_db")
+    return AliasIndex(Path(path).expanduser()) if path else None
+
+# ---------- container probe ----------
+
+PROBE_HEAD    = 256 << 10   # MKV：Segment Info / Tracks 只在文件头这一段里找
+PROBE_TRAILER = 80.0        # 短于此：CM / PV / 预告
+PROBE_SHORT   = 120.0       # 短于此：NCOP / NCED 等片段（约 90 秒）
+PROBE_CLUSTER = 0.5         # 比同系列有集数正片的时长中位数短一半以上 → 不是正片
+PROBE_SAMPLE  = 5           # 每个系列抽几集正片作时长参照
+PROBE_JOBS    = 8
+_MP4_TOP = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'uuid'}
+
+class MediaInfo(NamedTuple):
+    duration: Optional[float]     # 秒
+    tracks: Optional[int]
+
+def _ebml_vint(mm, pos: int, marker: bool = False) -> Tuple[int, int]:
+    """EBML 变长整数 -> (值, 字节数)。marker=True 保留长度标记位（元素 ID 的写法）。"""
+    first = mm[pos]
+    if not first: raise ValueError("bad EBML vint")
+    n = 9 - first.bit_length()
+    v = first if marker else first & (0xFF >> n)
+    for b in mm[pos + 1:pos + n]: v = (v << 8) | b
+    return v, n
+
+def _ebml_children(mm, pos: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    """[pos, end) 内的元素 -> (ID, 数据起点, 数据长度)。"""
+    while pos < end:
+        eid, n = _ebml_vint(mm, pos, True); pos += n
+        size, n = _ebml_vint(mm, pos); pos += n
+        yield eid, pos, size
+        pos += size
+
+def _probe_mkv(mm, size: int) -> MediaInfo:
+    # EBML 头之后是 Segment；Info(时长) 与 Tracks 在第一个 Cluster 之前
+    eid, n = _ebml_vint(mm, 0, True)
+    hsize, m = _ebml_vint(mm, n)
+    pos = n + m + hsize
+    eid, n = _ebml_vint(mm, pos, True)
+    if eid != 0x18538067: raise ValueError("no Segment")
+    _seg, m = _ebml_vint(mm, pos + n)
+    scale, duration, tracks = 1_000_000, None, None
+    for eid, p, sz in _ebml_children(mm, pos + n + m, min(size, PROBE_HEAD)):
+        if eid == 0x1549A966:                   # Info
+            for cid, cp, csz in _ebml_children(mm, p, min(p + sz, size)):
+                if cid == 0x2AD7B1: scale = int.from_bytes(mm[cp:cp + csz], "big")
+                elif cid == 0x4489: duration = struct.unpack(">f" if csz == 4 else ">d", mm[cp:cp + csz])[0]
+        elif eid == 0x1654AE6B:                 # Tracks
+            tracks = sum(1 for cid, _p, _s in _ebml_children(mm, p, min(p + sz, size)) if cid == 0xAE)
+        elif eid == 0x1F43B675:                 # Cluster：元数据已经过去了
+            break
+        if duration is not None and tracks is not None: break
+    return MediaInfo(duration * scale / 1e9 if duration is not None else None, tracks)
+
+def _mp4_boxes(mm, pos: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """[pos, end) 内的 box -> (类型, 数据起点, 数据终点)。只读 box 头，mdat 直接跳过。"""
+    while pos + 8 <= end:
+        size, typ = struct.unpack_from(">I4s", mm, pos); hdr = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", mm, pos + 8)[0]; hdr = 16
+        elif size == 0:
+            size = end - pos
+        if size < hdr: raise ValueError("bad box size")
+        yield typ, pos + hdr, min(pos + size, end)
+        pos += size
+
+def _probe_mp4(mm, size: int) -> MediaInfo:
+    # moov 可能在文件头（faststart）也可能在文件尾，顶层只走 box 头
+    for typ, p, end in _mp4_boxes(mm, 0, size):
+        if typ != b'moov': continue
+        duration, tracks = None, 0
+        for ct, cp, _ce in _mp4_boxes(mm, p, end):
+            if ct == b'mvhd':
+                if mm[cp] == 1: scale, d = struct.unpack_from(">IQ", mm, cp + 20)
+                else: scale, d = struct.unpack_from(">II", mm, cp + 12)
+                duration = d / scale if scale else None
+            elif ct == b'trak':
+                tracks += 1
+        return MediaInfo(duration, tracks)
+    return MediaInfo(None, None)
+
+def probe_media(path: str) -> MediaInfo:
+    """
+    不启动 ffprobe，mmap 后只读 MKV 的 Segment Info / Tracks 或 MP4 的 moov/mvhd，
+    实际只会读入文件头尾少量页面。不认识或损坏的文件返回 MediaInfo(None, None)。
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 16: return MediaInfo(None, None)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                if mm[:4] == b'\x1a\x45\xdf\xa3': return _probe_mkv(mm, size)
+                if mm[4:8] in _MP4_TOP: return _probe_mp4(mm, size)
+            except (ValueError, IndexError, struct.error):
+                pass
+    return MediaInfo(None, None)
+
+class ProbeCache:
+    """(dev, ino) -> MediaInfo，按 size/mtime 校验。有状态库时持久化到其 probes 表。"""
+    def __init__(self, state: Optional["StateDB"] = None):
+        self.state = state
+        self._mem: Dict[Tuple[int, int], Tuple[int, int, MediaInfo]] = {}
+
+    def get(self, st: os.stat_result) -> Optional[MediaInfo]:
+        row = self._mem.get((st.st_dev, st.st_ino))
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns: return row[2]
+        cached = self.state.get_probe(st) if self.state else None
+        if cached is None: return None
+        info = MediaInfo(*cached)
+        self._mem[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns, info)
+        return info
+
+    def put(self, st: os.stat_result, info: MediaInfo):
+        self._mem[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns, info)
+        if self.state: self.state.put_probe(st, *info)
+
+def _try_probe(path: str) -> Optional[MediaInfo]:
+    try:
+        return probe_media(path)
+    except (OSError, ValueError):
+        return None
+
+def probe_all(paths: Sequence[str], cache: ProbeCache, jobs: int = PROBE_JOBS) -> Dict[str, MediaInfo]:
+    """未缓存的文件在线程池里探测（主要是在等页面读入），结果写回缓存（只在调用线程写状态库）。"""
+    out: Dict[str, MediaInfo] = {}
+    need: List[Tuple[str, os.stat_result]] = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        info = cache.get(st)
+        if info is None: need.append((p, st))
+        else: out[p] = info
+    STATS.count("stat", len(paths)); STATS.count("probe", len(need)); STATS.count("probe_cached", len(out))
+    if len(need) > 1 and jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(jobs, len(need))) as pool:
+            results = list(pool.map(_try_probe, (p for p, _st in need)))
+    else:
+        results = [_try_probe(p) for p, _st in need]
+    for (p, st), info in zip(need, results):
+        if info is None: continue               # 读不了的文件不缓存，下次再试
+        cache.put(st, info); out[p] = info
+    return out
+
+def _probe_category(info: MediaInfo) -> Optional[str]:
+    """按时长/轨道数猜 extras 分类；不够短时返回 None。"""
+    if info.duration is None or info.duration >= PROBE_SHORT: return None
+    if info.tracks == 1: return "other"         # 只有视频轨：菜单、背景循环
+    return "trailers" if info.duration < PROBE_TRAILER else "clips"
 
 # ---------- plan builder ----------
 
-def _parse_common_main(p: Path, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str]) -> Tuple[str, Optional[str], int, int, str, str, Optional[str]]:
-    raw = p.name
-    clean = clean_tokens(raw)
-    s_found, ep = extract_season_ep(clean); use_season = season_arg if season_arg is not None else (s_found or 1)
-    title = extract_title(clean, title_arg); year  = year_arg or extract_year(clean)
+def _parse_common_main(name: str, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str],
+                       titles: Optional[Dict[str, str]] = None) -> Tuple[str, Optional[str], int, int, str, str, Optional[str], Optional[str]]:
+    rec = PARSER.parse(name)
+    use_season = season_arg if season_arg is not None else (rec.season or 1)
+    title = title_arg or (titles.get(rec.title, rec.title) if titles else rec.title); year = year_arg or rec.year
     name_year = f"{title} ({year})" if year else f"{title}"
-    group = parse_group_from_prefix(raw)
     series_dir = safe_folder(name_year)
-    return name_year, year, use_season, ep, series_dir, title, group
-
-def _parse_common_extra(p: Path, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str]) -> Tuple[str, Optional[str], int, str, str, Optional[str]]:
-    raw = p.name
-    clean = clean_tokens(raw)
-    # extras：系列名更激进，移除所有 [xxx]
-    base_for_title = strip_all_brackets(clean)
-    s_found, _ = extract_season_ep(base_for_title)
-    use_season = season_arg if season_arg is not None else (s_found or 1)
-    title = extract_title(base_for_title, title_arg)
-    year  = year_arg or extract_year(base_for_title)
+    return name_year, year, use_season, rec.ep, series_dir, title, rec.group, rec.lang
+
+def _parse_common_extra(name: str, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str],
+                        titles: Optional[Dict[str, str]] = None) -> Tuple[str, Optional[str], int, str, str, Optional[str]]:
+    # extras：系列名更激进，移除所有 [xxx]（见 NameParser.parse_extra）
+    rec = PARSER.parse_extra(name)
+    use_season = season_arg if season_arg is not None else (rec.season or 1)
+    title = title_arg or (titles.get(rec.title, rec.title) if titles else rec.title)
+    year  = year_arg or rec.year
     name_year = f"{title} ({year})" if year else f"{title}"
-    group = parse_group_from_prefix(raw)
     series_dir = safe_folder(name_year)
-    return name_year, year, use_season, series_dir, title, group
+    return name_year, year, use_season, series_dir, title, rec.group
 
-def _plan_main_file(p: Path, dst_root: Path, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str],
-                    items: List[PlanItem], tmp_groups_per_series: Dict[str, List[str]], is_subtitle: bool):
-    name_year, year, use_season, ep, series_dir, title, group = _parse_common_main(p, season_arg, title_arg, year_arg)
-    out_dir = dst_root / series_dir / f"Season {use_season:02d}"
+def _dst_dir(root: str, *parts: str) -> str:
+    # 与 str(Path(root, *parts)) 相同；同一目录的所有条目共用一个字符串
+    return sys.intern(os.path.join(root, *parts) if root != '.' else os.path.join(*parts))
+
+def _plan_main_file(src: Tuple[str, str], dst_root: Path, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str],
+                    items: List[PlanItem], tmp_groups_per_series: Dict[str, Counter], is_subtitle: bool,
+                    titles: Optional[Dict[str, str]] = None):
+    name = src[1]
+    name_year, year, use_season, ep, series_dir, title, group, lang = _parse_common_main(name, season_arg, title_arg, year_arg, titles)
+    out_dir = _dst_dir(str(dst_root), series_dir, f"Season {use_season:02d}")
     base = f"{name_year} S{use_season:02d}E{ep:02d}"
     if group: base += f" - {group}"
-    dst = out_dir / (base + p.suffix.lower())
+    dst_name = base + name_ext(name)
     if is_subtitle:
-        dst = Path(apply_lang(str(dst), p.name))
-        items.append(PlanItem(p, dst, 'SUB', series_dir, name_year, title, year, use_season, ep, normalize_lang(p.name)))
+        dst_name = apply_lang(dst_name, name, lang)
+        items.append(PlanItem(src, (out_dir, dst_name), 'SUB', series_dir, name_year, title, year, use_season, ep, lang))
     else:
-        items.append(PlanItem(p, dst, 'VID', series_dir, name_year, title, year, use_season, ep))
-    if group: tmp_groups_per_series.setdefault(series_dir, []).append(group)
-
-def _plan_extra_file(p: Path, dst_root: Path, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str],
-                     items: List[PlanItem], tmp_groups_per_series: Dict[str, List[str]],
-                     rules: List[Dict[str, Any]], fallback: str, scope: str):
-    name_year, year, use_season, series_dir, title, group = _parse_common_extra(p, season_arg, title_arg, year_arg)
-    folder, token = classify_extra(p.name, rules, fallback)
+        items.append(PlanItem(src, (out_dir, dst_name), 'VID', series_dir, name_year, title, year, use_season, ep))
+    if group: tmp_groups_per_series.setdefault(series_dir, Counter())[group] += 1
+
+def _plan_extra_file(src: Tuple[str, str], dst_root: Path, season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str],
+                     items: List[PlanItem], tmp_groups_per_series: Dict[str, Counter],
+                     rules: RuleSet, fallback: str, scope: str, titles: Optional[Dict[str, str]] = None):
+    name = src[1]
+    name_year, year, use_season, series_dir, title, group = _parse_common_extra(name, season_arg, title_arg, year_arg, titles)
+    folder, token = classify_extra(name, rules, fallback)
     # 目录：series 或 season 层
     if scope == 'season':
-        out_dir = dst_root / series_dir / f"Season {use_season:02d}" / folder
+        out_dir = _dst_dir(str(dst_root), series_dir, f"Season {use_season:02d}", folder)
     else:
-        out_dir = dst_root / series_dir / folder
+        out_dir = _dst_dir(str(dst_root), series_dir, folder)
     # 文件名：仅 Token（你要求）
     base = token
-    dst = out_dir / (base + p.suffix.lower())
-    items.append(PlanItem(p, dst, 'EXTRA', series_dir, name_year, title, year, use_season,
+    items.append(PlanItem(src, (out_dir, base + name_ext(name)), 'EXTRA', series_dir, name_year, title, year, use_season,
                           ep=None, lang=None, extra_folder=folder, extra_token=token))
-    if group: tmp_groups_per_series.setdefault(series_dir, []).append(group)
+    if group: tmp_groups_per_series.setdefault(series_dir, Counter())[group] += 1
+
+def probe_reclassify(items: List[PlanItem], ambiguous: List[int], cache: ProbeCache, dst_root: Path,
+                     season_arg: Optional[int], title_arg: Optional[str], year_arg: Optional[str],
+                     rules: RuleSet, fallback: str, scope: str, titles: Optional[Dict[str, str]] = None) -> int:
+    """
+    --probe：文件名判断不了的视频按容器时长重新归类（items[i] 原地替换），返回改动数。
+      - 没有集数的正片：比同系列有集数正片的时长中位数短一半以上（没有参照时短于 PROBE_SHORT）→ extras，
+        与正片时长聚在一起的仍按正片；
+      - 未命中规则的 extras：足够短时按时长/轨道数归到 trailers / clips / other，而不是 fallback。
+    """
+    amb = set(ambiguous)
+    series = {items[i].series_dir for i in ambiguous if items[i].kind == 'VID'}
+    refs: Dict[str, List[str]] = defaultdict(list)
+    for i, it in enumerate(items):
+        if it.kind == 'VID' and i not in amb and it.series_dir in series and len(refs[it.series_dir]) < PROBE_SAMPLE:
+            refs[it.series_dir].append(os.path.join(it.src_dir, it.src_name))
+    paths = [os.path.join(items[i].src_dir, items[i].src_name) for i in ambiguous]
+    infos = probe_all(paths + [p for ps in refs.values() for p in ps], cache)
+    median: Dict[str, float] = {}
+    for s, ps in refs.items():
+        ds = sorted(infos[p].duration for p in ps if p in infos and infos[p].duration)
+        if ds: median[s] = ds[len(ds) // 2]
+
+    changed = 0
+    for i, path in zip(ambiguous, paths):
+        it, info = items[i], infos.get(path)
+        if info is None or info.duration is None: continue
+        cat = _probe_category(info)
+        if it.kind == 'VID':
+            ref = median.get(it.series_dir)
+            if ref is not None and info.duration >= ref * PROBE_CLUSTER: continue
+            if ref is None and cat is None: continue
+            cat = cat or validate_category(fallback)
+        elif cat is None or cat == it.extra_folder:
+            continue
+        # 分类只在没有规则命中时生效，这里把它当作 fallback 传入
+        replanned: List[PlanItem] = []
+        _plan_extra_file((it.src_dir, it.src_name), dst_root, season_arg, title_arg, year_arg,
+                         replanned, {}, rules, cat, scope, titles)
+        items[i] = replanned[0]; changed += 1
+    STATS.count("probe_reclassified", changed)
+    return changed
 
 def build_plan(src_dir: Path, dst_root: Path, season_arg: Optional[int],
                title_arg: Optional[str], year_arg: Optional[str],
                extras_on: bool, extras_scope_cli: str,
-               rules: List[Dict[str, Any]], fallback_cat: str, cfg_scope: Optional[str]) -> Tuple[List[PlanItem], Dict[str, Optional[str]], Dict[str, List[str]]]:
+               rules, fallback_cat: str, cfg_scope: Optional[str],
+               max_depth: int = DEFAULT_SCAN_DEPTH, ignore: Optional[Sequence[str]] = None,
+               state: Optional[StateDB] = None, skip_done: bool = True,
+               dest_index: Optional[DestIndex] = None, resolve: bool = True) -> Tuple[List[PlanItem], Dict[str, Optional[str]], Dict[str, List[str]]]:
+    with STATS.phase("scan"):
+        entries = list(scan_tree(src_dir, max_depth, ignore, extras_on=extras_on, exclude=(dst_root,)))
+    return plan_entries(entries, dst_root, season_arg, title_arg, year_arg, extras_on, extras_scope_cli,
+                        rules, fallback_cat, cfg_scope, state=state, skip_done=skip_done,
+                        dest_index=dest_index, resolve=resolve)
+
+def plan_sort_key(it: PlanItem):
+    """计划的输出顺序：系列 → 季 → 正片/字幕/extras → 集数 → 简/繁/其他语言 → 原文件名（创建 PlanItem 时已算好）。"""
+    return it.sort_key
+
+def plan_entries(entries: Iterable[ScanEntry], dst_root: Path, season_arg: Optional[int],
+                 title_arg: Optional[str], year_arg: Optional[str],
+                 extras_on: bool, extras_scope_cli: str,
+                 rules, fallback_cat: str, cfg_scope: Optional[str],
+                 state: Optional[StateDB] = None, skip_done: bool = True,
+                 dest_index: Optional[DestIndex] = None, resolve: bool = True,
+                 skip_paths: Optional[set] = None, dedupe: Optional[Sequence[str]] = None,
+                 library: Optional[LibraryIndex] = None, aliases: Optional[AliasIndex] = None,
+                 probe: bool = False, max_items: Optional[int] = None,
+                 keep_skipped: bool = False) -> Tuple[List[PlanItem], Dict[str, Optional[str]], Dict[str, List[str]]]:
+    """
+    build_plan 的规划部分：消费任意来源的 ScanEntry（完整扫描、watch 模式下已就绪的文件等）。
+    排序后用 DestIndex 解决重名，计划里的目标名就是最终执行时的名字（resolve=False 时保留原始目标，由调用方解决）。
+    给了 max_items 时内存有界（见 PlanRuns）：返回 SpilledPlan，跳过的文件只计数（keep_skipped 时仍列出）。
+    """
     items: List[PlanItem] = []
     series_group: Dict[str, Optional[str]] = {}
-    skipped: Dict[str, List[str]] = defaultdict(list)
-    tmp_groups_per_series: Dict[str, List[str]] = {}
+    skipped: Dict[str, List[str]] = defaultdict(SkipCount if max_items and not keep_skipped else list)
+    runs = PlanRuns() if max_items else None
+    tmp_groups_per_series: Dict[str, Counter] = {}     # 系列 -> 字幕组计数（不按文件保存）
 
     extras_scope = cfg_scope or extras_scope_cli
+    rules = compile_rules(rules, warn=False)
+    done = (state.done_lookup(dst_root) if runs is not None else state.done_keys(dst_root)) if (state and skip_done) else ()
+    seen_extras: set = set()        # 已记为 DIR 的 extras 目录（SkipCount 只计数，不能用来判断是否已记过）
+    src_inodes: Dict[str, int] = {}
+    ambiguous: List[int] = []       # --probe：文件名判断不了的视频（items 下标）
+    probe = probe and extras_on
+    titles: Optional[Dict[str, str]] = None
+    if aliases is not None and runs is not None:
+        # 有界内存：不能先收集整批标题，只按别名表映射
+        titles = aliases
+    elif aliases is not None:
+        # 别名表：先收集本批出现的标题（解析有缓存），--title 时学习别名，否则映射到规范名/同批相似标题
+        entries = entries if isinstance(entries, list) else list(entries)
+        counts = _collect_titles(entries, rules, extras_on)
+        if title_arg:
+            aliases.learn_titles(counts, title_arg)
+        else:
+            titles = aliases.plan_titles(counts)
 
-    for p in sorted(src_dir.iterdir(), key=lambda x: x.name.lower()):
-        if p.is_dir():
-            # 允许用户把 extras 放一个子目录里（例如 SPs/extras），只处理该目录下的视频文件
-            if extras_on and p.name.lower() in ('sps', 'sp', 'extras'):
-                for fp in sorted(p.iterdir(), key=lambda x: x.name.lower()):
-                    if fp.is_file() and is_video(fp):
-                        _plan_extra_file(fp, dst_root, season_arg, title_arg, year_arg,
-                                         items, tmp_groups_per_series, rules, fallback_cat, extras_scope)
-                    else:
-                        skipped["DIR_ITEM"].append(str(fp))
-            else:
-                skipped["DIR"].append(p.name)
-            continue
+    def probe_items():
+        if not ambiguous: return
+        # --probe：按容器时长/轨道数重新归类，结果按 inode/mtime 缓存（有状态库时持久化）
+        with STATS.phase("probe"):
+            probe_reclassify(items, ambiguous, ProbeCache(state), dst_root, season_arg, title_arg, year_arg,
+                             rules, fallback_cat, extras_scope, titles)
+            if state: state.flush()
+        ambiguous.clear()
 
-        if not p.exists() or not p.is_file():
-            skipped["NONFILE"].append(p.name); continue
+    with STATS.phase("plan"):
+        for e in entries:
+            if runs is not None and len(items) >= max_items:
+                probe_items(); runs.spill(items, src_inodes, state.keys if state else None)
+            ext = name_ext(e.name)
+            if skip_paths and os.path.abspath(e.path) in skip_paths:
+                # --resume：日志里已完成的源文件，不再 stat
+                skipped["JOURNAL"].append(e.rel); continue
+            if state and e.kind == 'file' and (ext in VIDEO_EXTS or ext in SUB_EXTS):
+                # 状态库中已执行且未变化的文件直接跳过
+                if state.identify(e) in done:
+                    if runs is not None: state.keys.pop(e.path, None)
+                    skipped["DONE"].append(e.rel); continue
+            if library is not None and e.entry is not None and e.kind == 'file':
+                try:
+                    src_inodes[e.path] = e.entry.inode()
+                except OSError:
+                    pass
+            if e.extras and not extras_on:
+                # 条目来自 extras 开启时的扫描（交互会话缓存），此时整个 extras 目录按 DIR 跳过
+                parts = e.rel.split(os.sep)
+                cut = next(i for i, part in enumerate(parts[:-1]) if part.lower() in EXTRAS_DIRS)
+                extras_dir = os.sep.join(parts[:cut + 1])
+                if extras_dir not in seen_extras:
+                    seen_extras.add(extras_dir); skipped["DIR"].append(extras_dir)
+                continue
+            if e.extras:
+                # extras 目录：只处理视频文件
+                if e.kind == 'file' and ext in VIDEO_EXTS:
+                    _plan_extra_file(_split_path(e.path), dst_root, season_arg, title_arg, year_arg,
+                                     items, tmp_groups_per_series, rules, fallback_cat, extras_scope, titles)
+                    if probe and rules.category(items[-1].extra_token) is None: ambiguous.append(len(items) - 1)
+                else:
+                    skipped["DIR_ITEM"].append(e.path)
+                continue
 
-        if is_sub(p):
-            _plan_main_file(p, dst_root, season_arg, title_arg, year_arg,
-                            items, tmp_groups_per_series, is_subtitle=True)
-            continue
+            if e.kind == 'dir':
+                skipped["DIR"].append(e.rel); continue
 
-        if is_video(p):
-            # 命中文件名中的任何 extras 规则 → 当作 EXTRA；否则当作主视频
-            if extras_on and any(re.search(rule["pattern"], p.name, flags=re.I) for rule in rules):
-                _plan_extra_file(p, dst_root, season_arg, title_arg, year_arg,
-                                 items, tmp_groups_per_series, rules, fallback_cat, extras_scope)
-            else:
-                _plan_main_file(p, dst_root, season_arg, title_arg, year_arg,
-                                items, tmp_groups_per_series, is_subtitle=False)
-            continue
+            if e.kind != 'file':
+                skipped["NONFILE"].append(e.rel); continue
+
+            if ext in SUB_EXTS:
+                _plan_main_file(_split_path(e.path), dst_root, season_arg, title_arg, year_arg,
+                                items, tmp_groups_per_series, is_subtitle=True, titles=titles)
+                continue
+
+            if ext in VIDEO_EXTS:
+                p = _split_path(e.path)
+                # 命中文件名中的任何 extras 规则 → 当作 EXTRA；否则当作主视频
+                if extras_on and rules.matches(e.name):
+                    _plan_extra_file(p, dst_root, season_arg, title_arg, year_arg,
+                                     items, tmp_groups_per_series, rules, fallback_cat, extras_scope, titles)
+                    if probe and rules.category(items[-1].extra_token) is None: ambiguous.append(len(items) - 1)
+                else:
+                    _plan_main_file(p, dst_root, season_arg, title_arg, year_arg,
+                                    items, tmp_groups_per_series, is_subtitle=False, titles=titles)
+                    if probe and not PARSER.parse(e.name).ep_found: ambiguous.append(len(items) - 1)
+                continue
+
+            skipped["UNKNOWN"].append(e.rel)
 
-        skipped["UNKNOWN"].append(p.name)
+    probe_items()
 
     for series, groups in tmp_groups_per_series.items():
-        series_group[series] = Counter(groups).most_common(1)[0][0] if groups else None
+        series_group[series] = groups.most_common(1)[0][0] if groups else None
 
-    def kind_order(k: str) -> int: return {'VID': 0, 'SUB': 1, 'EXTRA': 2}.get(k, 9)
+    if runs is not None:
+        runs.spill(items, src_inodes, state.keys if state else None)
+        hashes = HashCache(state)
+        def finish(recs: List[Tuple[PlanItem, Optional[int], Optional[FileKey]]]) -> List[PlanItem]:
+            # 归并出的一个系列（已排序）：去重、库内跳过、重名都不会跨系列，逐个系列处理即可
+            grp = [it for it, _ino, _key in recs]
+            if dedupe is not None:
+                with STATS.phase("dedupe"):
+                    grp, dups = dedupe_plan(grp, dedupe, hashes)
+                for loser, winner, why in dups:
+                    skipped["DUP"].append(f"{loser.src_name}  ({why} as {winner.src_name})")
+            if library is not None:
+                with STATS.phase("library"):
+                    inodes = {os.path.join(it.src_dir, it.src_name): ino for it, ino, _key in recs if ino is not None}
+                    grp = skip_existing(grp, library, inodes, skipped)
+            if resolve:
+                with STATS.phase("resolve"):
+                    resolve_collisions(grp, DestIndex())
+            return grp
+        with STATS.phase("merge"):
+            plan = runs.merge(finish)
+        if state: state.flush()
+        STATS.count("files_planned", len(plan))
+        return plan, series_group, skipped
 
-    items.sort(key=lambda it: (
-        it.series_dir.lower(), it.season, kind_order(it.kind),
-        (it.ep or 0),
-        (0 if it.lang == 'zh-CN' else 1 if it.lang == 'zh-TW' else 9),
-        it.src.name.lower()
-    ))
+    with STATS.phase("sort"):
+        items.sort(key=plan_sort_key)
+    if dedupe is not None:
+        # --dedupe：重复的文件只留一个（策略见 dedupe_plan），其余记为 DUP
+        with STATS.phase("dedupe"):
+            items, dups = dedupe_plan(items, dedupe, HashCache(state))
+            if state: state.flush()
+        for loser, winner, why in dups:
+            skipped["DUP"].append(f"{loser.src_name}  ({why} as {winner.src_name})")
+    if library is not None:
+        # --skip-existing：库里已有的集数/字幕/extras 直接跳过，不再逐个探测
+        with STATS.phase("library"):
+            items = skip_existing(items, library, src_inodes, skipped)
+    if resolve:
+        with STATS.phase("resolve"):
+            resolve_collisions(items, dest_index if dest_index is not None else DestIndex())
+    STATS.count("files_planned", len(items))
     return items, series_group, skipped
 
-# ---------- executor ----------
+def scan_options(args, cfg: Dict[str, Any]) -> Tuple[int, List[str]]:
+    depth = args.depth if args.depth is not None else cfg.get("scan_depth", DEFAULT_SCAN_DEPTH)
+    ignore = cfg.get("ignore", DEFAULT_IGNORE) + (args.ignore or [])
+    return depth, ignore
 
-def act_hardlink(src: Path, dst: Path) -> Tuple[bool, str, Path]:
-    try:
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        final = dst; i = 1
-        while final.exists():
-            final = final.with_stem(final.stem + f"_{i}"); i += 1
-        os.link(str(src), str(final))
-        return True, "LINK ", final
-    except Exception as e:
-        return False, str(e), dst
+def plan_from_args(src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any],
+                   entries: Optional[Iterable[ScanEntry]] = None, resolve: bool = True,
+                   dest_index: Optional[DestIndex] = None,
+                   max_items: Optional[int] = None) -> Tuple[List[PlanItem], Dict[str, Optional[str]], Dict[str, List[str]]]:
+    if entries is None:
+        depth, ignore = scan_options(args, cfg)
+        if max_items:
+            # 有界内存：边扫描边规划，不保留整棵树的条目（扫描耗时计入 plan）
+            entries = scan_tree(src_dir, depth, ignore, extras_on=not args.no_extras, exclude=(dst_root,))
+        else:
+            with STATS.phase("scan"):
+                entries = list(scan_tree(src_dir, depth, ignore, extras_on=not args.no_extras, exclude=(dst_root,)))
+    return plan_entries(
+        entries, dst_root, args.season, args.title, args.year,
+        (not args.no_extras), args.extras_scope, cfg["rule_set"], cfg["fallback_category"], cfg.get("extras_scope"),
+        state=cfg.get("_state"), skip_done=not args.full, dest_index=dest_index, resolve=resolve,
+        skip_paths=cfg.get("_journal_done"),
+        dedupe=cfg.get("_dedupe"),
+        library=library_for(dst_root, cfg.get("_state")) if cfg.get("_skip_existing") else None,
+        aliases=cfg.get("_aliases"), probe=cfg.get("_probe", False),
+        max_items=max_items, keep_skipped=cfg.get("_verbose", False)
+    )
 
-def act_move(src: Path, dst: Path) -> Tuple[bool, str, Path]:
-    try:
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        final = dst; i = 1
-        while final.exists():
-            final = final.with_stem(final.stem + f"_{i}"); i += 1
-        shutil.move(str(src), str(final))
-        return True, "MOVED", final
-    except Exception as e:
-        return False, str(e), dst
+# ---------- bounded-memory planning ----------
 
-# ---------- printing / header ----------
+PLAN_ITEM_BYTES = 1024      # 每条计划在内存里的估算开销（含解析缓存），用于把 --max-memory 换算成条数
+PLAN_MIN_ITEMS  = 1000
+_RE_SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$', re.I)
 
-def width() -> int: return term_width()
+def parse_size(s) -> int:
+    """"512M" / "2G" / "1.5GiB" / 字节数 -> 字节数。"""
+    m = _RE_SIZE.match(str(s))
+    if not m: raise ValueError(f"bad size: {s!r}")
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " "))
 
-def fmt_auto(val_user: Optional[str|int], val_auto: Optional[str|int], *, is_year=False, is_season=False) -> str:
-    if val_user not in (None, ""):
-        if is_season and isinstance(val_user, int): return f"S{val_user:02d}"
-        return str(val_user)
-    if is_season:
-        if isinstance(val_auto, int): return f"S{val_auto:02d} (auto)"
-        return "S01 (auto)"
-    if is_year:
-        return f"{val_auto}" if val_auto else "(empty)"
-    return f"{val_auto} (auto)" if val_auto else "(empty)"
+def max_items_for(limit: int) -> int:
+    # 一半给规划缓冲，其余留给归并、系列表、状态库键等
+    return max(PLAN_MIN_ITEMS, limit // 2 // PLAN_ITEM_BYTES)
 
-def resolve_group_for_header(plan: List[PlanItem], series_group_map: Dict[str, Optional[str]]) -> str:
-    if not plan: return "-"
-    series_set = {it.series_dir for it in plan}
-    if len(series_set) == 1:
-        sd = next(iter(series_set))
-        return series_group_map.get(sd) or "-"
-    return "-"
+class SkipCount(list):
+    """有界内存模式下的跳过列表：只计数，不保存路径。"""
+    __slots__ = ('n',)
 
-def print_header(src_dir: Path, dst_root: Path, mode: str,
-                 user_title: Optional[str], user_year: Optional[str], user_season: Optional[int],
-                 resolved_title: Optional[str], resolved_year: Optional[str], resolved_season: Optional[int],
-                 group_str: str, files_count: int, extras: bool, extras_scope: str, config_path: str):
-    print("=== AniArr v3.6 ===")
-    print(f"Source      : {src_dir}")
-    print(f"Destination : {dst_root}")
-    print(f"Mode        : {mode}")
-    print(f"Title       : {fmt_auto(user_title, resolved_title)}")
-    print(f"Year        : {fmt_auto(user_year, resolved_year, is_year=True)}")
-    print(f"Season      : {fmt_auto(user_season, resolved_season, is_season=True)}")
-    print(f"Group       : {group_str}")
-    print(f"Extras      : {'on' if extras else 'off'} (scope={extras_scope})")
-    print(f"Config      : {config_path}")
-    print(f"Files       : {files_count} planned (sorted)")
-    print("====================\n")
+    def __init__(self):
+        super().__init__(); self.n = 0
+
+    def append(self, _path): self.n += 1
+    def extend(self, paths): self.n += sum(1 for _ in paths)
+    def __len__(self) -> int: return self.n
+
+class SpilledPlan:
+    """
+    顺序存放在临时文件里的计划（pickle 块）：len() 是条目数，可以反复迭代，chunks() 按块交给执行器。
+    每块带上其源文件的状态库键（src 路径 -> FileKey），blocks() 一并取出，执行时才放回 StateDB.keys。
+    """
+    def __init__(self, path: str, tmp):
+        self.path = path
+        self._tmp = tmp             # TemporaryDirectory：对象释放或进程退出时删除
+        self.count = 0
+        self._f = open(path, "wb"); self._buf: List[PlanItem] = []; self._keys: Dict[str, FileKey] = {}
+
+    def add(self, items: List[PlanItem], keys: Optional[Dict[str, FileKey]] = None):
+        self._buf.extend(items); self.count += len(items)
+        if keys: self._keys.update(keys)
+        if len(self._buf) >= PlanRuns.BLOCK: self._flush()
+
+    def _flush(self):
+        if self._buf: pickle.dump((self._buf, self._keys), self._f, pickle.HIGHEST_PROTOCOL)
+        self._buf = []; self._keys = {}
+
+    def seal(self):
+        self._flush(); self._f.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def blocks(self) -> Iterator[Tuple[List[PlanItem], Dict[str, FileKey]]]:
+        return PlanRuns.read_blocks(self.path)
+
+    def chunks(self) -> Iterator[List[PlanItem]]:
+        return (items for items, _keys in self.blocks())
+
+    def __iter__(self) -> Iterator[PlanItem]:
+        for block in self.chunks(): yield from block
+
+class PlanRuns:
+    """
+    --max-memory 的外部排序：规划时每攒满 max_items 条就按排序键排好写成一段，最后多路归并
+    （heapq.merge 稳定，相同键仍按扫描顺序，与整体排序结果一致）。每条随计划带上源文件 inode（--skip-existing 用）
+    和状态库键，内存里的 inode 表与 StateDB.keys 随每段清空。归并时按系列分组交给 finish（去重、库内跳过、解决重名），
+    结果顺序写入 SpilledPlan。临时文件放在 TMPDIR。
+    """
+    BLOCK = 1024
+
+    def __init__(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix="aniarr-plan-")
+        self.paths: List[str] = []
+
+    @staticmethod
+    def read_blocks(path: str) -> Iterator[List[PlanItem]]:
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def spill(self, items: List[PlanItem], inodes: Dict[str, int], keys: Optional[Dict[str, FileKey]] = None):
+        if not items:
+            if keys: keys.clear()
+            return
+        with STATS.phase("sort"):
+            items.sort(key=plan_sort_key)
+        recs = []
+        for it in items:
+            p = os.path.join(it.src_dir, it.src_name)
+            recs.append((it, inodes.get(p), keys.get(p) if keys else None))
+        path = os.path.join(self._tmp.name, f"run{len(self.paths)}")
+        with open(path, "wb") as f:
+            for i in range(0, len(recs), self.BLOCK):
+                pickle.dump(recs[i:i + self.BLOCK], f, pickle.HIGHEST_PROTOCOL)
+        self.paths.append(path)
+        STATS.count("spill")
+        items.clear(); inodes.clear()
+        if keys: keys.clear()
+        PARSER.clear()              # 解析缓存同样随文件数增长
+
+    def merge(self, finish) -> SpilledPlan:
+        out = SpilledPlan(os.path.join(self._tmp.name, "plan"), self._tmp)
+        runs = [itertools.chain.from_iterable(self.read_blocks(p)) for p in self.paths]
+        merged = heapq.merge(*runs, key=lambda r: r[0].sort_key)
+        for _series, grp in itertools.groupby(merged, key=lambda r: r[0].sort_key[0]):
+            recs = list(grp)
+            out.add(finish(recs), {os.path.join(it.src_dir, it.src_name): key for it, _ino, key in recs if key})
+        out.seal()
+        for p in self.paths: os.unlink(p)
+        self.paths = []
+        return out
+
+# ---------- dedupe ----------
+
+SAMPLE_BLOCK = 64 << 10                 # 抽样哈希：头/中/尾各取一块
+DEFAULT_PREFER = ["v2", "larger"]
+_RE_VERSION = re.compile(r'\d[vV](\d)(?![0-9A-Za-z])')
+
+def _hasher():
+    return hashlib.blake2b(digest_size=16)
+
+def sample_hash(path: str, size: int) -> str:
+    """大小 + 头/中/尾三块（mmap 读取）的哈希。不超过三块的文件直接哈希整个文件，结果即完整哈希。"""
+    h = _hasher(); h.update(size.to_bytes(8, "little"))
+    if size:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if size <= 3 * SAMPLE_BLOCK:
+                h.update(mm)
+            else:
+                for off in (0, size // 2 - SAMPLE_BLOCK // 2, size - SAMPLE_BLOCK):
+                    h.update(mm[off:off + SAMPLE_BLOCK])
+    return h.hexdigest()
+
+def full_hash(path: str) -> str:
+    h = _hasher()
+    buf = bytearray(COPY_CHUNK); view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n: break
+            h.update(view[:n])
+    return h.hexdigest()
+
+class HashCache:
+    """(dev, ino) -> 哈希，按 size/mtime 校验是否仍有效。有状态库时持久化到其 hashes 表，重复运行几乎不再读文件。"""
+    def __init__(self, state: Optional["StateDB"] = None):
+        self.state = state
+        self._mem: Dict[Tuple[int, int], List[Any]] = {}
+
+    def _row(self, st: os.stat_result) -> List[Any]:
+        k = (st.st_dev, st.st_ino)
+        row = self._mem.get(k)
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            cached = self.state.get_hash(st) if self.state else None
+            row = self._mem[k] = list(cached) if cached else [st.st_size, st.st_mtime_ns, None, None]
+        return row
+
+    def get(self, st: os.stat_result, full: bool) -> Optional[str]:
+        return self._row(st)[3 if full else 2]
+
+    def put(self, st: os.stat_result, full: bool, value: str):
+        row = self._row(st)
+        row[3 if full else 2] = value
+        if not full and st.st_size <= 3 * SAMPLE_BLOCK: row[3] = value
+        if self.state: self.state.put_hash(st, row[2], row[3])
+
+def parse_prefer(spec) -> List[str]:
+    """"v2,group:VCB-Studio,larger" 或列表 -> 校验过的策略列表，按顺序比较。"""
+    items = spec.split(",") if isinstance(spec, str) else list(spec or [])
+    out = []
+    for p in (str(x).strip() for x in items):
+        if p in ("v2", "larger") or (p.startswith("group:") and len(p) > 6):
+            out.append(p)
+        elif p:
+            print(f"[WARN] unknown dedupe policy '{p}' (use v2, larger or group:NAME); ignored")
+    return out
+
+def _unversioned(name: str) -> str:
+    """去掉版本号："[G] X [03v2].mkv" -> "[G] X [03].mkv"。"""
+    return _RE_VERSION.sub(lambda m: m.group(0)[0], name)
+
+def _version(name: str) -> int:
+    m = _RE_VERSION.search(name)
+    return int(m.group(1)) if m else 1
+
+def _winner_key(it: PlanItem, size: int, order: int, prefer: Sequence[str]) -> Tuple:
+    key: List[Any] = []
+    for p in prefer:
+        if p == "v2":       key.append(-_version(it.src_name))
+        elif p == "larger": key.append(-size)
+        else:               key.append(0 if (parse_group_from_prefix(it.src_name) or "").strip("[]").lower() == p[6:].strip("[]").lower() else 1)
+    key.append(order)                   # 最后按计划顺序
+    return tuple(key)
+
+def _hash_groups(cands: List[Tuple[int, os.stat_result]], items: List[PlanItem], cache: HashCache, full: bool,
+                 jobs: int) -> List[List[int]]:
+    """对同一候选组计算（抽样/完整）哈希，返回哈希相同的下标组（>1 个）。"""
+    need = [(i, st) for i, st in cands if cache.get(st, full) is None]
+    fn = (lambda i, st: full_hash(str(items[i].src))) if full else (lambda i, st: sample_hash(str(items[i].src), st.st_size))
+    STATS.count("hash_full" if full else "hash_sample", len(need))
+    STATS.count("hash_cached", len(cands) - len(need))
+    if need:
+        if jobs > 1 and len(need) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(lambda a: _try_hash(fn, *a), need))
+        else:
+            results = [_try_hash(fn, i, st) for i, st in need]
+        for (i, st), h in zip(need, results):
+            if h is not None: cache.put(st, full, h)
+    by: Dict[str, List[int]] = defaultdict(list)
+    for i, st in cands:
+        h = cache.get(st, full)
+        if h is not None: by[h].append(i)
+    return [g for g in by.values() if len(g) > 1]
+
+def _try_hash(fn, i: int, st: os.stat_result) -> Optional[str]:
+    try:
+        return fn(i, st)
+    except (OSError, ValueError):
+        return None
+
+def dedupe_plan(items: List[PlanItem], prefer: Sequence[str], cache: HashCache,
+                jobs: int = 4) -> Tuple[List[PlanItem], List[Tuple[PlanItem, PlanItem, str]]]:
+    """
+    去重（在解决重名之前调用）。两类重复：
+      - 内容相同：大小相同 → 抽样哈希相同 → 完整哈希相同（不超过三块的文件抽样即完整），同一 inode 直接算相同；
+      - 同一发布的不同版本：计划目标相同、且去掉版本号（vN）后文件名相同，例如同一组的 [03] 与 [03v2]，
+        原本会得到 x 与 x_1。目标相同但名字不同的（如同组的 [NCOP] 与 [NCED] extras）只按内容判断。
+    每组按 prefer 策略（v2 / group:NAME / larger，最后按计划顺序）留一个。返回（保留的条目, [(落选, 胜出, 原因)]）。
+    """
+    stats: Dict[int, os.stat_result] = {}
+    for i, it in enumerate(items):
+        try:
+            stats[i] = os.stat(os.path.join(it.src_dir, it.src_name))
+        except OSError:
+            pass
+    STATS.count("stat", len(items))
+
+    parent = list(range(len(items)))
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]; x = parent[x]
+        return x
+    reason: Dict[int, str] = {}
+    def union(group: List[int], why: str):
+        root = find(group[0])
+        for i in group[1:]:
+            r = find(i)
+            if r != root: parent[r] = root
+            reason.setdefault(i, why); reason.setdefault(group[0], why)
+
+    by_dst: Dict[Tuple[str, str, str], List[int]] = defaultdict(list)
+    by_size: Dict[int, List[int]] = defaultdict(list)
+    by_inode: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+    for i, it in enumerate(items):
+        by_dst[(it.dst_dir, it.dst_name, _unversioned(it.src_name).lower())].append(i)
+        st = stats.get(i)
+        if st is not None:
+            if (st.st_dev, st.st_ino) in by_inode: by_inode[(st.st_dev, st.st_ino)].append(i); continue
+            by_inode[(st.st_dev, st.st_ino)].append(i)
+            by_size[st.st_size].append(i)
+    for g in by_dst.values():
+        if len(g) > 1: union(g, "other version")
+    for g in by_inode.values():
+        if len(g) > 1: union(g, "same file")
+    for g in by_size.values():
+        if len(g) < 2: continue
+        for sg in _hash_groups([(i, stats[i]) for i in g], items, cache, False, jobs):
+            if stats[sg[0]].st_size > 3 * SAMPLE_BLOCK:
+                sg_full = _hash_groups([(i, stats[i]) for i in sg], items, cache, True, jobs)
+            else:
+                sg_full = [sg]
+            for fg in sg_full:
+                union(fg, "same content")       # 同一 inode 的其它硬链接已在上面并入同一组
+
+    sets: Dict[int, List[int]] = defaultdict(list)
+    for i in range(len(items)):
+        sets[find(i)].append(i)
+    losers: Dict[int, Tuple[int, str]] = {}
+    for members in sets.values():
+        if len(members) < 2: continue
+        ranked = sorted(members, key=lambda i: _winner_key(items[i], stats[i].st_size if i in stats else 0, i, prefer))
+        for i in ranked[1:]:
+            losers[i] = (ranked[0], reason.get(i, "duplicate"))
+    kept = [it for i, it in enumerate(items) if i not in losers]
+    dups = [(items[i], items[w], why) for i, (w, why) in sorted(losers.items())]
+    STATS.count("dup", len(dups))
+    return kept, dups
+
+# ---------- executor ----------
+
+# 重名已在规划阶段解决（DestIndex），这里不再逐个 exists() 探测；
+# 只有规划之后目标处又出现了同名文件时，才会从 FileExistsError 退到编号名。
+
+def _link_no_clobber(src: Path, dst: Path) -> Path:
+    final = dst; i = 1
+    while True:
+        STATS.count("link")
+        try:
+            os.link(str(src), str(final))
+            return final
+        except FileExistsError:
+            STATS.count("collision_retry")
+            final = numbered(dst, i); i += 1
+
+def act_hardlink(src: Path, dst: Path, mkdir: bool = True) -> Tuple[bool, str, Path]:
+    try:
+        if mkdir: dst.parent.mkdir(parents=True, exist_ok=True)
+        return True, "LINK ", _link_no_clobber(src, dst)
+    except Exception as e:
+        return False, str(e), dst
+
+_RENAME_NOREPLACE = 1
+_AT_FDCWD = -100
+_renameat2 = None           # None：尚未查找；False：libc 没有 renameat2
+
+def _rename_noreplace(src: str, dst: str) -> bool:
+    """renameat2(RENAME_NOREPLACE)：目标已存在时抛 FileExistsError。不可用（非 Linux、旧 glibc、文件系统不支持）时返回 False。"""
+    global _renameat2
+    if _renameat2 is None:
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            _renameat2 = libc.renameat2
+            _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+        except (OSError, AttributeError):
+            _renameat2 = False
+    if _renameat2 is False: return False
+    import ctypes
+    if _renameat2(_AT_FDCWD, os.fsencode(src), _AT_FDCWD, os.fsencode(dst), _RENAME_NOREPLACE) == 0: return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP): return False
+    raise OSError(err, os.strerror(err), src, None, dst)
+
+def _rename_no_clobber(src: Path, dst: Path) -> Path:
+    """
+    同一文件系统内的原子改名，且不覆盖已有目标：优先 renameat2(RENAME_NOREPLACE)，目标已存在时换编号名重试；
+    不支持时退回先探测再 rename（探测与改名之间不是原子的，但中断时只会有一个名字）。
+    """
+    final = dst; i = 1
+    while True:
+        STATS.count("rename")
+        try:
+            if _rename_noreplace(str(src), str(final)): return final
+            break
+        except FileExistsError:
+            STATS.count("collision_retry")
+            final = numbered(dst, i); i += 1
+    while os.path.lexists(final):
+        final = numbered(dst, i); i += 1
+    STATS.count("stat", i); STATS.count("collision_retry", i - 1)
+    os.rename(str(src), str(final))
+    return final
+
+# ---------- move engine ----------
+
+COPY_CHUNK   = 64 << 20                 # 单次内核拷贝 64 MiB
+VERIFY_BLOCK = 1 << 20                  # 续传/校验时比较的块大小
+PART_SUFFIX  = ".aniarr-part"
+
+def fmt_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024 or unit == "GiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.2f} {unit}"
+        n /= 1024
+    return f"{n:.2f} TiB"
+
+def _copy_fd_range(fin: int, fout: int, offset: int, total: int):
+    """从 offset 拷到 total：优先 copy_file_range（可由内核/服务端完成），其次 sendfile，最后普通读写。"""
+    pos = offset
+    for method in ("copy_file_range", "sendfile", None):
+        if pos >= total: return
+        fn = getattr(os, method, None) if method else None
+        if method and fn is None: continue
+        try:
+            while pos < total:
+                count = min(COPY_CHUNK, total - pos)
+                if method == "copy_file_range":
+                    n = fn(fin, fout, count, pos, pos)
+                elif method == "sendfile":
+                    os.lseek(fout, pos, os.SEEK_SET)
+                    n = fn(fout, fin, pos, count)
+                else:
+                    os.lseek(fin, pos, os.SEEK_SET); os.lseek(fout, pos, os.SEEK_SET)
+                    buf = os.read(fin, min(count, 8 << 20))
+                    n = os.write(fout, buf) if buf else 0
+                if n == 0:
+                    raise OSError(f"unexpected EOF at {pos}/{total}")
+                pos += n
+            return
+        except OSError as e:
+            # 内核/文件系统不支持该方式（EXDEV/EINVAL/ENOSYS/EOPNOTSUPP...）→ 换下一种，从当前位置继续
+            if method is None or e.errno is None: raise
+
+def _blocks_equal(a: int, b: int, offsets: Iterable[int], size: int) -> bool:
+    for off in offsets:
+        n = min(VERIFY_BLOCK, size - off)
+        if n <= 0: continue
+        if os.pread(a, n, off) != os.pread(b, n, off):
+            return False
+    return True
+
+def copy_resumable(src: Path, dst: Path) -> Tuple[Path, int, float]:
+    """
+    跨文件系统复制：写到同目录的 .<name>.aniarr-part，完成后 fsync、抽样校验、再改名为 dst（不覆盖）。
+    临时文件已存在（上次中断）且开头与源一致时从断点续传。返回 (最终路径, 本次复制字节数, 耗时)。
+    """
+    tmp = dst.with_name(f".{dst.name}{PART_SUFFIX}")
+    t0 = time.monotonic()
+    fin = os.open(str(src), os.O_RDONLY)
+    try:
+        size = os.fstat(fin).st_size
+        fout = os.open(str(tmp), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            have = os.fstat(fout).st_size
+            if have > size or (have and not _blocks_equal(fin, fout, (0, max(0, have - VERIFY_BLOCK)), have)):
+                have = 0                        # 不是同一个源的残留，重来
+            os.ftruncate(fout, have)
+            _copy_fd_range(fin, fout, have, size)
+            os.fsync(fout)
+            mid = (size // 2) & ~(VERIFY_BLOCK - 1)
+            if os.fstat(fout).st_size != size or not _blocks_equal(fin, fout, (0, mid, max(0, size - VERIFY_BLOCK)), size):
+                raise OSError(f"verification failed for {tmp}")
+        finally:
+            os.close(fout)
+    finally:
+        os.close(fin)
+    shutil.copystat(str(src), str(tmp))
+    STATS.count("copy"); STATS.count("copy_bytes", size - have)
+    final = _rename_no_clobber(tmp, dst)
+    return final, size - have, time.monotonic() - t0
+
+def act_move(src: Path, dst: Path, mkdir: bool = True) -> Tuple[bool, str, Path]:
+    try:
+        if mkdir: dst.parent.mkdir(parents=True, exist_ok=True)
+        STATS.count("stat", 2)
+        if os.stat(src).st_dev == os.stat(dst.parent).st_dev:
+            return True, "MOVED", _rename_no_clobber(src, dst)
+        final, copied, secs = copy_resumable(src, dst)
+        STATS.count("unlink")
+        os.unlink(str(src))
+        rate = copied / secs if secs > 0 else 0.0
+        return True, f"COPY  {fmt_bytes(copied)} @ {fmt_bytes(rate)}/s", final
+    except Exception as e:
+        return False, str(e), dst
+
+# ---------- journal ----------
+
+class Journal:
+    """
+    执行日志（NDJSON，追加写）。每个操作执行前写 begin、执行后写 done/fail，崩溃后可据此续跑或撤销：
+      {"t": "run",   "ts": ..., "mode": "link"|"move", "dst_root": ...}
+      {"t": "begin", "id": 7, "op": "link", "src": ..., "dst": ...}
+      {"t": "done",  "id": 7, "final": ...}      /  {"t": "fail", "id": 7, "err": ...}
+      {"t": "undone","id": 7}
+    src/dst 一律记绝对路径。每条记录写完立即 flush（begin 在链接/移动之前进入文件，进程被杀也不丢）；
+    只有 fsync 按批进行（每 FSYNC_EVERY 条或 FSYNC_SECS 秒一次，以及关闭时）。
+    """
+    FSYNC_EVERY = 256
+    FSYNC_SECS  = 1.0
+
+    def __init__(self, path: Path, next_id: int = 0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(self.path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._next = next_id
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _write(self, rec: Dict[str, Any]):
+        self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._f.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.FSYNC_EVERY or time.monotonic() - self._last_sync >= self.FSYNC_SECS:
+            self.sync()
+
+    def sync(self):
+        self._f.flush(); os.fsync(self._f.fileno())
+        self._unsynced = 0; self._last_sync = time.monotonic()
+
+    def run(self, mode: str, dst_root: Path):
+        with self._lock:
+            self._write({"t": "run", "ts": time.time(), "mode": mode, "dst_root": os.path.abspath(dst_root)})
+
+    def begin(self, op: str, src: Path, dst: Path) -> int:
+        with self._lock:
+            seq = self._next; self._next += 1
+            self._write({"t": "begin", "id": seq, "op": op, "src": os.path.abspath(src), "dst": os.path.abspath(dst)})
+            return seq
+
+    def end(self, seq: int, ok: bool, how: str, final: Path):
+        with self._lock:
+            if ok: self._write({"t": "done", "id": seq, "final": os.path.abspath(final)})
+            else:  self._write({"t": "fail", "id": seq, "err": how})
+
+    def mark(self, t: str, seq: int, **extra):
+        with self._lock:
+            self._write({"t": t, "id": seq, **extra})
+
+    def close(self):
+        with self._lock:
+            self.sync(); self._f.close()
+
+def read_journal(path: Path) -> Tuple[Dict[int, Dict[str, Any]], int]:
+    """读取日志，返回 ({id: 操作}, 下一个可用 id)。操作的 state 为 begin/done/fail/undone。末尾残缺的行忽略。"""
+    ops: Dict[int, Dict[str, Any]] = {}
+    try:
+        f = open(path, encoding="utf-8")
+    except OSError:
+        return ops, 0
+    with f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            t, seq = rec.get("t"), rec.get("id")
+            if t == "begin":
+                ops[seq] = {"op": rec["op"], "src": rec["src"], "dst": rec["dst"], "state": "begin", "final": None}
+            elif seq in ops and t in ("done", "fail", "undone"):
+                ops[seq]["state"] = t
+                if t == "done": ops[seq]["final"] = rec.get("final")
+    return ops, (max(ops) + 1 if ops else 0)
+
+def _op_landed(op: Dict[str, Any]) -> bool:
+    """begin 之后没有结果记录（执行中崩溃）：看目标是否已经落地。"""
+    src, dst = op["src"], op["dst"]
+    try:
+        if op["op"] == "link":
+            return os.path.samefile(src, dst)
+        return not os.path.lexists(src) and os.path.exists(dst)
+    except OSError:
+        return False
+
+def open_resume(path: Path, dry_run: bool = False) -> Tuple[Optional[Journal], set]:
+    """
+    --resume：返回（追加写的 Journal，已完成的源文件绝对路径集合）。只有执行中断的那几条才需要 stat 确认。
+    dry_run 时只读日志，不打开也不写入（Journal 为 None）。
+    """
+    ops, next_id = read_journal(path)
+    journal = None if dry_run else Journal(path, next_id)
+    done: set = set()
+    for seq, op in ops.items():
+        if op["state"] == "begin" and _op_landed(op):
+            op["state"], op["final"] = "done", op["dst"]
+            if journal: journal.mark("done", seq, final=op["dst"])
+        if op["state"] == "done":
+            done.add(op["src"])
+    return journal, done
+
+def _prune_empty_dirs(path: Path, stop: Path):
+    """删除 path 起向上的空目录，直到 stop（不含）。"""
+    stop = Path(os.path.abspath(stop))
+    d = Path(os.path.abspath(path))
+    while d != stop and stop in d.parents:
+        try:
+            d.rmdir()
+        except OSError:
+            return
+        d = d.parent
+
+def undo_journal(path: Path) -> Tuple[int, int]:
+    """
+    --undo：按相反顺序撤销日志中已完成的操作。硬链接只在与源文件仍是同一 inode 时删除（不会删掉唯一副本）；
+    移动则把文件移回原位置（不覆盖）。撤销结果追加写回同一日志，重复执行是安全的。
+    """
+    ops, next_id = read_journal(path)
+    roots: List[Path] = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if rec.get("t") == "run" and rec.get("dst_root"): roots.append(Path(rec["dst_root"]))
+    except OSError as e:
+        print(f"[ERROR] cannot read journal '{path}': {e}"); return 0, 1
+    journal = Journal(path, next_id)
+    ok = fail = 0
+    try:
+        for seq in sorted(ops, reverse=True):
+            op = ops[seq]
+            if op["state"] == "begin" and _op_landed(op):
+                op["state"], op["final"] = "done", op["dst"]
+            if op["state"] != "done" or not op["final"]: continue
+            src, final = Path(op["src"]), Path(op["final"])
+            try:
+                if op["op"] == "link":
+                    if os.path.lexists(final):
+                        if not (os.path.exists(src) and os.path.samefile(src, final)):
+                            raise OSError(f"{final} is no longer a link of {src}; left in place")
+                        os.unlink(final)
+                    how = "UNLINK"
+                else:
+                    src.parent.mkdir(parents=True, exist_ok=True)
+                    ok_move, err, _back = act_move(final, src, mkdir=False)
+                    if not ok_move: raise OSError(err)
+                    how = "RESTORE"
+                journal.mark("undone", seq)
+                ok += 1; print(wrap_line(f"[{how}] {final}"))
+                root = next((r for r in roots if r in final.parents), None)
+                if root: _prune_empty_dirs(final.parent, root)
+            except Exception as e:
+                fail += 1; print(wrap_line(f"[FAIL] {final} :: {e}"))
+    finally:
+        journal.close()
+    print(f"\nUndo done. OK={ok}  FAIL={fail}")
+    return ok, fail
+
+ActFn = Any   # (src, dst, mkdir) -> (ok, how, final)
+
+class PlanExecutor:
+    """
+    执行计划：
+    - 所有目标目录在开始前各创建一次，act_* 不再逐条 mkdir；
+    - jobs > 1 时用线程池并发执行链接/移动（目标相同的条目归入同一任务串行执行，避免互相抢名字）；
+    - 结果严格按计划顺序输出（计划已按系列排序），状态库也只在主线程写入；
+    - 给了 journal 时，每个操作前后都写日志（见 Journal）；
+    - 给了 stop 时，每个操作前检查，返回真后不再执行剩下的条目（--work 租约被收回）。
+    act_fn 可替换，默认按 move 选择 act_move / act_hardlink。
+    """
+    STOPPED = "stopped"
+
+    def __init__(self, dst_root: Path, move: bool, jobs: int = 1,
+                 state: Optional[StateDB] = None, act_fn: Optional[ActFn] = None,
+                 journal: Optional[Journal] = None, stop: Optional[Callable[[], bool]] = None):
+        self.dst_root = dst_root
+        self.move = move
+        self.jobs = max(1, jobs or 1)
+        self.state = state
+        self.journal = journal
+        self.act_fn = act_fn or (act_move if move else act_hardlink)
+        self.stop = stop
+        self.failed: List[PlanItem] = []       # 本执行器失败过的条目（--serve 按请求统计）
+        self._made_dirs: set = set()
+
+    def prepare_dirs(self, plan: List[PlanItem]) -> Dict[str, str]:
+        """创建尚未创建过的目标目录，返回 {目录: 错误信息}。"""
+        errors: Dict[str, str] = {}
+        for d in sorted({it.dst_dir for it in plan}, key=lambda s: s.count(os.sep)):
+            if d in self._made_dirs: continue
+            STATS.count("mkdir")
+            try:
+                os.makedirs(d, exist_ok=True)
+                self._made_dirs.add(d)
+            except OSError as e:
+                errors[d] = str(e)
+        return errors
+
+    def _run_group(self, items: List[PlanItem]) -> List[Tuple[bool, str, Path]]:
+        if self.journal is None and self.stop is None:
+            return [self.act_fn(it.src, it.dst, False) for it in items]
+        out = []
+        op = "move" if self.move else "link"
+        for it in items:
+            if self.stop is not None and self.stop():
+                out.append((False, self.STOPPED, it.dst)); continue
+            if self.journal is None:
+                out.append(self.act_fn(it.src, it.dst, False)); continue
+            seq = self.journal.begin(op, it.src, it.dst)
+            res = self.act_fn(it.src, it.dst, False)
+            self.journal.end(seq, *res)
+            out.append(res)
+        return out
+
+    def _results(self, plan: List[PlanItem], dir_errors: Dict[str, str]) -> Iterator[Tuple[PlanItem, Tuple[bool, str, Path]]]:
+        runnable = [it for it in plan if it.dst_dir not in dir_errors]
+        groups: Dict[Tuple[str, str], List[PlanItem]] = {}
+        for it in runnable:
+            groups.setdefault((it.dst_dir, it.dst_name), []).append(it)
+        pool = None
+        if self.jobs > 1 and len(groups) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="aniarr")
+            futures = {dst: pool.submit(self._run_group, g) for dst, g in groups.items()}
+            fetch = lambda dst: futures[dst].result()
+        else:
+            fetch = lambda dst: self._run_group(groups[dst])
+        done: Dict[int, Tuple[bool, str, Path]] = {}
+        try:
+            for it in plan:
+                err = dir_errors.get(it.dst_dir)
+                if err is not None:
+                    yield it, (False, err, it.dst); continue
+                if id(it) not in done:
+                    key = (it.dst_dir, it.dst_name)
+                    done.update({id(x): res for x, res in zip(groups[key], fetch(key))})
+                yield it, done.pop(id(it))
+        finally:
+            if pool is not None: pool.shutdown(wait=True)
+
+    def run(self, plan: List[PlanItem], summary: bool = True) -> Tuple[int, int]:
+        ok = fail = 0
+        touched = set() if JELLYFIN.enabled else None
+        if self.state: self.state.record_plan(plan, self.dst_root)
+        if self.journal: self.journal.run("move" if self.move else "link", self.dst_root)
+        with STATS.phase("execute"):
+            for it, (success, how, final_path) in self._results(plan, self.prepare_dirs(plan)):
+                if not success and how == self.STOPPED:
+                    print(f"[WARN] stopped before {it.src_name}; the remaining items were not executed"); break
+                if success:
+                    ok += 1; print(wrap_line(f"[{how}] -> {final_path}"))
+                    if self.state: self.state.mark_done(it.src, final_path, self.dst_root)
+                    if touched is not None:
+                        # 季目录；系列级 extras（<系列>/trailers）报系列目录
+                        touched.add(os.path.dirname(it.dst_dir) if it.kind == 'EXTRA' else it.dst_dir)
+                else:
+                    fail += 1; self.failed.append(it); print(wrap_line(f"[FAIL] {it.src_name} :: {how}"))
+            if self.state: self.state.flush()
+            if self.journal: self.journal.sync()
+        if touched: JELLYFIN.add(touched)
+        STATS.count("files_ok", ok); STATS.count("files_fail", fail)
+        if summary: print(f"\nDone. OK={ok}  FAIL={fail}")
+        return ok, fail
+
+def execute_plan(plan: List[PlanItem], dst_root: Path, move: bool, state: Optional[StateDB] = None,
+                 jobs: int = 1, journal: Optional[Journal] = None,
+                 stop: Optional[Callable[[], bool]] = None) -> Tuple[int, int]:
+    ex = PlanExecutor(dst_root, move, jobs=jobs, state=state, journal=journal, stop=stop)
+    if not isinstance(plan, SpilledPlan):
+        return ex.run(plan)
+    # --max-memory：计划在临时文件里，逐块执行
+    ok = fail = 0
+    for chunk, keys in plan.blocks():
+        if state: state.keys.update(keys)
+        o, f = ex.run(chunk, summary=False); ok += o; fail += f
+        if state:
+            for p in keys: state.keys.pop(p, None)
+    print(f"\nDone. OK={ok}  FAIL={fail}")
+    return ok, fail
+
+# ---------- jellyfin refresh ----------
+
+JELLYFIN_DEBOUNCE = 5.0     # 这么多秒内没有新目录才发送
+JELLYFIN_MAX_DELAY = 60.0   # 持续有新文件时最多攒这么久
+JELLYFIN_BATCH = 200        # 每个请求最多的路径数
+JELLYFIN_RETRIES = 4        # 失败重试次数，间隔 1, 2, 4, 8 秒
+JELLYFIN_TIMEOUT = 10.0
+
+def collapse_dirs(paths: Iterable[str]) -> List[str]:
+    """去掉位于其他路径之下的路径（系列目录已在列表中时不再单独列它的季目录）。"""
+    out: List[str] = []
+    for p in sorted(paths):
+        if out and (p == out[-1] or p.startswith(out[-1].rstrip(os.sep) + os.sep)): continue
+        out.append(p)
+    return out
+
+class JellyfinNotifier:
+    """
+    执行后只让 Jellyfin 刷新实际写入过的目录（POST /Library/Media/Updated），不必整库扫描。
+    PlanExecutor 每次执行完把写入的季目录（系列级 extras 为系列目录）交给 add()；后台线程在 debounce 秒内
+    没有新目录时（最长 max_delay 秒）合并成批发送，网络错误、5xx、429 按指数退避重试。
+    未配置时 add() 直接返回；进程退出前 close() 立即发出剩余目录。
+    """
+    def __init__(self):
+        self.enabled = False
+        self._paths: set = set()
+        self._first = self._last = 0.0
+        self._closing = False
+        self._cv = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def configure(self, url: str, api_key: str, debounce: float = JELLYFIN_DEBOUNCE,
+                  path_map: Optional[Dict[str, str]] = None, retries: int = JELLYFIN_RETRIES):
+        self.url = url.rstrip("/") + "/Library/Media/Updated"
+        self.api_key = api_key
+        self.debounce = max(0.0, float(debounce))
+        self.retries = max(0, int(retries))
+        # 本机路径 -> Jellyfin 看到的路径（容器挂载点不同时），最长前缀优先
+        self.path_map = sorted(((os.path.abspath(k), v) for k, v in (path_map or {}).items()),
+                               key=lambda kv: -len(kv[0]))
+        self.enabled = True
+        self._thread = threading.Thread(target=self._run, name="aniarr-jellyfin", daemon=True)
+        self._thread.start()
+
+    def map_path(self, p: str) -> str:
+        for src, dst in self.path_map:
+            if p == src or p.startswith(src + os.sep):
+                return dst.rstrip("/") + p[len(src):].replace(os.sep, "/")
+        return p
+
+    def add(self, dirs: Iterable[str]):
+        if not self.enabled: return
+        new = {self.map_path(os.path.abspath(d)) for d in dirs}
+        if not new: return
+        with self._cv:
+            now = time.monotonic()
+            if not self._paths: self._first = now
+            self._paths |= new; self._last = now
+            self._cv.notify()
+
+    def _take(self) -> Optional[List[str]]:
+        with self._cv:
+            while True:
+                if self._paths:
+                    now = time.monotonic()
+                    due = min(self._last + self.debounce, self._first + JELLYFIN_MAX_DELAY)
+                    if self._closing or now >= due:
+                        paths = collapse_dirs(self._paths); self._paths = set()
+                        return paths
+                    self._cv.wait(due - now)
+                elif self._closing:
+                    return None
+                else:
+                    self._cv.wait()
+
+    def _run(self):
+        while True:
+            paths = self._take()
+            if paths is None: return
+            for i in range(0, len(paths), JELLYFIN_BATCH):
+                self._post(paths[i:i + JELLYFIN_BATCH])
+
+    def _post(self, paths: List[str]) -> bool:
+        body = json.dumps({"Updates": [{"Path": p, "UpdateType": "Created"} for p in paths]}, ensure_ascii=False)
+        req = urllib.request.Request(self.url, data=body.encode("utf-8"), method="POST", headers={
+            "Content-Type": "application/json", "Authorization": f'MediaBrowser Token="{self.api_key}"'})
+        delay, err = 1.0, ""
+        for attempt in range(self.retries + 1):
+            STATS.count("jellyfin_request")
+            try:
+                with urllib.request.urlopen(req, timeout=JELLYFIN_TIMEOUT):
+                    pass
+                print(f"[JELLYFIN] refresh requested for {len(paths)} folder(s)", file=sys.stderr)
+                return True
+            except urllib.error.HTTPError as e:
+                err = f"HTTP {e.code} {e.reason}"
+                if e.code < 500 and e.code != 429: break      # 认证或请求错误，重试无用
+            except (urllib.error.URLError, OSError) as e:
+                err = str(getattr(e, "reason", e))
+            if attempt < self.retries:
+                time.sleep(delay); delay *= 2
+        print(f"[WARN] jellyfin refresh of {len(paths)} folder(s) failed: {err}", file=sys.stderr)
+        return False
+
+    def close(self):
+        if not self.enabled: return
+        with self._cv:
+            self._closing = True; self._cv.notify()
+        self._thread.join()
+
+JELLYFIN = JellyfinNotifier()
+
+def setup_jellyfin(args, cfg: Dict[str, Any]):
+    jf = dict(cfg.get("jellyfin") or {})
+    if args.jellyfin: jf["url"] = args.jellyfin
+    if not jf.get("url") or args.dry_run: return
+    key = jf.get("api_key") or os.environ.get("JELLYFIN_API_KEY")
+    if not key:
+        print("[WARN] jellyfin: no api_key in the config and JELLYFIN_API_KEY is not set; refresh disabled")
+        return
+    try:
+        JELLYFIN.configure(jf["url"], key, jf.get("debounce", JELLYFIN_DEBOUNCE), jf.get("path_map"),
+                           jf.get("retries", JELLYFIN_RETRIES))
+    except (TypeError, ValueError, AttributeError) as e:
+        print(f"[WARN] jellyfin: bad settings ({e}); refresh disabled"); return
+    atexit.register(JELLYFIN.close)
+
+# ---------- printing / header ----------
+
+def width() -> int: return term_width()
+
+def fmt_auto(val_user: Optional[str|int], val_auto: Optional[str|int], *, is_year=False, is_season=False) -> str:
+    if val_user not in (None, ""):
+        if is_season and isinstance(val_user, int): return f"S{val_user:02d}"
+        return str(val_user)
+    if is_season:
+        if isinstance(val_auto, int): return f"S{val_auto:02d} (auto)"
+        return "S01 (auto)"
+    if is_year:
+        return f"{val_auto}" if val_auto else "(empty)"
+    return f"{val_auto} (auto)" if val_auto else "(empty)"
+
+def resolve_group_for_header(plan: List[PlanItem], series_group_map: Dict[str, Optional[str]]) -> str:
+    if not plan: return "-"
+    series_set = {it.series_dir for it in plan}
+    if len(series_set) == 1:
+        sd = next(iter(series_set))
+        return series_group_map.get(sd) or "-"
+    return "-"
+
+def print_header(src_dir: Path, dst_root: Path, mode: str,
+                 user_title: Optional[str], user_year: Optional[str], user_season: Optional[int],
+                 resolved_title: Optional[str], resolved_year: Optional[str], resolved_season: Optional[int],
+                 group_str: str, files_count: int, extras: bool, extras_scope: str, config_path: str):
+    print("=== AniArr v3.6 ===")
+    print(f"Source      : {src_dir}")
+    print(f"Destination : {dst_root}")
+    print(f"Mode        : {mode}")
+    print(f"Title       : {fmt_auto(user_title, resolved_title)}")
+    print(f"Year        : {fmt_auto(user_year, resolved_year, is_year=True)}")
+    print(f"Season      : {fmt_auto(user_season, resolved_season, is_season=True)}")
+    print(f"Group       : {group_str}")
+    print(f"Extras      : {'on' if extras else 'off'} (scope={extras_scope})")
+    print(f"Config      : {config_path}")
+    print(f"Files       : {files_count} planned (sorted)")
+    print("====================\n")
+
+def show_header(src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any],
+                plan: List[PlanItem], sg: Dict[str, Optional[str]]):
+    first = next(iter(plan), None)
+    rt = first.title if first else None
+    ry = first.year if first else None
+    rs = first.season if first else None
+    print_header(
+        src_dir, dst_root,
+        "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK"),
+        args.title, args.year, args.season,
+        rt, ry, rs,
+        resolve_group_for_header(plan, sg), len(plan), (not args.no_extras),
+        cfg.get("extras_scope") or args.extras_scope, cfg["_config_path"]
+    )
 
 def _prefix_for_item(it) -> str:
     if it.kind == 'EXTRA':
@@ -456,115 +2721,286 @@ def _prefix_for_item(it) -> str:
     else:
         return "[SUB]"
 
+_RE_LEAD_GROUP = re.compile(r'\[[^\]]+\]')
+
 def _calc_indent_for_item(prefix: str, src_name: str) -> int:
     """
     动态计算第二行缩进，使 `->` 对齐到：
     <prefix> <[Group]> 之后（再加一个空格），然后整体再 -2。
     """
     # 匹配开头字幕组 [ ... ]，例如：[XKsub&VCB-Studio]
-    m = re.match(r'\[[^\]]+\]', src_name)
+    m = _RE_LEAD_GROUP.match(src_name)
     group_end = m.end() if m else 0  # 没组名则为 0
     indent = len(prefix) + 1 + group_end + 1 - 3
     if indent < 2:
         indent = max(2, len(prefix) + 1)  # 合理下限
     return indent
 
-def print_plan(items: List[PlanItem], dst_root: Path):
-    term_w = width()
+def render_plan(items: Iterable[PlanItem], dst_root: Path, term_w: Optional[int] = None) -> Iterator[str]:
+    if term_w is None: term_w = width()
+    root = str(dst_root)
+    root = '' if root == '.' else root if root.endswith(os.sep) else root + os.sep
     for it in items:
         prefix = _prefix_for_item(it)
+        src_name = it.src_name
 
-        # 目标相对路径
-        try:
-            rel = it.dst.relative_to(dst_root)
-        except Exception:
-            rel = it.dst
+        # 目标相对路径（dst_dir 就是 dst_root 拼出来的，按字符串前缀截取即可）
+        d = it.dst_dir + os.sep
+        rel = (d[len(root):] if d.startswith(root) else d) + it.dst_name
 
         # 第一行：<prefix> <原文件名>
-        head = f"{prefix} {it.src.name}"
-        print(wrap_line(head, term_w))
+        yield wrap_line(f"{prefix} {src_name}", term_w)
 
         # 第二行：按该条目单独计算缩进，并对后续折行保持该缩进
-        indent_cols = _calc_indent_for_item(prefix, it.src.name)
-        indent_spaces = " " * indent_cols
-        tail = f"{indent_spaces}-> {rel}"
-        print(wrap_line(tail, term_w, indent=indent_cols))
+        indent_cols = _calc_indent_for_item(prefix, src_name)
+        tail = f"{' ' * indent_cols}-> {rel}"
+        yield wrap_line(tail, term_w, indent=indent_cols)
 
-def print_skipped(skipped: Dict[str, List[str]]):
-    if not skipped: return
+def plan_record(it: PlanItem) -> Dict[str, Any]:
+    return {"src": str(it.src), "dst": str(it.dst), "kind": it.kind, "series": it.series_dir,
+            "season": it.season, "ep": it.ep, "lang": it.lang, "extra_folder": it.extra_folder}
+
+def render_ndjson(items: Iterable[PlanItem]) -> Iterator[str]:
+    for it in items:
+        yield json.dumps(plan_record(it), ensure_ascii=False)
+
+PLAN_FORMATS = ("text", "ndjson")
+
+def print_plan(items: Iterable[PlanItem], dst_root: Path, fmt: str = "text", out=None):
+    lines = render_ndjson(items) if fmt == "ndjson" else render_plan(items, dst_root)
+    with STATS.phase("render"):
+        write_lines(lines, out)
+
+# 这些原因通常数量巨大，只打印计数
+COUNT_ONLY_REASONS = {"DONE": "already executed (state db)", "JOURNAL": "completed in resumed journal",
+                      "EXISTS": "already in the destination library"}
+
+def render_skipped(skipped: Dict[str, List[str]]) -> Iterator[str]:
     w = width()
-    print("\n--- Skipped ---")
+    yield "\n--- Skipped ---"
     for reason in sorted(skipped.keys()):
         paths = skipped[reason]
         if not paths: continue
-        print(f"{reason} ({len(paths)}):")
+        if reason in COUNT_ONLY_REASONS:
+            yield f"{reason} ({len(paths)}): {COUNT_ONLY_REASONS[reason]}"; continue
+        if isinstance(paths, SkipCount):
+            yield f"{reason} ({len(paths)}): not listed (--max-memory; use -v to list)"; continue
+        yield f"{reason} ({len(paths)}):"
         for name in sorted(paths, key=str.lower):
-            print(wrap_line(f"  {name}", w, indent=4))
+            yield wrap_line(f"  {name}", w, indent=4)
+
+def print_skipped(skipped: Dict[str, List[str]]):
+    if not skipped: return
+    write_lines(render_skipped(skipped))
+
+# ---------- plan file ----------
+
+PLAN_FILE_VERSION = 1
+PLAN_STAT_JOBS = 16         # 校验源文件身份时并发 stat 的线程数（网络挂载上主要是在等往返）
+
+def _stat_key(path: str) -> Optional[FileKey]:
+    try:
+        return StateDB.key_of(os.stat(path))
+    except OSError:
+        return None
+
+def stat_keys(paths: Sequence[str], jobs: int = PLAN_STAT_JOBS) -> List[Optional[FileKey]]:
+    STATS.count("stat", len(paths))
+    if len(paths) > 1 and jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(jobs, len(paths))) as pool:
+            return list(pool.map(_stat_key, paths, chunksize=256))
+    return [_stat_key(p) for p in paths]
+
+def _open_plan_file(path: Path, mode: str, gz: bool):
+    # 以 .gz 结尾时压缩（几十万条的计划能小一个数量级）
+    if gz:
+        import gzip
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def save_plan(path: Path, plan: Iterable[PlanItem], src_dir: Path, dst_root: Path, move: bool,
+              state: Optional[StateDB] = None) -> int:
+    """
+    --save-plan：NDJSON 计划文件。第一行是表头 {"t": "plan", "version", "source", "destination", "mode", ...}，
+    之后每行一条：plan_record 的字段、重建 PlanItem 所需的系列字段，以及源文件身份 id = [dev, ino, size, mtime_ns]；
+    最后一行是结尾 {"t": "end", "files": 实际写入的条数}（写完才知道有几个源文件 stat 不到）。
+    src/dst 为绝对路径，目标名是解决重名后的最终名字。返回写入的条数（stat 不到的源文件不写入）。
+    """
+    plan = plan if isinstance(plan, (list, SpilledPlan)) else list(plan)
+    known = state.keys if state else {}
+    n, lost = 0, 0
+    tmp = path.with_name(f".{path.name}.tmp")
+    with _open_plan_file(tmp, "w", str(path).endswith(".gz")) as f:
+        f.write(json.dumps({"t": "plan", "version": PLAN_FILE_VERSION, "source": os.path.abspath(src_dir),
+                            "destination": os.path.abspath(dst_root), "mode": "move" if move else "link",
+                            "created": time.time()}, ensure_ascii=False) + "\n")
+        blocks = plan.blocks() if isinstance(plan, SpilledPlan) else [(plan, known)]
+        for chunk, known in blocks:
+            srcs = [os.path.join(it.src_dir, it.src_name) for it in chunk]
+            keys = {p: known.get(p) for p in srcs}
+            missing = [p for p, k in keys.items() if k is None]
+            if missing: keys.update(zip(missing, stat_keys(missing)))
+            for it, p in zip(chunk, srcs):
+                key = keys.get(p)
+                if key is None:
+                    lost += 1; continue
+                rec = plan_record(it)
+                # 路径一律写绝对路径：应用时的工作目录与保存时无关
+                rec.update(src=os.path.abspath(p), dst=os.path.abspath(os.path.join(it.dst_dir, it.dst_name)),
+                           id=list(key), name=it.series_name, title=it.title, year=it.year, extra_token=it.extra_token)
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n"); n += 1
+        f.write(json.dumps({"t": "end", "files": n}) + "\n")
+    os.replace(tmp, path)
+    if lost: print(f"[WARN] {lost} source file(s) vanished while saving the plan; left out")
+    return n
+
+def load_plan(path: Path) -> Tuple[Dict[str, Any], List[Tuple[PlanItem, FileKey]]]:
+    with open(path, "rb") as f:
+        gz = f.read(2) == b"\x1f\x8b"
+    with _open_plan_file(path, "r", gz) as f:
+        head = json.loads(f.readline() or "{}")
+        if head.get("t") != "plan":
+            raise ValueError("not an AniArr plan file")
+        if head.get("version") != PLAN_FILE_VERSION:
+            raise ValueError(f"unsupported plan file version {head.get('version')}")
+        items = []
+        end = None
+        for line in f:
+            r = json.loads(line)
+            if r.get("t") == "end":
+                end = r; break
+            it = PlanItem(r["src"], r["dst"], r["kind"], r["series"], r["name"], r["title"], r["year"],
+                          r["season"], r["ep"], r["lang"], r["extra_folder"], r["extra_token"])
+            items.append((it, tuple(r["id"])))
+    if end is None:
+        raise ValueError("plan file is truncated (no end record)")
+    if end.get("files") != len(items):
+        raise ValueError(f"plan file lists {end.get('files')} files but holds {len(items)}")
+    return head, items
+
+def report_saved_plan(args, plan, src_dir: Path, dst_root: Path, cfg: Dict[str, Any]):
+    n = save_plan(Path(args.save_plan), plan, src_dir, dst_root, args.move, cfg.get("_state"))
+    print(f"\nPlan saved: {args.save_plan} ({n} files). Apply with: --apply-plan {args.save_plan}")
+
+def apply_plan(path: Path, args, cfg: Dict[str, Any], plan_out=None) -> int:
+    """
+    --apply-plan：直接执行保存的计划，不扫描、不解析。每个源文件只做一次 stat 比对身份（并发进行），
+    不存在或 (dev, ino, size, mtime) 变了的记为 MISSING / CHANGED 不执行。模式以计划文件为准。返回失败数。
+    """
+    try:
+        head, loaded = load_plan(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[ERROR] cannot read plan file '{path}': {e}"); return 1
+    dst_root, move = Path(head["destination"]), head["mode"] == "move"
+    if args.move and not move:
+        print("[WARN] --move ignored: the plan was saved for hardlinking")
+    with STATS.phase("verify"):
+        now = stat_keys([str(it.src) for it, _key in loaded])
+    plan: List[PlanItem] = []
+    skipped: Dict[str, List[str]] = defaultdict(list)
+    state: Optional[StateDB] = cfg.get("_state")
+    for (it, key), cur in zip(loaded, now):
+        if cur is None: skipped["MISSING"].append(str(it.src)); continue
+        if cur != key: skipped["CHANGED"].append(str(it.src)); continue
+        if state: state.keys[str(it.src)] = cur
+        plan.append(it)
+    created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(head.get("created", 0)))
+    print(f"=== AniArr apply: {path} (saved {created}) ===")
+    print(f"Source      : {head['source']}")
+    print(f"Destination : {dst_root}")
+    print(f"Mode        : {'DRY-RUN' if args.dry_run else ('MOVE' if move else 'HARDLINK')}")
+    print(f"Files       : {len(plan)} of {len(loaded)} unchanged\n")
+    print_plan(plan, dst_root, args.format, plan_out); print_skipped(skipped)
+    if args.dry_run:
+        print("\nSummary: dry-run only."); return 0
+    _ok, fail = execute_plan(plan, dst_root, move, state, jobs=args.jobs, journal=cfg.get("_journal"))
+    return fail
 
 # ---------- interactive (two-stage) ----------
 
-def stage1_confirm(src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any]) -> Tuple[bool, Path, List[PlanItem], Dict[str, Optional[str]], Dict[str, List[str]]]:
-    plan, sg, skipped = build_plan(
-        src_dir, dst_root, args.season, args.title, args.year,
-        (not args.no_extras), args.extras_scope, cfg["rules"], cfg["fallback_category"], cfg.get("extras_scope")
-    )
-    rt = plan[0].title if plan else None
-    ry = plan[0].year if plan else None
-    rs = plan[0].season if plan else None
-    group_str = resolve_group_for_header(plan, sg)
-    eff_scope = cfg.get("extras_scope") or args.extras_scope
+class PlanSession:
+    """
+    交互确认期间的规划缓存：源目录只扫描一次（文件名解析另有 PARSER 缓存）。
+    - 标题/年份/季/extras 的修改：从缓存的条目重算名字，不再访问磁盘；
+    - 更换目标根目录：只把路径重定位到新根目录，再按新目录的列表解决重名；启用了状态库、--skip-existing
+      或 --dedupe 时结果取决于目标目录，完整重新规划；新旧目标位于源目录内时重新扫描；
+    - 切换 move/hardlink：不需要重新规划。
+    """
+    def __init__(self, src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any]):
+        self.src_dir = src_dir; self.dst_root = dst_root
+        self.args = args; self.cfg = cfg
+        self._indexes: Dict[str, DestIndex] = {}
+        self._scan()
+        self.replan()
 
-    print_header(
-        src_dir, dst_root,
-        "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK"),
-        args.title, args.year, args.season,
-        rt, ry, rs,
-        group_str, len(plan), (not args.no_extras), eff_scope, cfg["_config_path"]
-    )
+    def _scan(self):
+        # 总是带 extras 扫描，关闭 extras 时由 plan_entries 跳过
+        depth, ignore = scan_options(self.args, self.cfg)
+        self.entries = list(scan_tree(self.src_dir, depth, ignore, extras_on=True, exclude=(self.dst_root,)))
+
+    def _resolve(self):
+        index = self._indexes.setdefault(str(self.dst_root), DestIndex())
+        index.reset()
+        resolve_collisions(self.plan, index)
+
+    def replan(self):
+        self.plan, self.sg, self.skipped = plan_from_args(
+            self.src_dir, self.dst_root, self.args, self.cfg, entries=self.entries, resolve=False)
+        self._wanted = [it.dst.relative_to(self.dst_root) for it in self.plan]
+        self._resolve()
+
+    def rebase(self, new_root: Path):
+        if new_root == self.dst_root: return
+        old_root, self.dst_root = self.dst_root, new_root
+        src = self.src_dir.resolve()
+        if new_root.resolve().is_relative_to(src) or old_root.resolve().is_relative_to(src):
+            # 新目标位于源目录内要排除它，旧目标位于源目录内要把它扫回来
+            self._scan(); self.replan(); return
+        if self.cfg.get("_state") or self.cfg.get("_skip_existing") or self.cfg.get("_dedupe"):
+            self.replan(); return
+        for it, rel in zip(self.plan, self._wanted):
+            it.dst = new_root / rel
+        self._resolve()
+
+    def header(self):
+        show_header(self.src_dir, self.dst_root, self.args, self.cfg, self.plan, self.sg)
+
+def stage1_confirm(session: PlanSession, args, cfg: Dict[str, Any]) -> Tuple[bool, Path, List[PlanItem], Dict[str, Optional[str]], Dict[str, List[str]]]:
+    session.header()
 
     while True:
         prompt = "[Confirm 1/2] (Enter=next)  [t]itle  [y]ear  [s]eason  [d]estination  [m]ode  [x]extras  [q]uit"
         print(prompt)
         choice = input("> ").strip().lower()
         if choice in ("", "p"):
-            return True, dst_root, plan, sg, skipped
+            return True, session.dst_root, session.plan, session.sg, session.skipped
         if choice == "q":
             print("Aborted."); sys.exit(0)
         if choice == "t":
             args.title = (input("New title (blank=auto): ").strip() or None)
+            session.replan()
         elif choice == "y":
             args.year = (input("New year (blank=auto): ").strip() or None)
+            session.replan()
         elif choice == "s":
             new_s = input("New season number (blank=auto): ").strip()
             args.season = int(new_s) if new_s else None
+            session.replan()
         elif choice == "d":
-            new_r = input(f"New destination (blank to keep '{dst_root}'): ").strip()
-            if new_r: dst_root = Path(new_r)
+            new_r = input(f"New destination (blank to keep '{session.dst_root}'): ").strip()
+            if new_r: session.rebase(Path(new_r))
         elif choice == "m":
             args.move = not args.move
             print(f"Mode toggled => {'MOVE' if args.move else 'HARDLINK'}")
         elif choice == "x":
             args.no_extras = not args.no_extras
             print(f"Extras => {'on' if not args.no_extras else 'off'} (scope={cfg.get('extras_scope') or args.extras_scope})")
+            session.replan()
         else:
             print("Unknown option.")
 
-        plan, sg, skipped = build_plan(
-            src_dir, dst_root, args.season, args.title, args.year,
-            (not args.no_extras), args.extras_scope, cfg["rules"], cfg["fallback_category"], cfg.get("extras_scope")
-        )
-        rt = plan[0].title if plan else None
-        ry = plan[0].year if plan else None
-        rs = plan[0].season if plan else None
-        group_str = resolve_group_for_header(plan, sg)
-        eff_scope = cfg.get("extras_scope") or args.extras_scope
-        print_header(
-            src_dir, dst_root,
-            "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK"),
-            args.title, args.year, args.season,
-            rt, ry, rs,
-            group_str, len(plan), (not args.no_extras), eff_scope, cfg["_config_path"]
-        )
+        session.header()
 
 def stage2_confirm(dst_root: Path, args, plan: List[PlanItem], sg: Dict[str, Optional[str]], skipped: Dict[str, List[str]]) -> bool:
     print_plan(plan, dst_root); print_skipped(skipped)
@@ -582,8 +3018,1173 @@ def stage2_confirm(dst_root: Path, args, plan: List[PlanItem], sg: Dict[str, Opt
         else:
             print("Unknown option.")
 
+# ---------- watch mode ----------
+
+# 下载客户端写入中的临时后缀（qBittorrent / 浏览器 / aria2 等）
+PARTIAL_SUFFIXES = ('.!qb', '.part', '.crdownload', '.aria2', '.tmp')
+
+def is_partial(name: str) -> bool:
+    return name.lower().endswith(PARTIAL_SUFFIXES)
+
+def entry_for_path(src_dir: Path, path: str) -> ScanEntry:
+    """为单个文件构造 ScanEntry（watch 模式下文件不是通过 scan_tree 得到的）。"""
+    rel = os.path.relpath(path, src_dir)
+    parts = rel.split(os.sep)
+    extras = any(p.lower() in EXTRAS_DIRS for p in parts[:-1])
+    kind = 'file' if os.path.isfile(path) else 'other'
+    return ScanEntry(path, parts[-1], rel, len(parts) - 1, kind, extras, None)
+
+class _WatchBackend:
+    """监视后端公共部分：与 scan_tree 相同的深度 / ignore / extras / exclude 规则决定哪些目录需要关注。"""
+    name = "?"
+
+    def __init__(self, root: Path, max_depth: int, ignore: Optional[Sequence[str]],
+                 extras_on: bool, exclude: Iterable[Path]):
+        self.max_depth = max_depth
+        self.ignore_re = compile_ignore(ignore)
+        self.extras_on = extras_on
+        self.excluded = {os.path.abspath(p) for p in exclude}
+        self.initial: List[str] = self._scan_dir(str(root), 0)
+
+    def _ignored(self, name: str) -> bool:
+        return self.ignore_re is not None and self.ignore_re.match(name) is not None
+
+    def _descend_ok(self, path: str, name: str, depth: int) -> bool:
+        if self._ignored(name): return False
+        if name.lower() in EXTRAS_DIRS:
+            if not self.extras_on: return False
+        elif depth > self.max_depth:
+            return False
+        return os.path.abspath(path) not in self.excluded
+
+    def _register_dir(self, path: str, depth: int, names: set):
+        pass
+
+    def _known_dir(self, path: str) -> bool:
+        return False
+
+    def _scan_dir(self, path: str, depth: int) -> List[str]:
+        """登记目录（及其可进入的子目录），返回其中的文件路径。"""
+        files: List[str] = []; names = set()
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    names.add(e.name)
+                    if self._ignored(e.name): continue
+                    try:
+                        is_dir = e.is_dir()
+                    except OSError:
+                        continue
+                    if is_dir:
+                        if self._descend_ok(e.path, e.name, depth + 1) and not self._known_dir(e.path):
+                            files.extend(self._scan_dir(e.path, depth + 1))
+                    else:
+                        files.append(e.path)
+        except OSError:
+            return files
+        self._register_dir(path, depth, names)
+        return files
+
+    def poll(self, timeout: Optional[float]) -> List[str]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class PollBackend(_WatchBackend):
+    """mtime 轮询：每轮只 stat 已知目录，目录 mtime 变化（有文件新增/改名）时才重新列出。"""
+    name = "polling"
+
+    def __init__(self, *a, **kw):
+        self.dirs: Dict[str, Tuple[int, int, set]] = {}    # dir -> (depth, mtime_ns, names)
+        super().__init__(*a, **kw)
+
+    def _register_dir(self, path: str, depth: int, names: set):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        self.dirs[path] = (depth, mtime, names)
+
+    def _known_dir(self, path: str) -> bool:
+        return path in self.dirs
+
+    def poll(self, timeout: Optional[float]) -> List[str]:
+        time.sleep(timeout if timeout is not None else 5.0)
+        out: List[str] = []
+        for d, (depth, mtime, names) in list(self.dirs.items()):
+            try:
+                cur = os.stat(d).st_mtime_ns
+            except OSError:
+                self.dirs.pop(d, None); continue
+            if cur == mtime: continue
+            for p in self._scan_dir(d, depth):
+                if os.path.dirname(p) != d or os.path.basename(p) not in names:
+                    out.append(p)
+        return out
+
+class InotifyBackend(_WatchBackend):
+    """Linux inotify（通过 ctypes 调用 libc，无额外依赖）。网络挂载（NFS/SMB）上看不到远端改动，请用 --poll。"""
+    name = "inotify"
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+    def __init__(self, root: Path, *a, **kw):
+        import ctypes, ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wds: Dict[int, Tuple[str, int]] = {}
+        self.watched: set = set()
+        self.root = root
+        super().__init__(root, *a, **kw)
+
+    def _register_dir(self, path: str, depth: int, names: set):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd >= 0:
+            self.wds[wd] = (path, depth); self.watched.add(path)
+
+    def _known_dir(self, path: str) -> bool:
+        return path in self.watched
+
+    def poll(self, timeout: Optional[float]) -> List[str]:
+        import select, struct
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r: return []
+        out: List[str] = []
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            off = 0
+            while off < len(data):
+                wd, mask, _cookie, length = struct.unpack_from('iIII', data, off)
+                raw = data[off + 16: off + 16 + length].rstrip(b'\0'); off += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    # 事件队列溢出：重新登记整棵树，全部文件重新进入待定
+                    for w in list(self.wds): self._libc.inotify_rm_watch(self.fd, w)
+                    self.wds.clear(); self.watched.clear()
+                    out.extend(self._scan_dir(str(self.root), 0)); continue
+                if mask & self.IN_IGNORED:
+                    gone = self.wds.pop(wd, None)
+                    if gone: self.watched.discard(gone[0])
+                    continue
+                if wd not in self.wds or not raw: continue
+                d, depth = self.wds[wd]
+                name = os.fsdecode(raw); path = os.path.join(d, name)
+                if mask & self.IN_ISDIR:
+                    # 新目录：补登记，并收下注册前已经写进去的文件
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO) and self._descend_ok(path, name, depth + 1):
+                        out.extend(self._scan_dir(path, depth + 1))
+                elif not self._ignored(name):
+                    out.append(path)
+        return out
+
+    def close(self):
+        os.close(self.fd)
+
+def open_watch_backend(root: Path, max_depth: int, ignore: Optional[Sequence[str]], extras_on: bool,
+                       exclude: Iterable[Path], force_poll: bool = False) -> _WatchBackend:
+    exclude = list(exclude)
+    if not force_poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyBackend(root, max_depth, ignore, extras_on, exclude)
+        except (OSError, AttributeError) as e:
+            print(f"[WARN] inotify unavailable ({e}); falling back to polling.")
+    return PollBackend(root, max_depth, ignore, extras_on, exclude)
+
+class SettleTracker:
+    """
+    去抖：文件在 settle 秒内 size/mtime 都不再变化、且不带下载中后缀时才算“就绪”。
+    mtime 已经早于 settle 窗口的文件（例如启动时已有的文件）立即就绪。
+    """
+    def __init__(self, settle: float):
+        self.settle = settle
+        self.pending: Dict[str, Tuple[int, int, float]] = {}   # path -> (size, mtime_ns, stable_since)
+
+    def add(self, paths: Iterable[str]):
+        for p in paths:
+            if is_partial(p): continue
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            self.pending[p] = (st.st_size, st.st_mtime_ns, min(time.time(), st.st_mtime))
+
+    def settled(self) -> List[str]:
+        now = time.time(); ready: List[str] = []
+        for p, (size, mtime, since) in list(self.pending.items()):
+            try:
+                st = os.stat(p)
+            except OSError:
+                del self.pending[p]; continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                self.pending[p] = (st.st_size, st.st_mtime_ns, now)
+            elif now - since >= self.settle:
+                ready.append(p); del self.pending[p]
+        return ready
+
+WATCH_HANDLED_MAX = 100_000     # 已处理文件表超过这么多条时去掉已删除/已变化的文件
+
+def prune_handled(handled: set):
+    for key in list(handled):
+        try:
+            st = os.stat(key[0])
+        except OSError:
+            handled.discard(key); continue
+        if (st.st_size, st.st_mtime_ns) != key[1:]: handled.discard(key)
+
+def watch_loop(src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any], plan_out=None):
+    depth, ignore = scan_options(args, cfg)
+    backend = open_watch_backend(src_dir, depth, ignore, not args.no_extras, (dst_root,), force_poll=args.poll)
+    tracker = SettleTracker(args.settle)
+    handled: set = set()        # 已处理、可能再次出现在事件里的 (path, size, mtime_ns)
+    prune_at = WATCH_HANDLED_MAX
+    mode = "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK")
+    print(f"[WATCH] {src_dir} -> {dst_root} ({mode}, {backend.name}, settle={args.settle:g}s). Ctrl+C to stop.")
+    tracker.add(backend.initial)
+    try:
+        while True:
+            # 有待定文件时定时醒来检查是否就绪；否则 inotify 可以一直阻塞
+            idle = None if backend.name == "inotify" else args.poll_interval
+            timeout = min(args.poll_interval, max(args.settle, 0.5)) if tracker.pending else idle
+            tracker.add(backend.poll(timeout))
+            ready, keys = [], []
+            for p in sorted(tracker.settled()):
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                key = (p, st.st_size, st.st_mtime_ns)
+                if key not in handled:
+                    handled.add(key); ready.append(p); keys.append(key)
+            if len(handled) > prune_at:
+                # 仍在原处的文件（无状态库的硬链接模式）不能去掉；下次等表再翻倍时再清理
+                prune_handled(handled); prune_at = max(WATCH_HANDLED_MAX, 2 * len(handled))
+            if not ready: continue
+            entries = [entry_for_path(src_dir, p) for p in ready]
+            try:
+                plan, _sg, _skipped = plan_from_args(src_dir, dst_root, args, cfg, entries=entries)
+                if not plan: continue
+                print_plan(plan, dst_root, args.format, plan_out)
+                if args.dry_run: continue
+                execute_plan(plan, dst_root, args.move, cfg.get("_state"), jobs=args.jobs, journal=cfg.get("_journal"))
+                if args.move or cfg.get("_state"):
+                    # 已经移走，或已记入状态库（再次出现时按 DONE 跳过）：不必再记
+                    handled.difference_update(keys)
+                if args.stats_file: STATS.write_textfile(Path(args.stats_file))
+            finally:
+                release_plan_caches()   # 每轮的计划用完即丢，解析缓存与系列表不随运行时间增长
+    except KeyboardInterrupt:
+        print("\nStopped.")
+    finally:
+        backend.close()
+
+# ---------- batch mode ----------
+
+# manifest 每行一个 JSON 对象；除 source 外都可省略
+BATCH_OVERRIDES = ("title", "year", "season", "no_extras", "extras_scope", "depth")
+BATCH_KEYS = {"source", "destination", *BATCH_OVERRIDES}
+
+def _int_like(v) -> bool:
+    return (isinstance(v, int) and not isinstance(v, bool) and v >= 0) or (isinstance(v, str) and v.strip().isdigit())
+
+def check_overrides(job: Dict[str, Any]) -> Optional[str]:
+    """覆盖参数的类型检查（manifest 与 --serve 请求共用），不合法时返回错误信息。"""
+    for k in ("source", "destination", "title"):
+        if job.get(k) is not None and not isinstance(job[k], str): return f"'{k}' must be a string"
+    if job.get("year") is not None and not isinstance(job["year"], (str, int)): return "'year' must be a string"
+    for k in ("season", "depth"):
+        if job.get(k) is not None and not _int_like(job[k]): return f"'{k}' must be a non-negative integer"
+    if job.get("no_extras") is not None and not isinstance(job["no_extras"], bool): return "'no_extras' must be true or false"
+    if job.get("extras_scope") is not None and job["extras_scope"] not in ("series", "season"):
+        return "'extras_scope' must be 'series' or 'season'"
+    return None
+
+def load_manifest(path: Path) -> List[Dict[str, Any]]:
+    jobs: List[Dict[str, Any]] = []
+    for n, line in enumerate(path.read_text(encoding="utf-8").splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"): continue
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"[WARN] {path}:{n}: {e}. Line skipped."); continue
+        if not isinstance(job, dict) or not job.get("source"):
+            print(f"[WARN] {path}:{n}: missing 'source'. Line skipped."); continue
+        unknown = set(job) - BATCH_KEYS
+        if unknown:
+            print(f"[WARN] {path}:{n}: unknown keys ignored: {', '.join(sorted(unknown))}")
+        err = check_overrides(job)
+        if err:
+            print(f"[WARN] {path}:{n}: {err}. Line skipped."); continue
+        jobs.append(job)
+    return jobs
+
+def _job_args(base, job: Dict[str, Any]) -> argparse.Namespace:
+    a = argparse.Namespace(**vars(base))
+    for k in BATCH_OVERRIDES:
+        if k in job: setattr(a, k, job[k])
+    if a.season is not None: a.season = int(a.season)
+    if a.depth is not None: a.depth = int(a.depth)
+    return a
+
+def _job_paths(job: Dict[str, Any]) -> Tuple[Path, Path]:
+    src = Path(job["source"])
+    return src, (Path(job["destination"]) if job.get("destination") else src / "organized")
+
+def _plan_job(job: Dict[str, Any], base_args, cfg: Dict[str, Any]):
+    """在子进程里规划一个目录。状态库按路径各自打开（只读查询），识别出的文件键随结果带回主进程。"""
+    src, dst = _job_paths(job)
+    if not src.is_dir():
+        return None, {}, {"ERROR": [f"invalid source: {src}"]}, {}, []
+    state = StateDB(Path(cfg["_state_path"])) if cfg.get("_state_path") else None
+    cfg = dict(cfg, _state=state)
+    try:
+        plan, sg, skipped = plan_from_args(src, dst, _job_args(base_args, job), cfg, resolve=False)
+    finally:
+        if state: state.close()
+    aliases = cfg.get("_aliases")
+    return plan, sg, dict(skipped), (state.keys if state else {}), (aliases.learned if aliases else [])
+
+def batch_run(manifest: Path, args, cfg: Dict[str, Any], plan_out=None) -> int:
+    """
+    --batch：manifest 中的各个目录在进程池中并行规划，随后统一解决重名（跨目录的目标冲突会被报告，
+    后者改用编号名），最后在一个执行阶段里依次执行。返回失败数。
+    """
+    jobs = load_manifest(manifest)
+    if not jobs:
+        print(f"[ERROR] no usable entries in manifest: {manifest}"); return 1
+    state: Optional[StateDB] = cfg.get("_state")
+    # 状态库、执行日志只在主进程使用；别名表以副本传给规划进程，学到的别名随结果带回
+    wcfg = {k: v for k, v in cfg.items() if k not in ("_state", "_journal")}
+    wcfg["_state_path"] = str(state.path) if state else None
+
+    from concurrent.futures import ProcessPoolExecutor
+    workers = min(len(jobs), args.batch_workers or os.cpu_count() or 1)
+    results = [None] * len(jobs)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_plan_job, job, args, wcfg) for job in jobs]
+            for i, fut in enumerate(futures):
+                try:
+                    results[i] = fut.result()
+                except Exception as e:
+                    results[i] = (None, {}, {"ERROR": [f"planning failed: {e}"]}, {}, [])
+    else:
+        for i, job in enumerate(jobs):
+            try:
+                results[i] = _plan_job(job, args, wcfg)
+            except Exception as e:
+                results[i] = (None, {}, {"ERROR": [f"planning failed: {e}"]}, {}, [])
+
+    # 合并：所有目录共用一个 DestIndex 按 manifest 顺序占名
+    index = DestIndex()
+    owner: Dict[Path, int] = {}
+    conflicts: List[Tuple[PlanItem, Path]] = []
+    for j, (plan, _sg, _skipped, keys, learned) in enumerate(results):
+        if state: state.keys.update(keys)
+        if cfg.get("_aliases") and workers > 1:
+            for raw, canon in learned: cfg["_aliases"].observe(raw, canon)
+        for it in plan or ():
+            first = owner.setdefault(it.dst, j)
+            it.dst = index.claim(it.dst)
+            if first != j:
+                conflicts.append((it, _job_paths(jobs[first])[0]))
+
+    mode = "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK")
+    total = sum(len(r[0] or ()) for r in results)
+    print(f"=== AniArr batch: {len(jobs)} folders, {total} files planned ({mode}, planner processes: {workers}) ===")
+    for j, (plan, sg, skipped, _keys, _learned) in enumerate(results):
+        src, dst = _job_paths(jobs[j])
+        print(f"\n--- [{j + 1}/{len(jobs)}] {src} -> {dst}  ({len(plan or ())} planned, group {resolve_group_for_header(plan or [], sg)}) ---")
+        if plan: print_plan(plan, dst, args.format, plan_out)
+        print_skipped(skipped)
+    if conflicts:
+        print(f"\n--- Conflicts between folders ({len(conflicts)}) ---")
+        for it, other in conflicts:
+            print(wrap_line(f"  {it.src} -> {it.dst.name}  (name already planned from {other})", indent=4))
+
+    if args.dry_run:
+        print("\nSummary: dry-run only."); return 0
+    ok = fail = 0
+    for j, (plan, _sg, skipped, _keys, _learned) in enumerate(results):
+        fail += len(skipped.get("ERROR", ()))
+        if not plan: continue
+        _src, dst = _job_paths(jobs[j])
+        o, f = PlanExecutor(dst, args.move, jobs=args.jobs, state=state, journal=cfg.get("_journal")).run(plan, summary=False)
+        ok += o; fail += f
+    print(f"\nDone. OK={ok}  FAIL={fail}")
+    return fail
+
+# ---------- streaming pipeline ----------
+
+STREAM_QUEUE = 8            # 阶段之间最多积压的批次（有界队列：下游跟不上时扫描线程等待）
+STREAM_BATCH = 256          # 扫描线程一批最多交出的条目数；换目录时也会交出
+
+def _stream_key(e: ScanEntry) -> Optional[Tuple[str, str]]:
+    """
+    分块键：一个顶层子目录（通常是一个种子 / 一个系列）为一块；源目录根下的散文件按解析出的标题分块
+    （按名字排序后同一系列的文件相邻）。根下的非媒体文件返回 None，跟随当前块。
+    """
+    if e.depth: return e.rel.split(os.sep, 1)[0], ""
+    ext = name_ext(e.name)
+    if e.kind != 'file' or not (ext in VIDEO_EXTS or ext in SUB_EXTS): return None
+    return "", PARSER.parse(e.name).title
+
+def _queue_put(q: "queue.Queue", item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.2); return True
+        except queue.Full:
+            continue
+    return False
+
+def _queue_get(q: "queue.Queue", stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.2)
+        except queue.Empty:
+            continue
+    return None
+
+def _stream_scan(src_dir: Path, dst_root: Path, depth: int, ignore: List[str], extras_on: bool,
+                 out: "queue.Queue", stop: threading.Event):
+    """扫描线程：按批交出 ScanEntry，换目录时立即交出（下一个目录在慢速挂载上可能要列很久）。结束时放入 None。"""
+    batch: List[ScanEntry] = []; cur = None
+    try:
+        with STATS.phase("scan"):
+            for e in scan_tree(src_dir, depth, ignore, extras_on=extras_on, exclude=(dst_root,)):
+                d = os.path.dirname(e.rel)
+                if batch and (d != cur or len(batch) >= STREAM_BATCH):
+                    if not _queue_put(out, batch, stop): return
+                    batch = []
+                cur = d; batch.append(e)
+        if batch: _queue_put(out, batch, stop)
+    finally:
+        _queue_put(out, None, stop)
+
+def _stream_plan(src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any],
+                 inq: "queue.Queue", out: "queue.Queue", stop: threading.Event):
+    """
+    规划线程：只规划已经完整的块（后面已经出现了别的块），每块单独规划一次，跟不上扫描时也不合并，
+    结果与时序无关。字幕组多数决、同名版本（v2）与别名分组都只在块内决定：同一系列分散在多个顶层目录时
+    各目录分别统计，与 -y 的结果可能不同。
+    状态库另开一个连接（与 --batch 的规划进程相同），识别出的文件键随计划交给执行端。
+    """
+    state = StateDB(cfg["_state"].path) if cfg.get("_state") else None
+    pcfg = dict(cfg, _state=state)
+    index = DestIndex()             # 跨块共用：后面的块不会抢到前面已经占用的名字
+    pending: List[ScanEntry] = []; key = None; end = False
+    try:
+        while not end and not stop.is_set():
+            batches = [_queue_get(inq, stop)]
+            while batches[-1] is not None:
+                try:
+                    batches.append(inq.get_nowait())
+                except queue.Empty:
+                    break
+            chunks: List[List[ScanEntry]] = []
+            for b in batches:
+                if b is None:
+                    end = True; break
+                for e in b:
+                    k = _stream_key(e)
+                    if k is not None and k != key:
+                        if pending: chunks.append(pending)
+                        pending = []; key = k
+                    pending.append(e)
+            if end and pending: chunks.append(pending)
+            for chunk in chunks:
+                plan, sg, skipped = plan_from_args(src_dir, dst_root, args, pcfg, entries=chunk, dest_index=index)
+                keys = dict(state.keys) if state else {}
+                if state: state.keys.clear()
+                if not _queue_put(out, (plan, sg, skipped, keys), stop): return
+    except Exception as e:
+        _queue_put(out, e, stop)        # 交给主线程抛出
+    finally:
+        if state: state.close()
+        _queue_put(out, None, stop)
+
+def stream_run(src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any], plan_out=None) -> Tuple[int, int]:
+    """
+    --stream：扫描线程 → 规划线程 → 执行（主线程）三段流水线，阶段之间用有界队列连接，
+    慢速网络挂载上第一个目录扫完就开始链接，扫描的 I/O 与规划、执行重叠。
+    计划按块输出（块内已排序），跳过列表在最后统一输出。返回 (ok, fail)。
+    """
+    depth, ignore = scan_options(args, cfg)
+    stop = threading.Event()
+    entries_q: "queue.Queue" = queue.Queue(maxsize=STREAM_QUEUE)
+    plans_q: "queue.Queue" = queue.Queue(maxsize=STREAM_QUEUE)
+    threads = [
+        threading.Thread(target=_stream_scan, name="aniarr-scan", daemon=True,
+                         args=(src_dir, dst_root, depth, ignore, not args.no_extras, entries_q, stop)),
+        threading.Thread(target=_stream_plan, name="aniarr-plan", daemon=True,
+                         args=(src_dir, dst_root, args, cfg, entries_q, plans_q, stop)),
+    ]
+    for t in threads: t.start()
+    mode = "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK")
+    print(f"[STREAM] {src_dir} -> {dst_root} ({mode})")
+    state: Optional[StateDB] = cfg.get("_state")
+    executor = PlanExecutor(dst_root, args.move, jobs=args.jobs, state=state, journal=cfg.get("_journal"))
+    skipped_all: Dict[str, List[str]] = defaultdict(list)
+    ok = fail = 0
+    try:
+        while True:
+            got = plans_q.get()
+            if got is None: break
+            if isinstance(got, Exception): raise got
+            plan, sg, skipped, keys = got
+            for reason, paths in skipped.items(): skipped_all[reason].extend(paths)
+            if not plan: continue
+            # 计划已按系列排序：每个系列一段，带上该系列的多数字幕组
+            for series, items in itertools.groupby(plan, key=lambda it: it.series_dir):
+                print(f"\n--- {series}  (group {sg.get(series) or '-'}) ---")
+                print_plan(list(items), dst_root, args.format, plan_out)
+            if args.dry_run: continue
+            if state: state.keys.update(keys)
+            o, f = executor.run(plan, summary=False)
+            ok += o; fail += f
+    finally:
+        stop.set()
+        for t in threads: t.join()
+    print_skipped(skipped_all)
+    if args.dry_run:
+        print("\nSummary: dry-run only.")
+    else:
+        print(f"\nDone. OK={ok}  FAIL={fail}")
+    return ok, fail
+
+# ---------- server mode ----------
+
+# 请求键同 --batch manifest，另加 wait（默认 true：处理完才回复）
+SERVE_KEYS = BATCH_KEYS | {"wait"}
+SERVE_MAX_WAIT = 30.0       # 请求持续涌入时，一波最多收集这么久就开始处理
+
+def default_socket() -> str:
+    # 与 aniarr_client.py 中的同名函数保持一致
+    if os.environ.get("ANIARR_SOCKET"): return os.environ["ANIARR_SOCKET"]
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    return os.path.join(base, "aniarr.sock") if base else f"/tmp/aniarr-{os.getuid()}.sock"
+
+def _listen(path: str) -> socket.socket:
+    import stat
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise OSError(f"{path} exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)         # 上次异常退出留下的 socket 文件
+        else:
+            raise OSError(f"another server is already listening on {path}")
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old = os.umask(0o077)           # 只有同一用户能连上
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old)
+    sock.listen(64)
+    return sock
+
+class ServeRequest:
+    def __init__(self, job: Dict[str, Any]):
+        self.job = job
+        self.done = threading.Event()
+        self.result: Dict[str, Any] = {}
+
+class Server:
+    """
+    --serve：常驻进程，在 Unix socket 上接收请求（每个连接一行 JSON，回复一行 JSON）。
+    配置、目标库索引（有上限）、状态库与别名表都只加载一次；解析缓存与系列表每批执行完后清掉。请求进入队列，由单个 worker 串行处理：
+    收到第一个请求后等到 delay 秒内没有新请求，把这一波里目标目录与覆盖参数相同的请求合并成一个计划
+    （重复或嵌套的来源只扫描一次，同一系列的文件共用一次占名），所以并发完成的种子不会抢同一个目标目录。
+    """
+    def __init__(self, path: str, args, cfg: Dict[str, Any], plan_out=None):
+        self.path = path
+        self.args = args
+        self.cfg = cfg
+        self.plan_out = plan_out
+        self.delay = args.serve_delay
+        self.queue: "queue.Queue[ServeRequest]" = queue.Queue()
+        self.busy = threading.Lock()
+
+    @staticmethod
+    def check(job) -> Optional[str]:
+        if not isinstance(job, dict) or not job.get("source"): return "missing 'source'"
+        unknown = set(job) - SERVE_KEYS
+        if unknown: return f"unknown keys: {', '.join(sorted(unknown))}"
+        err = check_overrides(job)
+        if err: return err
+        for k in ("source", "destination"):
+            if job.get(k) and not os.path.isabs(job[k]): return f"'{k}' must be an absolute path"
+        if not os.path.exists(job["source"]): return f"invalid source: {job['source']}"
+        return None
+
+    def _handle(self, conn: socket.socket):
+        with conn, conn.makefile("rwb") as f:
+            try:
+                job = json.loads(f.readline(1 << 16))
+                err = self.check(job)
+            except ValueError as e:
+                job, err = None, f"bad request: {e}"
+            if err:
+                reply = {"status": "error", "error": err}
+            elif job.get("wait", True):
+                req = ServeRequest(job); self.queue.put(req)
+                req.done.wait(); reply = req.result
+            else:
+                self.queue.put(ServeRequest(job)); reply = {"status": "queued"}
+            try:
+                f.write(json.dumps(reply, ensure_ascii=False).encode("utf-8") + b"\n"); f.flush()
+            except OSError:
+                pass                # 客户端已断开（不等结果的钩子）
+
+    def _collect(self) -> List[ServeRequest]:
+        reqs = [self.queue.get()]
+        deadline = time.monotonic() + SERVE_MAX_WAIT
+        while time.monotonic() < deadline:
+            try:
+                reqs.append(self.queue.get(timeout=self.delay))
+            except queue.Empty:
+                break
+        return reqs
+
+    def _worker(self):
+        while True:
+            reqs = self._collect()
+            groups: Dict[Tuple, List[ServeRequest]] = {}
+            for r in reqs:
+                key = (self._dst(r.job), tuple(repr(r.job.get(k)) for k in BATCH_OVERRIDES))
+                groups.setdefault(key, []).append(r)
+            with self.busy:
+                for (dst, _overrides), rs in groups.items():
+                    try:
+                        result = self.run_group(dst, rs)
+                    except Exception as e:
+                        print(f"[ERROR] {dst}: {type(e).__name__}: {e}")
+                        result = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+                    results = result if isinstance(result, list) else [result] * len(rs)
+                    for r, res in zip(rs, results):
+                        r.result = res; r.done.set()
+                release_plan_caches()
+                if self.cfg.get("_aliases"): self.cfg["_aliases"].save()
+                if self.args.stats_file: STATS.write_textfile(Path(self.args.stats_file))
+
+    @staticmethod
+    def _dst(job: Dict[str, Any]) -> Path:
+        if job.get("destination"): return Path(job["destination"])
+        src = Path(job["source"])
+        return (src if src.is_dir() else src.parent) / "organized"
+
+    def run_group(self, dst: Path, reqs: List[ServeRequest]) -> List[Dict[str, Any]]:
+        """规划并执行一组请求，返回与 reqs 对应的结果：计数按各请求的来源路径前缀分别统计。"""
+        args = _job_args(self.args, reqs[0].job)
+        depth, ignore = scan_options(args, self.cfg)
+        # 同一来源只扫描一次；位于另一个来源之内的跳过（按路径排序后父目录总在前面）
+        roots: List[str] = []
+        for p in sorted({os.path.abspath(r.job["source"]) for r in reqs}):
+            if not any(p.startswith(k + os.sep) for k in roots): roots.append(p)
+        entries: List[ScanEntry] = []
+        with STATS.phase("scan"):
+            for p in roots:
+                if os.path.isdir(p):
+                    entries.extend(scan_tree(Path(p), depth, ignore, extras_on=not args.no_extras, exclude=(dst,)))
+                elif os.path.isfile(p):
+                    # 单文件种子
+                    entries.append(entry_for_path(Path(os.path.dirname(p)), p))
+        plan, _sg, skipped = plan_from_args(Path(roots[0]), dst, args, self.cfg, entries=entries)
+        print(f"[SERVE] {len(reqs)} request(s), {len(roots)} source(s) -> {dst}: {len(plan)} planned")
+        if plan: print_plan(plan, dst, self.args.format, self.plan_out)
+        print_skipped(skipped)
+        failed: set = set()
+        if plan and not self.args.dry_run:
+            executor = PlanExecutor(dst, self.args.move, jobs=self.args.jobs, state=self.cfg.get("_state"),
+                                    journal=self.cfg.get("_journal"))
+            executor.run(plan)
+            failed = {id(it) for it in executor.failed}
+        # 嵌套的来源各自都计入；未进入计划的扫描条目即该请求跳过的数量
+        srcs = [(os.path.join(it.src_dir, it.src_name), id(it) in failed) for it in plan]
+        planned_paths = {p for p, _f in srcs}
+        results = []
+        for r in reqs:
+            root = os.path.abspath(r.job["source"])
+            under = lambda p: p == root or p.startswith(root + os.sep)
+            mine = [f for p, f in srcs if under(p)]
+            fail = sum(mine)
+            results.append({"status": "done", "requests": len(reqs), "planned": len(mine),
+                            "ok": 0 if self.args.dry_run else len(mine) - fail, "fail": fail,
+                            "skipped": sum(1 for e in entries if under(e.path) and e.path not in planned_paths)})
+        return results
+
+    def serve_forever(self):
+        sock = _listen(self.path)
+        threading.Thread(target=self._worker, name="aniarr-serve", daemon=True).start()
+        mode = "DRY-RUN" if self.args.dry_run else ("MOVE" if self.args.move else "HARDLINK")
+        print(f"[SERVE] listening on {self.path} ({mode}, delay={self.delay:g}s). Ctrl+C to stop.")
+        try:
+            while True:
+                conn, _ = sock.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            print("\nStopped.")
+        finally:
+            sock.close()
+            with contextlib.suppress(OSError): os.unlink(self.path)
+            # 正在执行的一组做完再退出；还在排队的请求随进程结束断开
+            with self.busy: pass
+
+# ---------- work queue (multi-host) ----------
+
+QUEUE_LEASE = 300.0         # 租约秒数；worker 每 1/3 租约续一次，过期的单元由其他进程收回
+QUEUE_POLL = 1.0
+QUEUE_ATTEMPTS = 3          # 同一单元被收回这么多次后记为失败，不再重试
+# 协调端决定、所有 worker 一致使用的规划参数（规则、去重、库内跳过等）；状态库、别名库、日志仍按主机各自配置
+QUEUE_CFG_KEYS = ("rules", "fallback_category", "extras_scope")
+
+def _write_json(path: str, data: Dict[str, Any]):
+    # 先写临时文件再改名：其他主机上的进程不会读到半个文件
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{socket.gethostname()}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps(data, ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class WorkQueue:
+    """
+    共享目录上的工作队列（NAS 上各主机都能挂载的目录，只依赖原子 rename）：
+      job.json           协调端写完所有单元后写入：来源、目标、单元数、一致的规划参数
+      pending/U.json     待处理单元：一个系列目录的源文件（相对来源的路径）与标题/年份等覆盖参数
+      leased/U.json@W    worker W 认领（pending -> leased 的 rename 只有一个进程成功）；文件 mtime 即心跳
+      done/U.json        结果（计数或错误）
+    租约用队列目录所在文件系统的时钟判断（touch .clock 读 mtime），不受各主机时钟偏差影响。
+    """
+    def __init__(self, root: Path):
+        self.root = str(root)
+        self.pending = os.path.join(self.root, "pending")
+        self.leased = os.path.join(self.root, "leased")
+        self.done = os.path.join(self.root, "done")
+        self.job_path = os.path.join(self.root, "job.json")
+
+    def job(self) -> Optional[Dict[str, Any]]:
+        return _read_json(self.job_path)
+
+    def _names(self, d: str) -> List[str]:
+        try:
+            return sorted(n for n in os.listdir(d) if not n.startswith("."))
+        except FileNotFoundError:
+            return []
+
+    def done_count(self) -> int:
+        return len(self._names(self.done))
+
+    def finished(self, job: Dict[str, Any]) -> bool:
+        return self.done_count() >= job["units"]
+
+    def results(self) -> List[Dict[str, Any]]:
+        return [r for r in (_read_json(os.path.join(self.done, n)) for n in self._names(self.done)) if r]
+
+    def clock(self) -> float:
+        p = os.path.join(self.root, ".clock")
+        with open(p, "a"): pass
+        os.utime(p)
+        return os.stat(p).st_mtime
+
+    def reset(self):
+        """清空已完成的上一个任务。"""
+        for d in (self.pending, self.leased, self.done):
+            for n in self._names(d): os.unlink(os.path.join(d, n))
+        with contextlib.suppress(FileNotFoundError): os.unlink(self.job_path)
+
+    def publish(self, job: Dict[str, Any], units: List[Dict[str, Any]]):
+        for d in (self.pending, self.leased, self.done): os.makedirs(d, exist_ok=True)
+        for u in units:
+            _write_json(os.path.join(self.pending, f"{u['unit']}.json"), u)
+        _write_json(self.job_path, job)
+
+    def claim(self, owner: str) -> Optional[Tuple[Dict[str, Any], str]]:
+        """
+        认领一个待处理单元，返回 (单元, 租约文件)；没有可认领的返回 None。
+        rename 保留原文件的 mtime，所以先 touch 再改名，新租约不会一出现就显得过期而被收回。
+        """
+        for n in self._names(self.pending):
+            path = os.path.join(self.pending, n)
+            lease = os.path.join(self.leased, f"{n}@{owner}")
+            try:
+                os.utime(path)
+                os.rename(path, lease)
+            except FileNotFoundError:
+                continue            # 被别的 worker 抢先
+            unit = _read_json(lease)
+            if unit is not None: return unit, lease
+            # 读不到：文件损坏，或租约刚被收回（那样单元已回到 pending）
+            with contextlib.suppress(FileNotFoundError): os.unlink(lease)
+        return None
+
+    def complete(self, unit: Dict[str, Any], lease: str, result: Dict[str, Any]) -> bool:
+        """
+        写回结果并释放租约；租约已被收回时返回 False（单元会由别的 worker 重做）。
+        先把租约改名占住，与 reclaim 同时发生时只有一方成功。
+        """
+        grab = os.path.join(self.leased, f".{os.path.basename(lease)}.done")
+        try:
+            os.rename(lease, grab)
+        except FileNotFoundError:
+            return False
+        _write_json(os.path.join(self.done, f"{unit['unit']}.json"), result)
+        with contextlib.suppress(FileNotFoundError): os.unlink(grab)
+        return True
+
+    def reclaim(self, ttl: float, owner: str) -> int:
+        """把心跳超过 ttl 秒的租约放回 pending（超过 QUEUE_ATTEMPTS 次记为失败），返回收回的个数。"""
+        names = self._names(self.leased)
+        if not names: return 0
+        now, n = self.clock(), 0
+        for name in names:
+            path = os.path.join(self.leased, name)
+            try:
+                if now - os.stat(path).st_mtime < ttl: continue
+                # 先改名占住，多个进程同时收回时只有一个成功
+                grab = os.path.join(self.leased, f".{name}.reclaim@{owner}")
+                os.rename(path, grab)
+            except FileNotFoundError:
+                continue
+            unit = _read_json(grab)
+            if unit is not None:
+                unit["attempts"] = unit.get("attempts", 0) + 1
+                holder = name.partition("@")[2]
+                print(f"[QUEUE] lease of unit {unit['unit']} ({unit['series']}) held by {holder} expired", file=sys.stderr)
+                if unit["attempts"] >= QUEUE_ATTEMPTS:
+                    _write_json(os.path.join(self.done, f"{unit['unit']}.json"),
+                                {"unit": unit["unit"], "series": unit["series"], "worker": holder,
+                                 "error": f"lease expired {unit['attempts']} times"})
+                else:
+                    _write_json(os.path.join(self.pending, f"{unit['unit']}.json"), unit)
+            os.unlink(grab); n += 1
+        return n
+
+class _Heartbeat:
+    """执行单元期间定时 touch 租约文件；租约被收回（文件不见了）时 lost 置位。"""
+    def __init__(self, lease: str, ttl: float):
+        self.lease, self.every = lease, max(1.0, ttl / 3)
+        self.lost = False
+        self._stop = threading.Event()
+        self._t = threading.Thread(target=self._run, name="aniarr-lease", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.every):
+            try:
+                os.utime(self.lease)
+            except FileNotFoundError:
+                self.lost = True; return
+            except OSError:
+                pass                # NAS 短暂不可用：下次再续
+
+    def __enter__(self):
+        self._t.start(); return self
+
+    def __exit__(self, *exc):
+        self._stop.set(); self._t.join()
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}.{os.getpid()}"
+
+def coordinate(qdir: Path, src_dir: Path, dst_root: Path, args, cfg: Dict[str, Any]) -> int:
+    """
+    --coordinate：按 build_plan 的系列目录把来源切成工作单元写入队列，等待所有单元完成（期间收回过期租约），
+    汇总结果。同一来源/目标的任务尚未完成时直接接着等待。返回失败数。
+    """
+    q = WorkQueue(qdir)
+    src, dst = os.path.abspath(src_dir), os.path.abspath(dst_root)
+    job = q.job()
+    if job and not q.finished(job):
+        if (job["source"], job["destination"]) != (src, dst):
+            print(f"[ERROR] queue {qdir} is busy with {job['source']} -> {job['destination']}"); return 1
+        print(f"[QUEUE] attaching to the unfinished job in {qdir}")
+    else:
+        # 规划只用来分组：去重、库内跳过、探测都留给 worker
+        pcfg = dict(cfg, _dedupe=None, _skip_existing=False, _probe=False)
+        plan, _sg, skipped = plan_from_args(src_dir, dst_root, args, pcfg, resolve=False)
+        units: List[Dict[str, Any]] = []
+        overrides = {k: getattr(args, k) for k in ("season", "no_extras", "extras_scope")}
+        for series, grp in itertools.groupby(sorted(plan, key=plan_sort_key), key=lambda it: it.series_dir):
+            grp = list(grp)
+            # 标题、年份固定为协调端的结果，worker 重新解析后落到同一个系列目录
+            units.append({"unit": f"{len(units):05d}", "series": series, "attempts": 0,
+                          "overrides": dict(overrides, title=grp[0].title, year=grp[0].year),
+                          "files": [os.path.relpath(str(it.src), src) for it in grp]})
+        mode = "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK")
+        print(f"=== AniArr queue: {len(plan)} files in {len(units)} units ({mode}) -> {qdir} ===")
+        for u in units:
+            print(wrap_line(f"  [{u['unit']}] {u['series']}  ({len(u['files'])} files)", indent=4))
+        print_skipped(skipped)
+        if args.dry_run:
+            print("\nSummary: dry-run only."); return 0
+        if not units:
+            print("\nNothing to queue."); return 0
+        if job: q.reset()
+        job = {"source": src, "destination": dst, "units": len(units), "move": args.move, "lease": args.lease,
+               "dedupe": cfg.get("_dedupe"), "skip_existing": cfg.get("_skip_existing", False),
+               "probe": cfg.get("_probe", False), "created": time.time(),
+               **{k: cfg.get(k) for k in QUEUE_CFG_KEYS}}
+        q.publish(job, units)
+
+    procs = [_spawn_worker(qdir, args, cfg, i) for i in range(args.spawn or 0)]
+    me, last = worker_id(), -1
+    try:
+        while not q.finished(job):
+            q.reclaim(job["lease"], me)
+            n = q.done_count()
+            if n != last:
+                print(f"[QUEUE] {n}/{job['units']} units done", file=sys.stderr); last = n
+            time.sleep(QUEUE_POLL)
+    except KeyboardInterrupt:
+        print("\nStopped waiting; workers keep going. Run the same command again to attach.")
+        return 1
+    finally:
+        for p in procs: p.wait()
+
+    ok = fail = skipped_n = 0
+    workers = set()
+    for r in q.results():
+        workers.add(r.get("worker"))
+        if r.get("error"):
+            fail += 1; print(wrap_line(f"[FAIL] unit {r['unit']} ({r['series']}) :: {r['error']}", indent=4)); continue
+        ok += r["ok"]; fail += r["fail"]; skipped_n += r["skipped"]
+        if r["fail"]:
+            print(f"[FAIL] unit {r['unit']} ({r['series']}): {r['fail']} file(s) failed on {r['worker']}")
+    print(f"\nDone. OK={ok}  FAIL={fail}  skipped={skipped_n}  (units: {job['units']}, workers: {len(workers)})")
+    return fail
+
+def _spawn_worker(qdir: Path, args, cfg: Dict[str, Any], i: int):
+    """--spawn：在本机启动 worker 进程（输出写到队列目录下的 logs/）。"""
+    import subprocess
+    argv = [sys.executable, os.path.abspath(__file__), "--work", str(qdir), "--jobs", str(args.jobs)]
+    if cfg["_config_path"] != "(built-in)": argv += ["--config", cfg["_config_path"]]
+    logs = Path(qdir) / "logs"
+    logs.mkdir(exist_ok=True)
+    with open(logs / f"local-{i}.log", "a", encoding="utf-8") as out:
+        return subprocess.Popen(argv, stdout=out, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+
+def work(qdir: Path, args, cfg: Dict[str, Any], plan_out=None) -> int:
+    """
+    --work：从队列认领单元、规划并执行，结果写回 done/。任务发布之前一直等待；所有单元都有结果后退出。
+    返回本进程处理的单元中失败的文件数。
+    """
+    q = WorkQueue(qdir)
+    me = worker_id()
+    fails = units = 0
+    waiting = False
+    try:
+        while True:
+            job = q.job()
+            if job is None:
+                if not waiting: print(f"[WORK] {me}: waiting for a job in {qdir}"); waiting = True
+                time.sleep(QUEUE_POLL); continue
+            got = q.claim(me)
+            if got is None:
+                if q.finished(job): break
+                q.reclaim(job["lease"], me)
+                time.sleep(QUEUE_POLL); continue
+            unit, lease = got
+            with _Heartbeat(lease, job["lease"]) as hb:
+                result = run_unit(unit, job, args, cfg, plan_out, stop=lambda: hb.lost)
+            result.update(unit=unit["unit"], series=unit["series"], worker=me)
+            if hb.lost or not q.complete(unit, lease, result):
+                print(f"[WARN] lease of unit {unit['unit']} was reclaimed while running; result dropped")
+                continue
+            units += 1; fails += result.get("fail", 0) + bool(result.get("error"))
+    except KeyboardInterrupt:
+        print("\nStopped.")
+    print(f"\n[WORK] {me}: {units} unit(s) done, FAIL={fails}")
+    return fails
+
+def run_unit(unit: Dict[str, Any], job: Dict[str, Any], base_args, cfg: Dict[str, Any], plan_out=None,
+             stop: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """
+    规划并执行一个单元。单元可能是被收回后重做的：源文件 (st_dev, st_ino) 已在目标库里的条目
+    （上一个 worker 已经链接/移动过）总是跳过，重做不会生成 _1 副本。stop() 为真（租约丢失）时不再执行后续条目。
+    """
+    src, dst = Path(job["source"]), Path(job["destination"])
+    args = _job_args(base_args, unit["overrides"])
+    args.move = job["move"]
+    # 别名已由协调端固定在标题里；本机状态库、日志照常使用
+    ucfg = dict(cfg, _aliases=None, _dedupe=job["dedupe"], _skip_existing=job["skip_existing"], _probe=job["probe"],
+                **{k: job[k] for k in QUEUE_CFG_KEYS})
+    ucfg["rule_set"] = compile_rules(ucfg["rules"])
+    try:
+        entries = [entry_for_path(src, os.path.join(src, rel)) for rel in unit["files"]]
+        plan, _sg, skipped = plan_from_args(src, dst, args, ucfg, entries=entries, resolve=False)
+        plan = skip_linked(plan, library_for(dst, cfg.get("_state")), skipped)
+        resolve_collisions(plan, DestIndex())
+        print(f"[WORK] unit {unit['unit']} {unit['series']}: {len(plan)} planned")
+        if plan: print_plan(plan, dst, args.format, plan_out)
+        print_skipped(skipped)
+        ok, fail = execute_plan(plan, dst, args.move, cfg.get("_state"), jobs=args.jobs,
+                                journal=cfg.get("_journal"), stop=stop) if plan else (0, 0)
+    except Exception as e:
+        print(f"[ERROR] unit {unit['unit']} ({unit['series']}): {e}")
+        return {"error": str(e)}
+    return {"planned": len(plan), "ok": ok, "fail": fail, "skipped": sum(len(v) for v in skipped.values())}
+
 # ---------- CLI ----------
 
+def setup_runtime(args, cfg: Dict[str, Any]):
+    """运行期对象挂到 cfg 的下划线键上：状态库、执行日志、续跑时已完成的源文件集合。"""
+    cfg["_state"] = open_state(args.state, cfg)
+    cfg["_skip_existing"] = args.skip_existing or cfg.get("skip_existing", False)
+    cfg["_aliases"] = open_aliases(args.aliases, cfg)
+    if cfg["_aliases"]:
+        cfg["_aliases"].learn = not args.dry_run
+        cfg["_aliases"].fuzzy = args.fuzzy_titles or cfg.get("alias_fuzzy", False)
+        atexit.register(cfg["_aliases"].save)
+    cfg["_probe"] = args.probe or cfg.get("probe", False)
+    cfg["_verbose"] = args.verbose
+    setup_jellyfin(args, cfg)
+    limit = args.max_memory or cfg.get("max_memory")
+    if limit:
+        try:
+            cfg["_max_items"] = max_items_for(parse_size(limit))
+        except ValueError as e:
+            print(f"[WARN] max_memory ignored: {e}")
+    if args.dedupe or cfg.get("dedupe"):
+        cfg["_dedupe"] = parse_prefer(args.prefer) if args.prefer else cfg.get("dedupe_prefer", DEFAULT_PREFER)
+    if args.resume:
+        cfg["_journal"], cfg["_journal_done"] = open_resume(Path(args.resume), args.dry_run)
+        print(f"[RESUME] {args.resume}: {len(cfg['_journal_done'])} completed operations will be skipped", file=sys.stderr)
+    elif args.journal and not args.dry_run:
+        cfg["_journal"] = Journal(Path(args.journal), read_journal(Path(args.journal))[1])
+
+@contextlib.contextmanager
+def log_output(fmt: str):
+    """ndjson 模式下 stdout 只留计划记录，其余输出（表头、跳过列表、执行日志）改走 stderr。产出计划的输出流。"""
+    plan_out = sys.stdout
+    if fmt != "ndjson":
+        yield plan_out; return
+    with contextlib.redirect_stdout(sys.stderr):
+        yield plan_out
+
+def emit_stats(args):
+    write_lines(STATS.report(), sys.stderr)
+    if args.stats_file: STATS.write_textfile(Path(args.stats_file))
+
+def run_cli(ap: argparse.ArgumentParser, args):
+    if args.undo:
+        _ok, fail = undo_journal(Path(args.undo))
+        if fail: sys.exit(2)
+        return
+    if args.save_plan and (args.apply_plan or args.serve or args.batch or args.work or args.watch
+                           or args.stream or args.coordinate):
+        ap.error("--save-plan needs a one-shot run (-y, or interactive)")
+    if args.apply_plan:
+        cfg = load_config(args.config)
+        setup_runtime(args, cfg)
+        with log_output(args.format) as plan_out:
+            fail = apply_plan(Path(args.apply_plan), args, cfg, plan_out)
+        if fail: sys.exit(2)
+        return
+    if args.serve:
+        cfg = load_config(args.config)
+        setup_runtime(args, cfg)
+        # systemd 等用 SIGTERM 停止服务，按 Ctrl+C 处理以便清理 socket
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with log_output(args.format) as plan_out:
+            Server(args.serve, args, cfg, plan_out).serve_forever()
+        return
+    if args.work:
+        if args.dry_run: ap.error("--work cannot dry-run; use -d with --coordinate")
+        cfg = load_config(args.config)
+        setup_runtime(args, cfg)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with log_output(args.format) as plan_out:
+            fail = work(Path(args.work), args, cfg, plan_out)
+        if fail: sys.exit(2)
+        return
+    if args.batch:
+        cfg = load_config(args.config)
+        setup_runtime(args, cfg)
+        with log_output(args.format) as plan_out:
+            failed = batch_run(Path(args.batch), args, cfg, plan_out)
+        if failed: sys.exit(2)
+        return
+    if not args.source:
+        ap.error("the following arguments are required: source")
+    if args.format == "ndjson" and not (args.yes or args.watch or args.stream):
+        ap.error("--format ndjson needs a non-interactive run (-y, --watch or --batch)")
+    src_dir = Path(args.source)
+    dst_root = Path(args.destination) if args.destination else (src_dir / "organized")
+    if not src_dir.exists() or not src_dir.is_dir():
+        print(f"[ERROR] invalid source: {src_dir}"); sys.exit(1)
+
+    cfg = load_config(args.config)
+    setup_runtime(args, cfg)
+
+    if args.watch:
+        with log_output(args.format) as plan_out:
+            watch_loop(src_dir, dst_root, args, cfg, plan_out)
+        return
+
+    if args.coordinate:
+        fail = coordinate(Path(args.coordinate), src_dir, dst_root, args, cfg)
+        if fail: sys.exit(2)
+        return
+
+    if args.stream:
+        if cfg.get("_dedupe"):
+            ap.error("--stream plans each top-level folder on its own and cannot dedupe across them; drop --dedupe (or dedupe in the config)")
+        with log_output(args.format) as plan_out:
+            _ok, fail = stream_run(src_dir, dst_root, args, cfg, plan_out)
+        if fail: sys.exit(2)
+        return
+
+    # non-interactive
+    if args.yes:
+        plan, sg, skipped = plan_from_args(src_dir, dst_root, args, cfg, max_items=cfg.get("_max_items"))
+        with log_output(args.format) as plan_out:
+            show_header(src_dir, dst_root, args, cfg, plan, sg)
+            print_plan(plan, dst_root, args.format, plan_out); print_skipped(skipped)
+            if args.save_plan: report_saved_plan(args, plan, src_dir, dst_root, cfg)
+            if args.dry_run:
+                print("\nSummary: dry-run only."); return
+            ok, fail = execute_plan(plan, dst_root, args.move, cfg.get("_state"), jobs=args.jobs, journal=cfg.get("_journal"))
+        if fail: sys.exit(2)
+        return
+
+    # interactive 2-stage
+    if cfg.get("_max_items"):
+        print("[WARN] --max-memory only applies to -y runs; planning in memory.")
+    session = PlanSession(src_dir, dst_root, args, cfg)
+    while True:
+        proceed, dst_root, plan, sg, skipped = stage1_confirm(session, args, cfg)
+        if not proceed:
+            print("Aborted."); sys.exit(0)
+        proceed2 = stage2_confirm(dst_root, args, plan, sg, skipped)
+        if not proceed2:
+            continue
+        if args.save_plan: report_saved_plan(args, plan, src_dir, dst_root, cfg)
+        if args.dry_run:
+            print("\nSummary: dry-run only."); return
+        ok, fail = execute_plan(plan, dst_root, args.move, cfg.get("_state"), jobs=args.jobs, journal=cfg.get("_journal"))
+        if fail: sys.exit(2)
+        return
+
 def main():
     ap = argparse.ArgumentParser(
         description="Arrange anime for Jellyfin with episodes/subtitles and configurable extras (SP/PV/CM/NCOP...).",
@@ -597,8 +4198,19 @@ def main():
 
   # With config file (else default to script-dir aniarr.conf, then built-in)
   python ani_arr_v3_6.py --config ./aniarr.conf ./src ./Anime
+
+  # Keep watching a download folder (use --poll on NFS/SMB)
+  python ani_arr_v3_6.py --watch --state ~/.aniarr.db ./downloads ./Anime
+
+  # Many folders at once, one JSON object per line:
+  #   {"source": "./dl/Dandadan", "destination": "./Anime", "title": "胆大党", "season": 1}
+  python ani_arr_v3_6.py --batch manifest.jsonl
+
+  # Resident server for download-client completion hooks (see aniarr_client.py)
+  python ani_arr_v3_6.py --serve --state ~/.aniarr.db
+  python aniarr_client.py "%F" ./Anime
 """)
-    ap.add_argument("source", help="Source folder")
+    ap.add_argument("source", nargs="?", help="Source folder (omit with --batch)")
     ap.add_argument("destination", nargs="?", help="Destination root (default: source/organized)")
     ap.add_argument("-d", "--dry-run", action="store_true", help="Preview only (no writes)")
     ap.add_argument("-m", "--move", action="store_true", help="Move files instead of hardlink")
@@ -609,67 +4221,66 @@ def main():
     ap.add_argument("--no-extras", action="store_true", help="Disable extras processing (default: ON)")
     ap.add_argument("--extras-scope", choices=["series","season"], default="series", help="Series-level (default) or season-level extras (config can override)")
     ap.add_argument("--config", help="Path to JSON config (default: <script_dir>/aniarr.conf if present)")
+    # scanning
+    ap.add_argument("--depth", type=int, help="Subdirectory levels to descend into (default: config scan_depth, else 0 = top level only; SPs/extras folders are always entered)")
+    ap.add_argument("--ignore", action="append", metavar="GLOB", help="Skip files/dirs whose name matches GLOB (repeatable, added to config ignore)")
+    # incremental state
+    ap.add_argument("--state", metavar="DB", help="SQLite state db; skip files already executed in earlier runs (config: state_db)")
+    ap.add_argument("--full", action="store_true", help="Ignore the state db when planning (still records results)")
+    # watch mode
+    ap.add_argument("--watch", action="store_true", help="Keep running and organize files as they finish downloading (implies -y)")
+    ap.add_argument("--settle", type=float, default=30.0, metavar="SEC", help="Watch: seconds a file must stay unchanged before it is handled (default: 30)")
+    ap.add_argument("--poll", action="store_true", help="Watch: use mtime polling instead of inotify (needed for NFS/SMB mounts)")
+    ap.add_argument("--poll-interval", type=float, default=5.0, metavar="SEC", help="Watch: polling interval (default: 5)")
+    # execution
+    ap.add_argument("--stream", action="store_true", help="Non-interactive pipeline: scan, plan and link concurrently, each top-level folder as soon as it is scanned (implies -y; not with --dedupe)")
+    ap.add_argument("-j", "--jobs", type=int, default=1, metavar="N", help="Run up to N link/move operations in parallel (default: 1)")
+    # batch
+    ap.add_argument("--batch", metavar="MANIFEST", help="Plan many folders from a JSONL manifest ({\"source\", \"destination\", \"title\", \"year\", \"season\", ...} per line); non-interactive")
+    ap.add_argument("--batch-workers", type=int, metavar="N", help="Planner processes for --batch (default: CPU count)")
+    # server
+    ap.add_argument("--serve", nargs="?", const=default_socket(), metavar="SOCKET", help="Run as a resident server on a Unix socket (default: $ANIARR_SOCKET, else $XDG_RUNTIME_DIR/aniarr.sock); send it work with aniarr_client.py")
+    ap.add_argument("--serve-delay", type=float, default=2.0, metavar="SEC", help="Server: wait until no request arrived for SEC seconds, then plan the burst together (default: 2)")
+    ap.add_argument("--coordinate", metavar="QUEUE_DIR", help="Split the source into per-series units in a shared queue directory and wait for --work processes (on any host) to finish them")
+    ap.add_argument("--work", metavar="QUEUE_DIR", help="Claim units from a shared queue directory, plan and execute them; exits when the job is finished")
+    ap.add_argument("--spawn", type=int, default=0, metavar="N", help="With --coordinate: also start N local worker processes (logs in QUEUE_DIR/logs)")
+    ap.add_argument("--lease", type=float, default=QUEUE_LEASE, metavar="SEC", help=f"With --coordinate: units whose worker stopped renewing for SEC seconds are handed out again (default: {QUEUE_LEASE:g})")
+    # output
+    ap.add_argument("--format", choices=PLAN_FORMATS, default="text", help="Plan output: wrapped text (default) or one JSON record per item on stdout (ndjson; other output goes to stderr)")
+    # aliases
+    ap.add_argument("--aliases", metavar="FILE", help="Series alias file (JSON): maps title variants to one series folder; learns from --title")
+    ap.add_argument("--fuzzy-titles", action="store_true", help="Also group titles that differ only by a few characters within one run; titles with different trailing sequel/season tokens (II, 2, S2, 2nd Season, ...) are never merged (config: alias_fuzzy)")
+    # library
+    ap.add_argument("--skip-existing", action="store_true", help="Skip episodes, subtitles and extras already present in the destination (indexed once; kept in the state db)")
+    # probe
+    ap.add_argument("--probe", action="store_true", help="Read duration/track count from MKV/MP4 headers to classify videos the file name leaves ambiguous (config: probe)")
+    # plan file
+    ap.add_argument("--save-plan", metavar="FILE", help="Write the final plan, with each source's (dev, inode, size, mtime), to an NDJSON file (.gz to compress); combine with -y -d to review now and apply later")
+    ap.add_argument("--apply-plan", metavar="FILE", help="Execute a saved plan without scanning or parsing; sources that vanished or changed since it was saved are skipped")
+    # bounded memory
+    ap.add_argument("--max-memory", metavar="SIZE", help="Bound planning memory for huge -y runs (e.g. 512M): spill sorted runs to TMPDIR and merge them; skipped files are only counted (config: max_memory)")
+    ap.add_argument("-v", "--verbose", action="store_true", help="With --max-memory, still list every skipped file")
+    # dedupe
+    ap.add_argument("--dedupe", action="store_true", help="Skip duplicate files (same content, or the same planned destination such as v1/v2) and keep one per --prefer")
+    ap.add_argument("--prefer", metavar="POLICIES", help="Dedupe winner order, comma-separated: v2, group:NAME, larger (default: v2,larger)")
+    # journal
+    ap.add_argument("--journal", metavar="FILE", help="Append every link/move to FILE before and after it runs")
+    ap.add_argument("--resume", metavar="FILE", help="Continue an interrupted run: skip sources completed in journal FILE and keep appending to it")
+    ap.add_argument("--undo", metavar="FILE", help="Reverse the completed operations recorded in journal FILE, then exit")
+    # jellyfin
+    ap.add_argument("--jellyfin", metavar="URL", help="After executing, ask this Jellyfin server to rescan only the folders written to (api key: config jellyfin.api_key or $JELLYFIN_API_KEY)")
+    # stats
+    ap.add_argument("--stats", action="store_true", help="Print per-phase wall time and filesystem call counts to stderr")
+    ap.add_argument("--stats-file", metavar="FILE", help="Also write the stats as an OpenMetrics textfile (node_exporter textfile collector); implies --stats")
     # non-interactive
     ap.add_argument("-y", "--yes", action="store_true", help="Auto confirm and proceed (non-interactive)")
 
     args = ap.parse_args()
-    src_dir = Path(args.source)
-    dst_root = Path(args.destination) if args.destination else (src_dir / "organized")
-    if not src_dir.exists() or not src_dir.is_dir():
-        print(f"[ERROR] invalid source: {src_dir}"); sys.exit(1)
-
-    cfg = load_config(args.config)
-
-    # non-interactive
-    if args.yes:
-        plan, sg, skipped = build_plan(
-            src_dir, dst_root, args.season, args.title, args.year,
-            (not args.no_extras), args.extras_scope, cfg["rules"], cfg["fallback_category"], cfg.get("extras_scope")
-        )
-        rt = plan[0].title if plan else None
-        ry = plan[0].year if plan else None
-        rs = plan[0].season if plan else None
-        group_str = resolve_group_for_header(plan, sg)
-        eff_scope = cfg.get("extras_scope") or args.extras_scope
-        print_header(
-            src_dir, dst_root,
-            "DRY-RUN" if args.dry_run else ("MOVE" if args.move else "HARDLINK"),
-            args.title, args.year, args.season,
-            rt, ry, rs,
-            group_str, len(plan), (not args.no_extras), eff_scope, cfg["_config_path"]
-        )
-        print_plan(plan, dst_root); print_skipped(skipped)
-        if args.dry_run:
-            print("\nSummary: dry-run only."); return
-        ok = fail = 0
-        act_fn = act_move if args.move else act_hardlink
-        for it in plan:
-            success, how, final_path = act_fn(it.src, it.dst)
-            if success: ok += 1; print(wrap_line(f"[{how}] -> {final_path}"))
-            else: fail += 1; print(wrap_line(f"[FAIL] {it.src.name} :: {how}"))
-        print(f"\nDone. OK={ok}  FAIL={fail}"); 
-        if fail: sys.exit(2); 
-        return
-
-    # interactive 2-stage
-    while True:
-        proceed, dst_root, plan, sg, skipped = stage1_confirm(src_dir, dst_root, args, cfg)
-        if not proceed:
-            print("Aborted."); sys.exit(0)
-        proceed2 = stage2_confirm(dst_root, args, plan, sg, skipped)
-        if not proceed2:
-            continue
-        if args.dry_run:
-            print("\nSummary: dry-run only."); return
-        ok = fail = 0
-        act_fn = act_move if args.move else act_hardlink
-        for it in plan:
-            success, how, final_path = act_fn(it.src, it.dst)
-            if success: ok += 1; print(wrap_line(f"[{how}] -> {final_path}"))
-            else: fail += 1; print(wrap_line(f"[FAIL] {it.src.name} :: {how}"))
-        print(f"\nDone. OK={ok}  FAIL={fail}")
-        if fail: sys.exit(2); 
-        return
+    STATS.enabled = args.stats or bool(args.stats_file)
+    try:
+        run_cli(ap, args)
+    finally:
+        if STATS.enabled: emit_stats(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+import json, os, sys, tempfile, unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+class LearnTitlesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "aliases.json"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_title_override_learns_only_the_dominant_title(self):
+        counts = {"Dandadan": 12, "Dan Da Dan": 2, "Dandadan 01": 1, main.UNKNOWN_TITLE: 1, " ": 1}
+        aliases = main.AliasIndex(self.path)
+        aliases.learn_titles(counts, "胆大党")
+        aliases.save()
+        learned = json.loads(self.path.read_text(encoding="utf-8"))["胆大党"]
+        self.assertEqual(learned, ["Dandadan"])
+
+        # 之后无关的、解析不出标题的文件不会被归到 胆大党
+        later = main.AliasIndex(self.path)
+        title = main.PARSER.parse("[Other] [05].mkv").title
+        self.assertEqual(title, main.UNKNOWN_TITLE)
+        self.assertIsNone(later.resolve(title))
+        self.assertEqual(later.plan_titles({title: 1}), {title: title})
+        self.assertEqual(later.resolve("Dan Da Dan"), "胆大党")
+
+    def test_similar_spelling_is_learned_but_not_a_sequel(self):
+        counts = {"Kono Subarashii Sekai ni Shukufuku wo": 10,
+                  "Kono Subarashii Sekai ni Syukufuku wo": 1,
+                  "Kono Subarashii Sekai ni Shukufuku wo 2": 1}
+        aliases = main.AliasIndex(self.path)
+        aliases.learn_titles(counts, "KonoSuba")
+        self.assertEqual(aliases.resolve("Kono Subarashii Sekai ni Syukufuku wo"), "KonoSuba")
+        self.assertIsNone(aliases.resolve("Kono Subarashii Sekai ni Shukufuku wo 2"))
+
+
+if __name__ == "__main__":
+    unittest.main()